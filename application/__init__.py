@@ -1,5 +1,4 @@
 from flask import Flask
-from mongoengine import connect
 import os
 
 VAR_SECRET_KEY = 'SYLLABITS_SECRET_KEY'
@@ -17,6 +16,7 @@ def create_app():
         load_config(app.config)
 
         # Initialize extensions
+        # This also registers the DB connection, which connects lazily (see 'MongoConnection')
         from .extensions import all
         for ext in all: ext.init_app(app)
 
@@ -30,10 +30,9 @@ def create_app():
         # Set up commands
         from . import commands
 
-        # Connect to DB
-        connect(db=app.config['MONGO_DB'], host=app.config['MONGO_URI'])
-
-        # Construct/register schemas
+        # Construct/register schemas and their query budgets
+        from . import schema_loader
+        schema_loader.use_budgets(app.config['QUERY_BUDGETS'])
         from . import schemas
 
         # Construct views
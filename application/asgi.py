@@ -0,0 +1,114 @@
+"""
+ASGI interface
+GraphQL requests are executed on the event loop (see 'views.handle_request_async'), so resolvers that
+wait on Mongo don't hold up other requests. Every other route is served by the WSGI app in a thread.
+Requires asgiref, and hot resolvers use Motor (see 'AsyncMongo').
+"""
+
+import io
+from asgiref.wsgi import WsgiToAsgi
+
+def build_environ(scope, body):
+    """
+    Builds a WSGI environ for an ASGI HTTP request, so Flask can parse it
+    """
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf8').decode('latin1'),
+        'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+        'QUERY_STRING': scope['query_string'].decode('ascii'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'REMOTE_ADDR': client[0],
+        'REMOTE_HOST': client[0],
+        'REMOTE_PORT': client[1],
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': io.StringIO(),
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        'CONTENT_LENGTH': str(len(body)),
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1')
+        value = value.decode('latin1')
+        if name == 'content-type':
+            environ['CONTENT_TYPE'] = value
+            continue
+        if name == 'content-length':
+            continue
+        key = 'HTTP_' + name.upper().replace('-', '_')
+        # Repeated headers are combined, like WSGI servers do
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+class ASGIApp:
+    """
+    Serves a Flask app over ASGI, executing GraphQL requests asynchronously
+    The GraphQL view is called within a regular request context, and the response goes through
+    'process_response', so after-request handlers (like CORS) still apply.
+    """
+
+    # Requests to these paths with these methods are executed on the event loop
+    graphql_paths = {'/'}
+    graphql_methods = {'GET', 'POST'}
+
+    def __init__(self, app):
+        self.app = app
+        self.wsgi = WsgiToAsgi(app)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.handle_lifespan(receive, send)
+        elif scope['type'] == 'http' and scope['path'] in self.graphql_paths and scope['method'] in self.graphql_methods:
+            await self.handle_graphql(scope, receive, send)
+        else:
+            await self.wsgi(scope, receive, send)
+
+    async def handle_lifespan(self, receive, send):
+        from .extensions import progress_buffer
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                # Persist buffered progress before the server exits
+                with self.app.app_context():
+                    progress_buffer.flush()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def read_body(self, receive):
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                break
+            body.extend(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        return bytes(body)
+
+    async def handle_graphql(self, scope, receive, send):
+        from .views import handle_request_async
+        body = await self.read_body(receive)
+        with self.app.request_context(build_environ(scope, body)):
+            # Mirrors 'Flask.full_dispatch_request', with the view awaited
+            try:
+                try:
+                    rv = self.app.preprocess_request()
+                    if rv is None:
+                        rv = await handle_request_async()
+                except Exception as e:
+                    rv = self.app.handle_user_exception(e)
+                response = self.app.finalize_request(rv)
+            except Exception as e:
+                response = self.app.handle_exception(e)
+            headers = [(name.lower().encode('latin1'), value.encode('latin1')) for name, value in response.headers.items()]
+            await send({'type': 'http.response.start', 'status': response.status_code, 'headers': headers})
+            await send({'type': 'http.response.body', 'body': response.get_data()})
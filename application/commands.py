@@ -1,22 +1,84 @@
 import click
-import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 from flask import current_app
-from .models import Poem
+from bson.objectid import ObjectId
+from mongoengine.errors import ValidationError
+from .models import recount_categories, migrate_user_poems
+from .importer import read_records, assign_ids, batched, validate_poem, insert_poems
 
 @current_app.cli.command('importpoems')
 @click.argument('path', type=click.Path(exists=True))
-def import_poems(path):
+@click.option('--batch-size', default=500, show_default=True, help='Number of poems inserted at once')
+@click.option('--workers', default=os.cpu_count(), show_default=True, help='Number of processes used to validate poems')
+@click.option('--checkpoint', type=click.Path(), help='File used to record progress so an interrupted import can be resumed')
+def import_poems(path, batch_size, workers, checkpoint):
+    """
+    Imports poems from a JSON array or JSON lines file
+    Poems are read incrementally, validated in parallel, and inserted in batches.
+    If a checkpoint file is given, the import resumes after the last batch recorded in it.
+    Poems without an ID are given IDs derived from the import's seed (see 'assign_ids'), which is recorded in the
+    checkpoint, so poems inserted after the last checkpoint aren't inserted twice when resuming.
+    """
     click.echo(f'Importing poems from \'{path}\'...')
 
-    with open(path) as file:
-        data = json.load(file)
+    # Resume from checkpoint if one exists
+    # The checkpoint holds the number of poems processed and the seed of the import's IDs
+    skip = 0
+    seed = ObjectId()
+    if checkpoint and os.path.exists(checkpoint):
+        with open(checkpoint) as file:
+            fields = file.read().split()
+        if fields:
+            skip = int(fields[0])
+        if len(fields) > 1:
+            seed = ObjectId(fields[1])
+        click.echo(f'Resuming after {skip} poems')
 
-        for poem_data in data:
-            # Create new poem
-            poem = Poem._from_son(poem_data, created=True)
-            poem.save()
-        
-        click.echo('Done')
-        
+    def record_progress(processed):
+        if checkpoint:
+            with open(checkpoint, 'w') as checkpoint_file:
+                checkpoint_file.write(f'{processed} {seed}')
 
+    # Record the seed before inserting anything, so even the first batch can be resumed
+    record_progress(skip)
+    processed = skip
+    inserted = 0
+    started = time.monotonic()
+    with open(path) as file, ProcessPoolExecutor(max_workers=workers) as executor:
+        records = assign_ids(islice(read_records(file), skip, None), seed, skip)
+        for batch in batched(records, batch_size):
+            # Validate poems in worker processes
+            try:
+                documents = list(executor.map(validate_poem, batch, chunksize=max(1, len(batch) // workers)))
+            except ValidationError as error:
+                raise click.ClickException(f'Invalid poem in batch starting at poem {processed}: {error}')
+            inserted += insert_poems(documents)
+            processed += len(batch)
+            record_progress(processed)
+            rate = (processed - skip) / max(time.monotonic() - started, 1e-6)
+            click.echo(f'Processed {processed} poems ({inserted} inserted, {rate:.0f} poems/s)')
 
+    click.echo('Done')
+
+@current_app.cli.command('recountcategories')
+def recount_categories_command():
+    click.echo('Recounting category references...')
+    counts = recount_categories()
+    click.echo(f'Done ({len(counts)} categories in use)')
+
+@current_app.cli.command('migrateuserpoems')
+@click.option('--batch-size', default=500, show_default=True, help='Number of users migrated at once')
+def migrate_user_poems_command(batch_size):
+    """
+    Moves the saved, in-progress and completed poems and the locations of users to their own collection
+    Can be interrupted and run again.
+    """
+    click.echo('Migrating user poems...')
+    migrated = 0
+    for count in migrate_user_poems(batch_size):
+        migrated += count
+        click.echo(f'Migrated {migrated} users')
+    click.echo('Done')
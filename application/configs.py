@@ -3,16 +3,131 @@ from .config_loader import for_mode
 class BaseConfig:
     MONGO_DB = 'syllabits'
     MONGO_URI = 'mongodb://127.0.0.1:27017'
+    # Each worker process has its own connection pool, created when the worker first queries the database
+    # Timeouts are in milliseconds. Options set to None use the driver's defaults.
+    MONGO_MAX_POOL_SIZE = 20
+    MONGO_MIN_POOL_SIZE = 0
+    MONGO_MAX_IDLE_TIME_MS = 60000
+    # How long a request waits for a free connection before failing
+    MONGO_WAIT_QUEUE_TIMEOUT_MS = 2000
+    MONGO_CONNECT_TIMEOUT_MS = 5000
+    MONGO_SERVER_SELECTION_TIMEOUT_MS = 5000
+    MONGO_SOCKET_TIMEOUT_MS = 20000
+    # Queries running longer than this are aborted by the server, so runaway queries can't hold on to connections
+    # Should be less than MONGO_SOCKET_TIMEOUT_MS
+    MONGO_MAX_TIME_MS = 10000
     JWT_TOKEN_LOCATION = 'headers'
     JWT_HEADER_TYPE = ''
     # No need to send cookies when making third-party requests
     JWT_COOKIE_SAMESITE = 'strict'
     CORS_SUPPORTS_CREDENTIALS = True
+    # Authenticated users are cached for a short time to avoid a lookup on every request
+    # Editors and admins are never cached, so changes to their roles apply right away on every worker
+    USER_CACHE_SIZE = 1024
+    USER_CACHE_TTL = 30
+    # Only load the fields needed for authentication when looking up users
+    USER_LOOKUP_AUTH_ONLY = False
+    # How often (in seconds) each worker syncs its copy of the token blocklist
+    # Tokens revoked on other workers may be accepted for up to this long
+    BLOCKLIST_SYNC_INTERVAL = 10
+    # Parsed and validated GraphQL documents are cached per schema
+    DOCUMENT_CACHE_SIZE = 512
+    # Clients can opt in to sending query hashes in place of queries
+    ENABLE_PERSISTED_QUERIES = True
+    PERSISTED_QUERY_CACHE_SIZE = 1024
+    ENABLE_CACHE_STATS = False
+    # Connection counts are cached until the model changes, or for at most COUNT_CACHE_TTL seconds
+    COUNT_CACHE_SIZE = 1024
+    COUNT_CACHE_TTL = 60
+    # Use the collection's estimated document count for unfiltered connections
+    ESTIMATE_UNFILTERED_COUNTS = False
+    # How often (in seconds) each worker reloads the pool of poems used to choose random poems
+    POEM_POOL_REFRESH_INTERVAL = 300
+    # The poem recommender reloads poem categories every RECOMMENDER_REFRESH_INTERVAL seconds
+    # Completed and in-progress poems contribute to a user's interests with different weights
+    RECOMMENDER_REFRESH_INTERVAL = 300
+    RECOMMENDER_COMPLETED_WEIGHT = 1
+    RECOMMENDER_IN_PROGRESS_WEIGHT = 0.5
+    # The poem IDs of collections are cached for navigating through collections
+    COLLECTION_CACHE_SIZE = 256
+    COLLECTION_CACHE_TTL = 300
+    # The line keys of poems are cached for checking answers
+    # Editing a poem only drops the keys cached by the worker that made the edit. Other workers keep checking answers
+    # against the old keys (and storing the results in progress) for up to LINE_KEY_CACHE_TTL seconds, so keep it short
+    LINE_KEY_CACHE_SIZE = 2048
+    LINE_KEY_CACHE_TTL = 10
+    # Buffer progress writes and flush them in bulk every PROGRESS_FLUSH_INTERVAL seconds,
+    # or once PROGRESS_FLUSH_SIZE users/poems have pending progress
+    PROGRESS_WRITE_BEHIND = False
+    PROGRESS_FLUSH_INTERVAL = 1
+    PROGRESS_FLUSH_SIZE = 500
+    # Cache responses to anonymous queries, up to RESPONSE_CACHE_MAX_BYTES in total
+    # Responses are dropped when a model they select changes, or after RESPONSE_CACHE_TTL seconds
+    # Only writes made by the same worker drop responses, so with several workers, responses can be stale for up to
+    # RESPONSE_CACHE_TTL seconds. Only enable this if that is acceptable (or there is a single worker)
+    ENABLE_RESPONSE_CACHE = False
+    RESPONSE_CACHE_MAX_BYTES = 32 * 1024 * 1024
+    RESPONSE_CACHE_TTL = 60
+    # Record request, resolver and Mongo command metrics, labeled by operation name (at most METRICS_MAX_OPERATIONS names)
+    # Metrics are off by default since they add work to every resolver and Mongo command
+    # Counting the bytes of Mongo commands and replies costs re-encoding them
+    ENABLE_METRICS = False
+    METRICS_COUNT_MONGO_BYTES = False
+    METRICS_MAX_OPERATIONS = 100
+    # Serve metrics in the Prometheus format at '/metrics'
+    EXPOSE_METRICS = False
+    # Log requests taking at least SLOW_REQUEST_THRESHOLD seconds, along with their slowest resolvers (when metrics are enabled)
+    SLOW_REQUEST_THRESHOLD = 1
+    SLOW_REQUEST_TOP_RESOLVERS = 5
+    # Operations are rejected before execution if their estimated cost or depth exceeds the budget of the user's role
+    # The cost is roughly the number of documents an operation can read (see 'CostAnalysis'). Lists without a
+    # 'first' or 'last' argument are assumed to have QUERY_COST_DEFAULT_LIST_SIZE items
+    # Budgets are (cost, depth) tuples keyed by role name, and roles without a budget use the public budget
+    # Clients load whole connections without 'first' (like every collection along with its poems and the user's progress,
+    # which is estimated at about 20000), so budgets leave room for that. See tests/test_query_budgets.py
+    QUERY_BUDGETS = {
+        'public': (50000, 12),
+        'EDITOR': (100000, 15),
+        'ADMIN': (200000, 15),
+    }
+    QUERY_COST_DEFAULT_LIST_SIZE = 100
+    # Accept arrays of up to MAX_BATCH_SIZE operations in one request. The operations of a batch share one query budget
+    ENABLE_BATCHING = True
+    MAX_BATCH_SIZE = 10
+    # Passwords are hashed with bcrypt at a cost of 2^BCRYPT_LOG_ROUNDS. When this changes, hashes are updated as users log in
+    BCRYPT_LOG_ROUNDS = 12
+    # At most PASSWORD_HASH_WORKERS passwords are hashed at once (per worker process), and at most PASSWORD_HASH_QUEUE_SIZE
+    # more can wait. Logins and registrations beyond that are rejected right away
+    # Only the ASGI mode serves other requests while waiting on a hash. Over WSGI, the request thread still waits
+    PASSWORD_HASH_WORKERS = 2
+    PASSWORD_HASH_QUEUE_SIZE = 32
+    # Login attempts allowed per email, and login and registration attempts allowed per IP address, within a window (in seconds)
+    # Classrooms often share an IP address, so the IP limit is generous. A successful login resets the email's count
+    LOGIN_EMAIL_ATTEMPTS = 10
+    LOGIN_EMAIL_WINDOW = 300
+    LOGIN_IP_ATTEMPTS = 300
+    LOGIN_IP_WINDOW = 300
+    # Number of reverse proxies in front of the server. Client IP addresses (used to limit attempts) are read from
+    # the 'X-Forwarded-For' entry added by the outermost one. Leave at 0 unless every request comes through the proxies,
+    # since clients could otherwise spoof their address
+    TRUSTED_PROXIES = 0
+    # When serving in ASGI mode (see asgi.py), hot resolvers use Motor if it is installed
+    ENABLE_ASYNC_MONGO = True
 
 @for_mode('development')
 class DevelopmentConfig(BaseConfig):
     DEBUG = True
     ENABLE_GRAPHIQL = True
+    ENABLE_CACHE_STATS = True
+    ENABLE_METRICS = True
+    METRICS_COUNT_MONGO_BYTES = True
+    EXPOSE_METRICS = True
+    # A small pool is plenty for a single developer, and slow queries shouldn't be cut off while debugging
+    MONGO_MAX_POOL_SIZE = 5
+    MONGO_SOCKET_TIMEOUT_MS = None
+    MONGO_MAX_TIME_MS = None
+    # Cheap hashes keep logging in quick while developing
+    BCRYPT_LOG_ROUNDS = 4
 
 @for_mode('betatesting')
 class BetaTestingConfig(BaseConfig):
@@ -20,6 +135,7 @@ class BetaTestingConfig(BaseConfig):
     ENABLE_GRAPHIQL = False
     JWT_COOKIE_SECURE = True
     CORS_ORIGINS = 'https://syllabits.betatesting.as.ua.edu'
+    MONGO_MAX_POOL_SIZE = 10
 
 @for_mode('production')
 class ProductionConfig(BaseConfig):
@@ -27,3 +143,7 @@ class ProductionConfig(BaseConfig):
     ENABLE_GRAPHIQL = False
     JWT_COOKIE_SECURE = True
     CORS_ORIGINS = 'https://syllabits.as.ua.edu'
+    # Keep a few connections open so bursts don't wait on connection setup
+    MONGO_MAX_POOL_SIZE = 50
+    MONGO_MIN_POOL_SIZE = 5
+    MONGO_MAX_TIME_MS = 5000
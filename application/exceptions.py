@@ -3,4 +3,11 @@ class InsufficientPrivilegeError(Exception):
     Raised when accessing a field that the user is not authorized to access
     Ex. non-admin accessing poem keys
     """
+    pass
+
+class ServerBusyError(Exception):
+    """
+    Raised when a bounded pool of work (like password hashing) is full
+    Requests are rejected right away rather than queueing behind the backlog.
+    """
     pass
\ No newline at end of file
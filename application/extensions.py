@@ -1,13 +1,75 @@
 from flask_cors import CORS
 from flask_bcrypt import Bcrypt
 from flask_jwt_extended import JWTManager
+from flask import current_app
 from bson.objectid import ObjectId
 
-from .models import User, TokenBlocklist
+from .models import User, Poem, Category, Collection, Progress, UserPoem, TokenBlocklist
+from .utilities import Cache, TokenBlocklistCache, PasswordHasher, ProgressBuffer, PoemPool, PoemRecommender, ResponseCache, AttemptLimiter, Metrics, MongoConnection, AsyncMongo, signals, count_cache
+from .roles import Role
 
+metrics = Metrics()
+mongo = MongoConnection()
 cors = CORS()
 bcrypt = Bcrypt()
 jwt = JWTManager()
+blocklist_cache = TokenBlocklistCache(TokenBlocklist)
+poem_pool = PoemPool(Poem)
+poem_recommender = PoemRecommender(Poem)
+progress_buffer = ProgressBuffer(Progress, UserPoem)
+password_hasher = PasswordHasher(bcrypt)
+user_cache = Cache('USER_CACHE', size=1024, ttl=30)
+"""
+Caches users looked up during authentication, keyed by user ID
+Anything that modifies a user should invalidate the cached user.
+The TTL bounds how long other workers can hold on to a stale user, so only regular users are cached
+(see 'user_lookup_callback').
+"""
+
+document_cache = Cache('DOCUMENT_CACHE', size=512)
+"""
+Caches parsed and validated GraphQL documents, keyed by schema and query hash
+"""
+persisted_queries = Cache('PERSISTED_QUERY_CACHE', size=1024)
+"""
+Maps query hashes to query strings so clients can send the hash in place of the query
+"""
+
+collection_cache = Cache('COLLECTION_CACHE', size=256, ttl=300)
+"""
+Caches the poem IDs of collections, keyed by collection ID
+"""
+
+line_key_cache = Cache('LINE_KEY_CACHE', size=2048, ttl=10)
+"""
+Caches the line keys of poems (used to check answers), keyed by poem ID
+Edits only invalidate this worker's copy, so the TTL bounds how long other workers check answers against old keys.
+"""
+
+login_email_limiter = AttemptLimiter('LOGIN_EMAIL', attempts=10, window=300)
+"""
+Limits login attempts per email, so a single account can't be guessed at
+"""
+login_ip_limiter = AttemptLimiter('LOGIN_IP', attempts=300, window=300)
+"""
+Limits login and registration attempts per IP address, so credential stuffing can't occupy the password hasher
+"""
+
+response_cache = ResponseCache()
+"""
+Caches responses to anonymous queries
+"""
+
+async_mongo = AsyncMongo()
+"""
+Async Mongo driver used by the hot resolvers when serving in ASGI mode
+"""
+
+AUTH_FIELDS = ('id', 'email', 'role')
+"""
+The user fields required for authentication and authorization
+If 'USER_LOOKUP_AUTH_ONLY' is set, only these fields are loaded when authenticating.
+"""
 
 # Set up automatic user serialization/deserialization
 @jwt.user_identity_loader
@@ -17,7 +79,54 @@ def user_identity_lookup(user):
 @jwt.user_lookup_loader
 def user_lookup_callback(jwt_header, jwt_data):
     identity = ObjectId(jwt_data["sub"])
-    return User.objects(pk=identity).first()
+    def load():
+        query = User.objects(pk=identity)
+        if current_app.config['USER_LOOKUP_AUTH_ONLY']:
+            query = query.only(*AUTH_FIELDS)
+        return query.first()
+    # Tokens of privileged users (editors and admins) are always looked up, so a demoted or deleted
+    # admin loses their privileges on every worker right away, rather than when other workers' cached users expire
+    if jwt_data.get('role') != Role.USER.name:
+        return load()
+    return user_cache.get_or_load(identity, load)
+
+# Drop cached users when they are updated or deleted by admins
+@signals.post_update.connect_via(User)
+@signals.post_delete.connect_via(User)
+def user_changed(sender, document, **kwargs):
+    user_cache.invalidate(document.id)
+
+# Keep the poem pool and recommender current
+@signals.post_create.connect_via(Poem)
+@signals.post_update.connect_via(Poem)
+def poem_saved(sender, document, **kwargs):
+    poem_pool.add(document)
+    poem_recommender.add(document)
+
+@signals.post_delete.connect_via(Poem)
+def poem_deleted(sender, document, **kwargs):
+    poem_pool.remove(document)
+    poem_recommender.remove(document)
+    line_key_cache.invalidate(document.id)
+
+@signals.post_update.connect_via(Poem)
+def poem_updated(sender, document, **kwargs):
+    line_key_cache.invalidate(document.id)
+
+@signals.post_update.connect_via(Collection)
+@signals.post_delete.connect_via(Collection)
+def collection_changed(sender, document, **kwargs):
+    collection_cache.invalidate(document.id)
+
+# Drop cached responses that select a model whenever a document of the model changes
+# Category reference counts are maintained by poem signals, so poems also affect categories
+def invalidate_responses(sender, **kwargs):
+    response_cache.invalidate_model(sender)
+    if sender is Poem:
+        response_cache.invalidate_model(Category)
+
+for _signal in (signals.pre_create, signals.post_create, signals.pre_update, signals.post_update, signals.pre_delete, signals.post_delete):
+    _signal.connect(invalidate_responses)
 
 @jwt.additional_claims_loader
 def additional_claims_callback(user):
@@ -25,10 +134,11 @@ def additional_claims_callback(user):
 
 # Set up blocked token checker
 # If a block exists for the jti of the jwt, we block it
+# Blocks are checked against the local copy of the blocklist
 @jwt.token_in_blocklist_loader
 def check_token_block(jwt_header, jwt_payload):
     jti = jwt_payload['jti']
-    block = TokenBlocklist.objects.with_id(jti)
-    return block is not None
+    return blocklist_cache.is_revoked(jti)
 
-all = [cors, bcrypt, jwt]
\ No newline at end of file
+# Metrics must be initialized before the Mongo connection, see 'Metrics.init_app'
+all = [metrics, mongo, cors, bcrypt, password_hasher, login_email_limiter, login_ip_limiter, jwt, user_cache, blocklist_cache, document_cache, persisted_queries, count_cache, poem_pool, poem_recommender, collection_cache, line_key_cache, progress_buffer, response_cache, async_mongo]
\ No newline at end of file
@@ -0,0 +1,101 @@
+"""
+Helpers for importing poems in bulk
+These are kept separate from the commands so they can be used by worker processes.
+"""
+import json
+from itertools import islice
+from bson.objectid import ObjectId
+from pymongo.errors import BulkWriteError
+from .models import Poem, CategoryRefCounts
+
+DUPLICATE_KEY = 11000
+
+def read_records(file, chunk_size=1 << 16):
+    """
+    Yields the records of a file containing either a JSON array or JSON lines
+    The file is decoded incrementally, so the whole file is never held in memory.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    started = False
+    eof = False
+    while True:
+        # Skip whitespace and separators between records
+        buffer = buffer.lstrip(' \t\r\n,')
+        if buffer and not started:
+            started = True
+            if buffer[0] == '[':
+                buffer = buffer[1:]
+                continue
+        if buffer.startswith(']'):
+            return
+        if buffer:
+            try:
+                record, end = decoder.raw_decode(buffer)
+                buffer = buffer[end:]
+                yield record
+                continue
+            except json.JSONDecodeError:
+                # Record is incomplete, unless we have read the whole file
+                if eof:
+                    raise
+        elif eof:
+            return
+        chunk = file.read(chunk_size)
+        eof = not chunk
+        buffer += chunk
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+def assign_ids(records, seed, start=0):
+    """
+    Gives each record without an ID an ID derived from the import's seed (an ObjectId) and the record's index
+    Resuming an interrupted import with the same seed assigns the same IDs, so poems of a batch that were inserted
+    before the interruption are skipped as duplicates rather than inserted twice.
+    IDs keep the timestamp and random bytes of the seed, followed by the index, so poems are ordered as in the file.
+    """
+    prefix = seed.binary[:8]
+    for index, record in enumerate(records, start):
+        if isinstance(record, dict) and '_id' not in record:
+            record['_id'] = ObjectId(prefix + index.to_bytes(4, 'big'))
+        yield record
+
+def validate_poem(data):
+    """
+    Validates raw poem data, returning the document to insert
+    Raises a ValidationError if the data is invalid.
+    """
+    poem = Poem._from_son(data, created=True)
+    poem.validate()
+    return poem.to_mongo().to_dict()
+
+def insert_poems(documents):
+    """
+    Inserts validated poems and updates category reference counts, returning the number inserted
+    Poems that already exist (by ID) are skipped, which makes re-importing a batch harmless.
+    If any other insert fails, the counts of the poems that were inserted are still updated before the error is raised.
+    """
+    skipped = set()
+    failure = None
+    try:
+        Poem._get_collection().insert_many(documents, ordered=False)
+    except BulkWriteError as error:
+        for write_error in error.details['writeErrors']:
+            if write_error['code'] != DUPLICATE_KEY:
+                failure = error
+            skipped.add(write_error['index'])
+    # Count categories of inserted poems
+    counts = CategoryRefCounts()
+    for index, document in enumerate(documents):
+        if index not in skipped:
+            counts.add(document.get('categories', []))
+    counts.apply()
+    if failure is not None:
+        raise failure
+    return len(documents) - len(skipped)
@@ -1,5 +1,9 @@
 from mongoengine import Document, EmbeddedDocument
 from bson.objectid import ObjectId
+from collections import Counter
+from datetime import datetime
+from enum import IntEnum
+from pymongo import UpdateOne, UpdateMany
 from mongoengine.fields import (
     ObjectIdField,
     EmailField,
@@ -15,7 +19,7 @@ from mongoengine.fields import (
     EnumField,
 )
 from .roles import Role
-from .utilities import signals, operators
+from .utilities import TimeLimitedQuerySet, signals, operators
 
 class Category(Document):
     """
@@ -26,12 +30,12 @@ class Category(Document):
     Categories are used to describe groups of similar poems. For example, a category could describe poems
     that share a common theme, were written in the same time period, etc.
     """
-    meta = {'collection': 'category'}
+    meta = {'collection': 'category', 'queryset_class': TimeLimitedQuerySet}
     name = StringField(primary_key=True)
     ref_count = IntField(required=True)
 
 class Collection(Document):
-    meta = {'collection': 'collection'}
+    meta = {'collection': 'collection', 'queryset_class': TimeLimitedQuerySet}
     title = StringField()
     categories = ListField(ReferenceField(Category))
     """
@@ -69,6 +73,7 @@ class PoemLine(EmbeddedDocument):
 class Poem(Document):
     meta = {
         'collection': 'poem',
+        'queryset_class': TimeLimitedQuerySet,
         # We define a text index for searching poems using content, title, etc.
         'indexes': [
             {
@@ -87,29 +92,77 @@ class Poem(Document):
     author = StringField()
     lines = EmbeddedDocumentListField(PoemLine)
 
+class CategoryRefCounts:
+    """
+    Accumulates changes to category reference counts so they can be applied in one bulk write
+    Bulk operations (like importing poems) can use a single instance for the whole batch.
+    """
+
+    def __init__(self):
+        self.deltas = Counter()
+
+    def add(self, names, delta=1):
+        for name in names:
+            self.deltas[name] += delta
+
+    def apply(self):
+        # Categories are created when first referenced
+        requests = [
+            UpdateOne({'_id': name}, {'$inc': {'ref_count': delta}}, upsert=(delta > 0))
+            for name, delta in self.deltas.items() if delta
+        ]
+        if requests:
+            Category._get_collection().bulk_write(requests, ordered=False)
+        self.deltas.clear()
+
+def recount_categories():
+    """
+    Recomputes the reference count of every category from the poems themselves
+    Useful for repairing counts that have drifted (if a write failed halfway through, for instance).
+    """
+    pipeline = [
+        {'$unwind': '$categories'},
+        {'$group': {'_id': '$categories', 'ref_count': {'$sum': 1}}},
+    ]
+    counts = {data['_id']: data['ref_count'] for data in Poem.objects.aggregate(pipeline)}
+    requests = [UpdateOne({'_id': name}, {'$set': {'ref_count': count}}, upsert=True) for name, count in counts.items()]
+    requests.append(UpdateMany({'_id': {'$nin': list(counts)}}, {'$set': {'ref_count': 0}}))
+    Category._get_collection().bulk_write(requests, ordered=False)
+    return counts
+
 # Connect poem signals so that we can update category
 # reference counts when appropriate
 
 @signals.pre_create.connect_via(Poem)
 def poem_pre_create(sender, document):
-    for name in document.categories:
-        Category.objects(pk=name).upsert_one(inc__ref_count=1)
+    counts = CategoryRefCounts()
+    counts.add(document.categories, 1)
+    counts.apply()
 
 @signals.pre_delete.connect_via(Poem)
 def poem_pre_delete(sender, document):
-    for name in document.categories:
-        Category.objects(pk=name).update_one(dec__ref_count=1)
+    counts = CategoryRefCounts()
+    counts.add(document.categories, -1)
+    counts.apply()
 
 @signals.pre_update.connect_via(Poem)
-def poem_pre_update(sender, document, operator, receiver, args):
+def poem_pre_update(sender, document, operator, receiver, path, args, state):
     # If adding a category, increment reference count
-    if operator == operators.add and receiver == document.categories:
-        Category.objects(pk=args['value']).upsert_one(inc__ref_count=1)
-    elif operator == operators.remove and receiver == document.categories:
-        Category.objects(pk=args['value']).update_one(dec__ref_count=1)
+    # Changes are collected in the update state and applied once the document is saved
+    if path.string == 'categories' and operator in (operators.add, operators.remove):
+        counts = state.setdefault('category_ref_counts', CategoryRefCounts())
+        delta = 1 if operator == operators.add else -1
+        counts.add([args['value']], delta)
+
+@signals.post_update.connect_via(Poem)
+def poem_post_update(sender, document, state):
+    counts = state.get('category_ref_counts')
+    if counts:
+        counts.apply()
 
 class User(Document):
-    meta = {'collection': 'user', 'indexes': [
+    # Users that haven't been migrated yet (see 'migrateuserpoems') still have the old play state fields
+    meta = {'collection': 'user', 'queryset_class': TimeLimitedQuerySet, 'strict': False, 'indexes': [
         'email',
         {
             'fields': ['$email'],
@@ -120,49 +173,157 @@ class User(Document):
     email = EmailField(unique=True)
     password_hashed = StringField(required=True)
     role = EnumField(Role, default=Role.USER)
-    saved = ListField(ReferenceField(Poem))
-    """
-    A user can 'save' poems. This is a simple, general-purpose feature which allows
-    users to remember poems (that they would like to play, for instance)
-    When the user starts working on a poem, the poem is moved from saved to in-progress.
-    Currently not implemented.
-    """
-    in_progress = ListField(ReferenceField(Poem))
-    """
-    A list of the poems the user is currently "working on"
-    Important to note is that all poems in-progress have an associated Progress document,
-    but the vice-versa isn't necessarily true. A poem can be completed and not in-progress,
-    and still have a progress document.
-    A poem becomes in-progress by initially submitting a line of the poem.
-    """
-    completed = ListField(ReferenceField(Poem))
-    """
-    A list of poems the user has completed
-    A poem becomes completed once all lines are correct. Once completed, a poem is no longer
-    considered in-progress, but can become in-progress again by resetting the progress.
-    """
-    locations = MapField(StringField())
-    """
-    A map of poems to locations which were most recently used to access the poem
-    """
+    # Poems the user has saved, is working on, or has completed, along with the locations last used to access them,
+    # are stored in the 'UserPoem' collection rather than in the user, so that authenticating stays cheap
 
 @signals.pre_delete.connect_via(User)
 def user_pre_delete(sender, document):
     # Mongoengine supposedly has support for cascading deletes,
     # but I've found (from experience) that it's always better to be explicit with Mongoengine...
     Progress.objects(user=document).delete()
+    UserPoem.objects(user=document).delete()
 
 class ProgressLine(EmbeddedDocument):
     answer = ListField(StringField(max_length=1), required=True)
     correct = BooleanField(required=True)
 
 class Progress(Document):
-    meta = {'collection': 'progress', 'indexes': [('user', 'poem')]}
+    meta = {'collection': 'progress', 'queryset_class': TimeLimitedQuerySet, 'indexes': [('user', 'poem')]}
     user = ReferenceField(User, required=True)
     poem = ReferenceField(Poem, required=True, unique_with='user')
     lines = MapField(EmbeddedDocumentField(ProgressLine), required=True)
     num_correct = IntField()
 
+class PoemState(IntEnum):
+    """
+    The state of a poem for a user
+    States are ordered: a poem moves from saved to in-progress to completed, and updates use '$max'
+    so that a poem never moves back (submitting a line of a completed poem keeps it completed).
+    Resetting progress clears the state.
+    """
+    SAVED = 1
+    """
+    A user can 'save' poems. This is a simple, general-purpose feature which allows
+    users to remember poems (that they would like to play, for instance)
+    Currently not implemented.
+    """
+    IN_PROGRESS = 2
+    """
+    The poem the user is currently "working on"
+    Important to note is that all poems in-progress have an associated Progress document,
+    but the vice-versa isn't necessarily true.
+    A poem becomes in-progress by initially submitting a line of the poem.
+    """
+    COMPLETED = 3
+    """
+    A poem becomes completed once all lines are correct.
+    """
+
+class UserPoem(Document):
+    """
+    The relation between a user and a poem they have played: the poem's state and the location
+    most recently used to access it
+    Users can play any number of poems, so these are kept in their own collection rather than in lists on the user.
+    Either the state or the location can be missing (a poem that was opened but never played has no state).
+    """
+    meta = {
+        'collection': 'user_poem',
+        'queryset_class': TimeLimitedQuerySet,
+        'indexes': [
+            {'fields': ['user', 'poem'], 'unique': True},
+            # Lists of a user's poems in a state are paged through by poem ID
+            ('user', 'state', 'poem'),
+        ]
+    }
+    user = ReferenceField(User, required=True)
+    poem = ReferenceField(Poem, required=True)
+    state = EnumField(PoemState)
+    location = StringField()
+    updated_at = DateTimeField(default=datetime.utcnow)
+
+    @classmethod
+    def get_poem_ids(cls, user_id, *states):
+        """
+        Returns the IDs of the poems a user has in each of the given states, as a dict of lists
+        """
+        ids = {state: [] for state in states}
+        for data in cls.objects(user=user_id, state__in=states).only('poem', 'state').as_pymongo():
+            ids[PoemState(data['state'])].append(data['poem'])
+        return ids
+
+    @staticmethod
+    def get_state_update(user_id, poem_id, state):
+        """
+        Returns the bulk write request that moves a poem to a state (see 'PoemState')
+        The state only ever increases ('$max'), so a poem is in one state at a time: playing a saved poem moves it
+        to in-progress, and a completed poem stays completed even if a later submission is wrong. (The old lists on
+        the user also added such a poem back to in-progress.) Only 'ResetProgress' moves a poem back, by clearing its state.
+        """
+        return UpdateOne(
+            {'user': user_id, 'poem': poem_id},
+            {'$max': {'state': int(state)}, '$set': {'updated_at': datetime.utcnow()}},
+            upsert=True,
+        )
+
+    @classmethod
+    def get_progress_update(cls, user_id, poem_id, complete):
+        """
+        Returns the bulk write request that records progress on a poem, moving it to completed or in-progress
+        """
+        return cls.get_state_update(user_id, poem_id, PoemState.COMPLETED if complete else PoemState.IN_PROGRESS)
+
+    @staticmethod
+    def get_location_update(user_id, poem_id, location):
+        """
+        Returns the filter and update that record the location last used to access a poem
+        """
+        return {'user': user_id, 'poem': poem_id}, {'$set': {'location': location, 'updated_at': datetime.utcnow()}}
+
+LEGACY_USER_FIELDS = ('saved', 'in_progress', 'completed', 'locations')
+"""
+Fields users used to store their play state in, before it was moved to 'UserPoem'
+"""
+
+def migrate_user_poems(batch_size=500):
+    """
+    Moves the play state stored in users (see 'LEGACY_USER_FIELDS') to 'UserPoem', yielding the number of users in each batch
+    The old fields are removed from each batch of users once its entries are written, so an interrupted migration
+    can be run again. States are merged using '$max', and locations recorded since the app was upgraded are kept.
+    """
+    users = User._get_collection()
+    query = {'$or': [{field: {'$exists': True}} for field in LEGACY_USER_FIELDS]}
+    projection = {field: 1 for field in LEGACY_USER_FIELDS}
+    while True:
+        batch = list(users.find(query, projection).limit(batch_size))
+        if not batch:
+            return
+        requests = []
+        now = datetime.utcnow()
+        for data in batch:
+            # Combine each poem's state and location into a single upsert
+            states = {}
+            for field, state in (('saved', PoemState.SAVED), ('in_progress', PoemState.IN_PROGRESS), ('completed', PoemState.COMPLETED)):
+                for poem_id in data.get(field) or []:
+                    states[poem_id] = max(states.get(poem_id, state), state)
+            locations = {}
+            for poem_id, location in (data.get('locations') or {}).items():
+                if ObjectId.is_valid(poem_id):
+                    locations[ObjectId(poem_id)] = location
+            for poem_id in states.keys() | locations.keys():
+                update = {'$setOnInsert': {'updated_at': now}}
+                if poem_id in states:
+                    update['$max'] = {'state': int(states[poem_id])}
+                if poem_id in locations:
+                    update['$setOnInsert']['location'] = locations[poem_id]
+                requests.append(UpdateOne({'user': data['_id'], 'poem': poem_id}, update, upsert=True))
+        if requests:
+            UserPoem._get_collection().bulk_write(requests, ordered=False)
+        users.update_many(
+            {'_id': {'$in': [data['_id'] for data in batch]}},
+            {'$unset': {field: '' for field in LEGACY_USER_FIELDS}},
+        )
+        yield len(batch)
+
 class Page(Document):
     """
     A static page visible to all users
@@ -171,6 +332,7 @@ class Page(Document):
     """
     meta = {
         'collection': 'page',
+        'queryset_class': TimeLimitedQuerySet,
         'indexes': [
             'path',
             {
@@ -201,7 +363,12 @@ class TokenBlocklist(Document):
     """
     meta = {
         'collection': 'token_blocklist',
-        'indexes': [{'fields': ['expires'], 'expireAfterSeconds': 0}]
+        'queryset_class': TimeLimitedQuerySet,
+        'indexes': [{'fields': ['expires'], 'expireAfterSeconds': 0}, 'revoked']
     }
     jti = StringField(primary_key=True)
     expires = DateTimeField(required=True)
+    revoked = DateTimeField(default=datetime.utcnow)
+    """
+    When the token was invalidated. Workers use this to fetch only the blocks created since they last synced.
+    """
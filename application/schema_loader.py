@@ -1,5 +1,10 @@
+from .roles import Role
+from .utilities.query_cost import QueryBudget
+
 role_to_schema = {}
 public_schema = None
+role_to_budget = {}
+public_budget = None
 
 def use_public(schema):
     global public_schema
@@ -8,10 +13,28 @@ def use_public(schema):
 def use_for_role(role, schema):
     role_to_schema[role] = schema
 
+def use_budgets(budgets):
+    """
+    Sets the query budgets of each role from a dict of (cost, depth) tuples, keyed by role name or 'public'
+    Roles without a budget use the public budget.
+    """
+    global public_budget
+    public_budget = QueryBudget(*budgets['public']) if budgets.get('public') else None
+    role_to_budget.clear()
+    for role in Role:
+        if budgets.get(role.name):
+            role_to_budget[role] = QueryBudget(*budgets[role.name])
+
 def load(user):
     schema = public_schema
     if user:
         schema = role_to_schema.get(user.role, public_schema)
     return schema
 
-__all__ = ['use_public', 'use_for_role', 'load']
\ No newline at end of file
+def load_budget(user):
+    budget = public_budget
+    if user:
+        budget = role_to_budget.get(user.role, public_budget)
+    return budget
+
+__all__ = ['use_public', 'use_for_role', 'use_budgets', 'load', 'load_budget']
\ No newline at end of file
@@ -1,9 +1,8 @@
 from graphene import (Schema, ObjectType)
-from graphene_mongo import MongoengineConnectionField
 from .public_schema import Poem, Page
 from .editor_schema import Query as EditorQuery, Mutation as EditorMutation
 from .user_schema import User
-from ..utilities import MongoengineUpdateMutation, MongoengineDeleteMutation, MongoengineCreateMutation
+from ..utilities import KeysetConnectionField, MongoengineUpdateMutation, MongoengineDeleteMutation, MongoengineCreateMutation
 from ..roles import Role
 from .. import schema_loader
 
@@ -13,8 +12,8 @@ Query Objects
 
 class Query(EditorQuery, ObjectType):
     # Administrators can view all users
-    users = MongoengineConnectionField(User)
-    pages = MongoengineConnectionField(Page)
+    users = KeysetConnectionField(User)
+    pages = KeysetConnectionField(Page)
 
 """
 Mutations
@@ -1,8 +1,11 @@
 from graphene_mongo import MongoengineObjectType
 from graphene import (Node, GlobalID, ObjectType, Mutation, Schema, Field, InputObjectType, Int, String, List, Enum, Boolean)
-from graphene_mongo import MongoengineConnectionField
 import mongoengine
 from mongoengine.errors import DoesNotExist
+from bson.objectid import ObjectId
+from flask import current_app, request
+from functools import partial
+from promise import Promise
 
 from ..models import (
     Category as CategoryModel,
@@ -11,12 +14,15 @@ from ..models import (
     Poem as PoemModel,
     User as UserModel,
     Progress as ProgressModel,
+    UserPoem as UserPoemModel,
+    PoemState,
     ProgressLine as ProgressLineModel,
     Page as PageModel,
 )
 from .. import schema_loader
-from ..extensions import bcrypt
-from ..utilities import CountableConnection, find_conflicts, decode_location, encode_location
+from ..extensions import user_cache, password_hasher, login_email_limiter, login_ip_limiter, poem_pool, progress_buffer, collection_cache, line_key_cache
+from ..utilities import CountableConnection, ProjectedConnectionField, KeysetConnectionField, Size, get_computed, DocumentLoader, signals, find_conflicts, decode_location, encode_location, run_async, run_blocking, resolve_future, get_max_time_ms
+from ..exceptions import ServerBusyError
 
 """
 Types/Queries
@@ -39,6 +45,39 @@ class Progress(MongoengineObjectType):
     class Meta:
         model = ProgressModel
 
+class ProgressLoader(DocumentLoader):
+    """
+    Loads the current user's progress for many poems at once, keyed by poem ID
+    """
+    model = ProgressModel
+    field = 'poem'
+
+    def get_queryset(self):
+        return ProgressModel.objects(user=self.context.user)
+
+    def batch_load_fn(self, keys):
+        # Make sure any buffered progress of the user is written first
+        # Flushing writes to the database, so on the event loop it runs in a worker thread
+        if getattr(self.context, 'async_mongo', None):
+            return run_async(self.flush_and_load_async(keys))
+        progress_buffer.flush_user(self.context.user.id)
+        return super().batch_load_fn(keys)
+
+    async def flush_and_load_async(self, keys):
+        await run_blocking(progress_buffer.flush_user, self.context.user.id)
+        queryset = self.get_queryset()(**{f'{self.field}__in': keys})
+        return await self.batch_load_async(self.context.async_mongo, queryset, keys)
+
+class UserPoemLoader(DocumentLoader):
+    """
+    Loads the current user's state and location of many poems at once, keyed by poem ID
+    """
+    model = UserPoemModel
+    field = 'poem'
+
+    def get_queryset(self):
+        return UserPoemModel.objects(user=self.context.user)
+
 class PoemLine(MongoengineObjectType):
     """
     Semantically, inheriting Node means an object is "globally identifiable" with its ID.
@@ -74,20 +113,33 @@ class Poem(MongoengineObjectType):
     location = String()
     num_lines = Int() # Expose number of lines for convenience
 
+    # Model fields used by fields that aren't model fields, so connections can project only what is selected
+    # Progress and location only need the poem ID
+    projections = {
+        'num_lines': Size('lines'),
+        'progress': (),
+        'location': (),
+    }
+    # Lines are embedded, so they are loaded along with the poem (see 'CostAnalysis')
+    costs = {'lines': 0}
+
     def resolve_num_lines(parent, info):
-        return len(parent.lines)
+        # Lists of poems usually only count lines, so the count is projected when lines aren't selected
+        return get_computed(parent, 'num_lines', lambda: len(parent.lines))
     
     # Only attach progress if a user is present
     def resolve_progress(parent, info):
         # Look up progress using poem and user
+        # Lookups are batched so that a page of poems only costs one query
         if info.context.has_perm('poem.progress.read'):
-            return ProgressModel.objects(user=info.context.user, poem=parent).first()
+            return info.context.get_loader(ProgressLoader).load(parent.id)
 
     # The location last used to access a poem
     # Only resolve if user is present
+    # Lookups are batched like progress
     def resolve_location(parent, info):
         if info.context.has_perm('poem.location.read'):
-            return info.context.user.locations.get(str(parent.id))
+            return info.context.get_loader(UserPoemLoader).load(parent.id).then(lambda user_poem: user_poem and user_poem.location)
 
 class Collection(MongoengineObjectType):
     class Meta:
@@ -105,9 +157,10 @@ class Page(MongoengineObjectType):
 
 class Query(ObjectType):
     node = Node.Field()
-    collections = MongoengineConnectionField(Collection)
-    poems = MongoengineConnectionField(Poem)
-    categories = MongoengineConnectionField(Category)
+    collections = ProjectedConnectionField(Collection)
+    # Poems and categories are paged through deeply, so they use keyset pagination
+    poems = KeysetConnectionField(Poem)
+    categories = KeysetConnectionField(Category)
     public_pages = List(Page)
     page = Field(Page, path=String(required=True))
 
@@ -123,15 +176,30 @@ Mutations
 """
 
 class RandomPoem(Mutation):
+    """
+    Chooses a random poem, optionally from a category
+    Users can also choose to skip poems they have already completed.
+    """
+
+    class Arguments:
+        category = String()
+        exclude_completed = Boolean()
     poem = Field(Poem)
     
-    def mutate(parent, info):
-        # Retrieve one random poem using the Mongo pipeline
-        pipeline = [{ '$sample': { 'size': 1 } }]
-        poem_data = PoemModel.objects().aggregate(pipeline).next()
-        # Convert raw data to a Poem object to automatically dereference things
-        poem_obj = PoemModel._from_son(poem_data)
-        return RandomPoem(poem=poem_obj)
+    def mutate(parent, info, category=None, exclude_completed=False):
+        # Looking up completed poems, reloading the pool and loading the poem all block, so on the event loop they run in a worker thread
+        if getattr(info.context, 'async_mongo', None):
+            return run_async(run_blocking(RandomPoem.choose, info, category, exclude_completed))
+        return RandomPoem.choose(info, category, exclude_completed)
+
+    @staticmethod
+    def choose(info, category, exclude_completed):
+        # Choose from the in-memory pool of poem IDs rather than sampling the collection
+        exclude = None
+        if exclude_completed and info.context.user:
+            exclude = set(UserPoemModel.get_poem_ids(info.context.user.id, PoemState.COMPLETED)[PoemState.COMPLETED])
+        poem = poem_pool.fetch(category=category, exclude=exclude)
+        return RandomPoem(poem=poem)
 
 class LocationType(Enum):
     DIRECT = 0
@@ -143,6 +211,45 @@ class PlayPoemError(Enum):
     INVALID_INDEX = 2
     CORRUPT_LOCATION = 3
 
+def parse_global_id(global_id, type):
+    """
+    Returns the ObjectId of a global ID of the given type, or None if the global ID isn't one
+    """
+    try:
+        _type, id = Node.from_global_id(global_id)
+    except Exception:
+        return None
+    if _type != type._meta.name or not ObjectId.is_valid(id):
+        return None
+    return ObjectId(id)
+
+# The sync and async versions of these lookups only differ by how the document is loaded
+
+def get_collection_poems(global_id):
+    """
+    Returns the IDs of the poems in a collection, or None if the collection doesn't exist
+    Only the list of poem IDs is loaded (nothing is dereferenced), and the list is cached
+    so that navigating through a collection doesn't load the collection again.
+    """
+    id = parse_global_id(global_id, Collection)
+    if id is None:
+        return None
+    def load():
+        return collection_poems_from_son(CollectionModel.objects(pk=id).only('poems').as_pymongo().first())
+    return collection_cache.get_or_load(id, load)
+
+async def get_collection_poems_async(async_mongo, global_id):
+    id = parse_global_id(global_id, Collection)
+    if id is None:
+        return None
+    async def load():
+        return collection_poems_from_son(await async_mongo.collection(CollectionModel).find_one({'_id': id}, {'poems': 1}, max_time_ms=get_max_time_ms()))
+    return await collection_cache.get_or_load_async(id, load)
+
+def collection_poems_from_son(data):
+    if data is not None:
+        return tuple(data.get('poems', []))
+
 class PlayPoem(Mutation):
     """
     There are several ways to locate a poem.
@@ -166,49 +273,138 @@ class PlayPoem(Mutation):
     error = Field(PlayPoemError)
 
     def mutate(parent, info, location):
+        async_mongo = getattr(info.context, 'async_mongo', None)
+        if async_mongo:
+            return run_async(PlayPoem.mutate_async(info, location, async_mongo))
         # Resolve location
-        # Locations are B64-encoded JSON. A 'type' field specifies whether the location is
-        # "direct" or references a collection.
+        decoded = PlayPoem.decode(location)
+        if decoded is None:
+            return PlayPoem(ok=False, error=PlayPoemError.CORRUPT_LOCATION)
+        # Only look up the poem IDs of the collection, then load the one poem we need
+        poem_ids = get_collection_poems(decoded['c']) if decoded['t'] == LocationType.COLLECTION else None
+        poem_id, result = PlayPoem.locate(decoded, poem_ids)
+        if result.error is not None:
+            return result
+        poem = PoemModel.objects(pk=poem_id).first() if poem_id else None
+        if poem is None:
+            return PlayPoem(ok=False, error=PlayPoemError.POEM_NOT_FOUND)
+        # If user is logged in, update 'last played location'
+        if info.context.has_perm('poem.location.update'):
+            UserPoemModel._get_collection().update_one(*UserPoemModel.get_location_update(info.context.user.id, poem.id, location), upsert=True)
+        return PlayPoem.finish(result, poem)
+
+    @staticmethod
+    async def mutate_async(info, location, async_mongo):
+        # Same as 'mutate', using the async driver
+        decoded = PlayPoem.decode(location)
+        if decoded is None:
+            return PlayPoem(ok=False, error=PlayPoemError.CORRUPT_LOCATION)
+        poem_ids = await get_collection_poems_async(async_mongo, decoded['c']) if decoded['t'] == LocationType.COLLECTION else None
+        poem_id, result = PlayPoem.locate(decoded, poem_ids)
+        if result.error is not None:
+            return result
+        data = await async_mongo.collection(PoemModel).find_one({'_id': poem_id}, max_time_ms=get_max_time_ms()) if poem_id else None
+        if data is None:
+            return PlayPoem(ok=False, error=PlayPoemError.POEM_NOT_FOUND)
+        poem = PoemModel._from_son(data)
+        if info.context.has_perm('poem.location.update'):
+            await async_mongo.collection(UserPoemModel).update_one(*UserPoemModel.get_location_update(info.context.user.id, poem.id, location), upsert=True)
+        return PlayPoem.finish(result, poem)
+
+    @staticmethod
+    def decode(location):
+        """
+        Decodes a location, returning None if it is corrupt
+        Locations are B64-encoded JSON. A 'type' field specifies whether the location is
+        "direct" or references a collection.
+        """
         try:
             decoded = decode_location(location)
         except:
-            return PlayPoem(ok=False, error=PlayPoemError.CORRUPT_LOCATION)
-        next = None
-        previous = None
+            return None
+        if not isinstance(decoded, dict) or decoded.get('t') not in (LocationType.DIRECT, LocationType.COLLECTION):
+            return None
+        return decoded
+
+    @staticmethod
+    def locate(decoded, poem_ids):
+        """
+        Returns the ID of the poem at a decoded location (or None) and the result to finish once the poem is loaded
+        The result has an error if the location is invalid. 'poem_ids' are the poems of the collection, for collection locations.
+        """
         if decoded['t'] == LocationType.DIRECT:
-            try:
-                poem=Node.get_node_from_global_id(info, decoded['p'])
-            except DoesNotExist:
-                return PlayPoem(ok=False, error=PlayPoemError.POEM_NOT_FOUND)
-        elif decoded['t'] == LocationType.COLLECTION:
-            try:
-                collection = Node.get_node_from_global_id(info, decoded['c'])
-            except DoesNotExist:
-                return PlayPoem(ok=False, error=PlayPoemError.COLLECTION_NOT_FOUND)
-            index = decoded['i']
-            if index < 0 or index >= len(collection.poems): return PlayPoem(ok=False, error=PlayPoemError.INVALID_INDEX)
-            poem = collection.poems[index]
-            # Define next and previous locations, if applicable
-            if decoded['i'] > 0:
-                previous = decoded.copy()
-                previous['i'] -= 1
-                previous = encode_location(previous)
-            if decoded['i'] < (collection.poems.length - 1):
-                next = decoded.copy()
-                next['i'] += 1
-                next = encode_location(next)
-        # If user is logged in, update 'last played location'
-        if info.context.has_perm('poem.location.update'):
-            update_clause = {'$set': {f'locations.{str(poem.id)}': location}}
-            info.context.user.modify(__raw__=update_clause)
+            return parse_global_id(decoded['p'], Poem), PlayPoem()
+        error = PlayPoem.check_index(decoded, poem_ids)
+        if error is not None:
+            return None, PlayPoem(ok=False, error=error)
+        previous, next = PlayPoem.get_neighbors(decoded, len(poem_ids))
+        return poem_ids[decoded['i']], PlayPoem(next=next, previous=previous)
+
+    @staticmethod
+    def finish(result, poem):
         # Package result
-        return PlayPoem(ok=True, poem=poem, next=next, previous=previous)
+        result.ok = True
+        result.poem = poem
+        return result
+
+    @staticmethod
+    def check_index(decoded, poem_ids):
+        """
+        Returns the error of a collection location, if any
+        """
+        if poem_ids is None:
+            return PlayPoemError.COLLECTION_NOT_FOUND
+        index = decoded['i']
+        if index < 0 or index >= len(poem_ids):
+            return PlayPoemError.INVALID_INDEX
+
+    @staticmethod
+    def get_neighbors(decoded, num_poems):
+        """
+        Returns the previous and next locations of a collection location, if applicable
+        """
+        previous = None
+        next = None
+        if decoded['i'] > 0:
+            previous = decoded.copy()
+            previous['i'] -= 1
+            previous = encode_location(previous)
+        if decoded['i'] < (num_poems - 1):
+            next = decoded.copy()
+            next['i'] += 1
+            next = encode_location(next)
+        return previous, next
 
 class SubmitLineInput(InputObjectType):
     poemID = GlobalID()
     lineID = String()
     answer = List(String)
 
+def get_line_keys(poem_id):
+    """
+    Returns a dict mapping the line IDs of a poem to their keys, or None if the poem doesn't exist
+    Only the line IDs and keys are loaded, and they are cached until the poem is updated or deleted
+    (by this worker), or for at most 'LINE_KEY_CACHE_TTL' seconds.
+    """
+    if not ObjectId.is_valid(poem_id):
+        return None
+    poem_id = ObjectId(poem_id)
+    def load():
+        return line_keys_from_son(PoemModel.objects(pk=poem_id).only('lines.id', 'lines.key').as_pymongo().first())
+    return line_key_cache.get_or_load(poem_id, load)
+
+async def get_line_keys_async(async_mongo, poem_id):
+    if not ObjectId.is_valid(poem_id):
+        return None
+    poem_id = ObjectId(poem_id)
+    async def load():
+        return line_keys_from_son(await async_mongo.collection(PoemModel).find_one({'_id': poem_id}, {'lines._id': 1, 'lines.key': 1}, max_time_ms=get_max_time_ms()))
+    return await line_key_cache.get_or_load_async(poem_id, load)
+
+def line_keys_from_son(data):
+    if data is not None:
+        return {str(line['_id']): tuple(line.get('key', [])) for line in data.get('lines', [])}
+
 class SubmitLine(Mutation):
     class Arguments:
         input = SubmitLineInput(required=True)
@@ -217,33 +413,44 @@ class SubmitLine(Mutation):
     correct = Boolean()
 
     def mutate(parent, info, input):
-        # Lookup poem and line
-        poem = Node.get_node_from_global_id(info, input.poemID)
-        line = poem.lines.get(id=input.lineID)
+        async_mongo = getattr(info.context, 'async_mongo', None)
+        if async_mongo:
+            return run_async(SubmitLine.mutate_async(info, input, async_mongo))
+        # Lookup line keys of poem
+        # The poem itself is never loaded, only the (cached) keys of its lines
+        _type, poem_id = Node.from_global_id(input.poemID)
+        return SubmitLine.submit(info, input, poem_id, get_line_keys(poem_id))
+
+    @staticmethod
+    async def mutate_async(info, input, async_mongo):
+        _type, poem_id = Node.from_global_id(input.poemID)
+        line_keys = await get_line_keys_async(async_mongo, poem_id)
+        # Unless progress is buffered, submitting writes progress right away, so do it in a worker thread
+        if progress_buffer.write_behind:
+            return SubmitLine.submit(info, input, poem_id, line_keys)
+        return await run_blocking(SubmitLine.submit, info, input, poem_id, line_keys)
+
+    @staticmethod
+    def submit(info, input, poem_id, line_keys):
+        if line_keys is None:
+            raise PoemModel.DoesNotExist(f'Poem \'{input.poemID}\' does not exist')
+        poem = ObjectId(poem_id)
+        key = line_keys.get(input.lineID)
+        if key is None:
+            raise DoesNotExist(f'Line \'{input.lineID}\' does not exist')
         # Determine if correct
         conflicts = None
-        if len(line.key) == len(input.answer):
-            conflicts = find_conflicts(line.key, input.answer)
+        if len(key) == len(input.answer):
+            conflicts = find_conflicts(key, input.answer)
             correct = (len(conflicts) == 0)
         else:
             correct = False
         # Update progress if applicable
+        # The progress buffer upserts progress and updates in-progress/completed poems
         if info.context.has_perm('poem.progress.update'):
             user = info.context.user
-            progress_query = ProgressModel.objects(user=user, poem=poem)
-            # Construct update clause and upsert progress (insert or update)
-            update_clause = {'$set': {f'lines.{input.lineID}': {'answer': input.answer, 'correct': correct}}}
-            if (correct): update_clause['$inc'] = {'num_correct': 1}
-            progress = progress_query.upsert_one(__raw__=update_clause)
-            # Determine if poem is complete
-            # If poem is complete, remove in_progress and add complete
-            # If not, add in_progress
-            complete = (progress.num_correct == len(poem.lines))
-            if complete:
-                user.modify(pull__in_progress=poem, add_to_set__completed=poem)
-            else:
-                user.modify(add_to_set__in_progress=poem)
-            
+            progress_buffer.submit(user.id, poem, input.lineID, input.answer, correct, len(line_keys))
+
         # Construct response
         return SubmitLine(conflicts=conflicts, correct=correct)
 
@@ -251,34 +458,76 @@ class LoginInput(InputObjectType):
     email = String()
     password = String()
 
+class LoginError(Enum):
+    TOO_MANY_ATTEMPTS = 0
+    BUSY = 1
+
+def get_attempt_key(email):
+    return (email or '').strip().lower()
+
+def get_client_address():
+    """
+    Returns the IP address of the client making the current request
+    Behind 'TRUSTED_PROXIES' proxies, the connection comes from a proxy, so the address is read from 'X-Forwarded-For'.
+    Each proxy appends the address it received the request from, so only the entry added by the outermost trusted proxy
+    is used (like Werkzeug's 'ProxyFix'). Entries before it come from the client and can be spoofed.
+    """
+    proxies = current_app.config['TRUSTED_PROXIES']
+    if proxies:
+        forwarded = [address.strip() for address in request.headers.get('X-Forwarded-For', '').split(',')]
+        forwarded = [address for address in forwarded if address]
+        if len(forwarded) >= proxies:
+            return forwarded[-proxies]
+    return request.remote_addr
+
+def save_rehashed_password(user_id, hashed, rehashed):
+    # Only update the user if their password hasn't changed in the meantime
+    UserModel.objects(pk=user_id, password_hashed=hashed).update(set__password_hashed=rehashed)
+    user_cache.invalidate(user_id)
+
 class Login(Mutation):
     class Arguments:
         input = LoginInput(required=True)
     
     result = String()
     ok = Boolean()
+    error = Field(LoginError)
 
     def mutate(parent, info, input):
+        # Throttle clients before hashing anything, so guessing can't occupy the password hasher
+        if not (login_ip_limiter.attempt(get_client_address()) and login_email_limiter.attempt(get_attempt_key(input.email))):
+            return Login(ok=False, error=LoginError.TOO_MANY_ATTEMPTS)
         # Attempt to find user and check if hashed passwords match
+        user = UserModel.objects(email=input.email).first()
+        if user is None:
+            return Login(ok=False)
         try:
-            user = UserModel.objects(email=input.email).get()
-            if bcrypt.check_password_hash(user.password_hashed, input.password):
-                # Update context with new user and request a refresh token
-                # to be attached to the response
-                info.context.user = user
-                info.context.attach_refresh_token = True
-                token = info.context.create_access_token()
-                return Login(ok=True, result=token)
-            else:
-                return Login(ok=False)
-        except UserModel.DoesNotExist:
+            check = password_hasher.check(user.password_hashed, input.password)
+        except ServerBusyError:
+            return Login(ok=False, error=LoginError.BUSY)
+        return Promise.resolve(resolve_future(check)).then(partial(Login.finish, info, input, user))
+
+    def finish(info, input, user, matches):
+        if not matches:
             return Login(ok=False)
+        login_email_limiter.reset(get_attempt_key(input.email))
+        # Transparently update hashes made with a different cost
+        if password_hasher.needs_rehash(user.password_hashed):
+            password_hasher.rehash(input.password, partial(save_rehashed_password, user.id, user.password_hashed))
+        # Update context with new user and request a refresh token
+        # to be attached to the response
+        info.context.user = user
+        info.context.attach_refresh_token = True
+        token = info.context.create_access_token()
+        return Login(ok=True, result=token)
 
 class RegisterInput(LoginInput):
     pass
 
 class RegisterError(Enum):
     USER_EXISTS = 0
+    TOO_MANY_ATTEMPTS = 1
+    BUSY = 2
 
 class Register(Mutation):
     class Arguments:
@@ -289,12 +538,21 @@ class Register(Mutation):
     error = Field(RegisterError)
 
     def mutate(parent, info, input):
+        if not login_ip_limiter.attempt(get_client_address()):
+            return Register(ok=False, error=RegisterError.TOO_MANY_ATTEMPTS)
+        try:
+            hashing = password_hasher.hash(input.password)
+        except ServerBusyError:
+            return Register(ok=False, error=RegisterError.BUSY)
+        return Promise.resolve(resolve_future(hashing)).then(partial(Register.finish, info, input))
+
+    def finish(info, input, password_hashed):
         # Create new user with email and attempt to save
         user = UserModel(email=input.email)
-        password_hashed = bcrypt.generate_password_hash(input.password).decode('utf-8')
         user.password_hashed = password_hashed
         try:
             user.save()
+            signals.post_create.send(UserModel, document=user)
             # Update context with new user and request a refresh token
             # to be attached to the response
             info.context.user = user
@@ -1,11 +1,13 @@
 from graphene_mongo import MongoengineObjectType
-from graphene import (Node, GlobalID, Schema, Mutation, ObjectType, InputObjectType, Boolean, Field, Enum)
+from graphene import (Node, GlobalID, Schema, Mutation, ObjectType, InputObjectType, Boolean, Field, Enum, List, Int, JSONString)
 from datetime import datetime
+from functools import partial
 
-from .public_schema import Query as PublicQuery, Mutation as PublicMutation
-from ..utilities import CountableConnection
-from ..models import Progress as ProgressModel, User as UserModel, TokenBlocklist as TokenBlocklistModel
+from .public_schema import Query as PublicQuery, Mutation as PublicMutation, Poem
+from ..utilities import CountableConnection, KeysetConnectionField, DocumentLoader, DocumentPageLoader, DocumentCountLoader, get_selected_fields, project, run_async, run_blocking
+from ..models import Progress as ProgressModel, User as UserModel, Poem as PoemModel, UserPoem as UserPoemModel, PoemState, TokenBlocklist as TokenBlocklistModel
 from ..roles import Role as RoleModel
+from ..extensions import blocklist_cache, progress_buffer, poem_recommender
 from .. import schema_loader
 
 """
@@ -14,6 +16,120 @@ Queries/Object Types
 
 Role = Enum.from_enum(RoleModel)
 
+# Arguments that only page through a connection
+PAGING_ARGUMENTS = ('first', 'after', 'keyset')
+# Locations returned by default, and at most
+DEFAULT_LOCATIONS = 100
+MAX_LOCATIONS = 500
+
+class PoemStatePageLoader(DocumentPageLoader):
+    """
+    Loads the IDs of a page of the poems users have in a state, keyed by user ID
+    Pages are read from the (user, state, poem) index, in poem ID order.
+    """
+    model = UserPoemModel
+    field = 'user'
+    fields = ('poem',)
+    order = ('poem',)
+
+    def __init__(self, context, state, after, limit):
+        super().__init__(context, limit)
+        self.state = state
+        self.after = after
+
+    def get_queryset(self):
+        queryset = UserPoemModel.objects(state=self.state)
+        if self.after is not None:
+            queryset = queryset(poem__gt=self.after)
+        return queryset
+
+class PoemStateCountLoader(DocumentCountLoader):
+    """
+    Counts the poems users have in a state, keyed by user ID
+    """
+    model = UserPoemModel
+    field = 'user'
+
+    def __init__(self, context, state):
+        super().__init__(context)
+        self.state = state
+
+    def get_queryset(self):
+        return UserPoemModel.objects(state=self.state)
+
+class PoemsLoader(DocumentLoader):
+    """
+    Loads poems by ID, projected onto the fields selected by a connection (see 'project')
+    """
+    model = PoemModel
+    field = 'id'
+
+    def __init__(self, context, fields):
+        super().__init__(context)
+        self.fields = fields
+
+    def get_queryset(self):
+        return project(PoemModel.objects, Poem, self.fields)
+
+    def get_key(self, document):
+        return document.pk
+
+class LocationLoader(DocumentPageLoader):
+    """
+    Loads the locations users most recently used to access poems, keyed by user ID
+    """
+    model = UserPoemModel
+    field = 'user'
+    fields = ('poem', 'location')
+    order = ('-updated_at',)
+
+    def get_queryset(self):
+        return UserPoemModel.objects(location__exists=True)
+
+class PoemStateConnectionField(KeysetConnectionField):
+    """
+    A connection of the poems a user has in a state (like the poems they have completed), see 'UserPoem'
+    These connections use keyset pagination by default. The page of poem IDs is read from the (user, state, poem) index
+    and only those poems are loaded, so heavy players cost the same as anyone else. Pages, poems and counts are loaded
+    through request-scoped loaders keyed by user, so a page of users costs the same few queries as a single user.
+    Otherwise (with 'keyset: false', offset cursors, filtering or paging backward), the IDs of all of the user's poems
+    in the state are loaded and the poems are filtered as usual.
+    """
+
+    def __init__(self, type, state, *args, **kwargs):
+        kwargs.setdefault(self.keyset_argument, Boolean(default_value=True))
+        super().__init__(type, *args, **kwargs)
+        self.state = state
+
+    def get_resolver(self, parent_resolver):
+        # The poems aren't stored in the user, so there is nothing for the parent resolver to resolve
+        return partial(self.connection_resolver, self.resolve_poems, self.type)
+
+    def resolve_poems(self, _root, info, **args):
+        if any(value is not None for name, value in args.items() if name not in PAGING_ARGUMENTS):
+            args[self.keyset_argument] = False
+        after_key, keyset = self.use_keyset(args)
+        if not keyset:
+            ids = UserPoemModel.get_poem_ids(_root.id, self.state)[self.state]
+            return self.default_resolver(None, info, pk__in=ids, keyset=False, **args)
+        first = args.get('first')
+        # Fetch one extra ID to know whether there is a next page
+        limit = first + 1 if first is not None else None
+        after = after_key[0] if after_key is not None else None
+        fields = frozenset(get_selected_fields(info, ('edges', 'node')))
+        def load_poems(entries):
+            ids = [data['poem'] for data in entries]
+            return info.context.get_loader(PoemsLoader, fields).load_many(ids).then(lambda poems: (ids, poems))
+        def create_connection(loaded):
+            ids, poems = loaded
+            keyed = [([id], poem) for id, poem in zip(ids, poems) if poem is not None]
+            connection = self.create_connection(None, keyed, after_key, first)
+            # The total count is the number of entries in the state
+            connection.get_total_count = lambda: info.context.get_loader(PoemStateCountLoader, self.state).load(_root.id)
+            return connection
+        page = info.context.get_loader(PoemStatePageLoader, self.state, after, limit).load(_root.id)
+        return page.then(load_poems).then(create_connection)
+
 class User(MongoengineObjectType):
     class Meta:
         model = UserModel
@@ -23,13 +139,68 @@ class User(MongoengineObjectType):
         connection_class = CountableConnection
         searchable = True
     role = Field(Role)
+    saved = PoemStateConnectionField(Poem, state=PoemState.SAVED)
+    in_progress = PoemStateConnectionField(Poem, state=PoemState.IN_PROGRESS)
+    completed = PoemStateConnectionField(Poem, state=PoemState.COMPLETED)
+    # Maps poem IDs to the locations last used to access them, for the 'first' most recently used poems
+    locations = JSONString(first=Int(default_value=DEFAULT_LOCATIONS))
+
+    # Play state is looked up by user ID, so lists of users don't need to load anything for it
+    projections = {
+        'saved': (),
+        'in_progress': (),
+        'completed': (),
+        'locations': (),
+    }
+    # Locations are looked up like a connection
+    costs = {'locations': 1}
+
+    def resolve_locations(parent, info, first):
+        limit = min(max(first, 0), MAX_LOCATIONS)
+        if not limit:
+            return {}
+        loader = info.context.get_loader(LocationLoader, limit)
+        return loader.load(parent.id).then(lambda entries: {str(data['poem']): data['location'] for data in entries})
 
 class Query(PublicQuery, ObjectType):
     # Reference to the current user
     # This allows the current user to query their own saved poems/etc, but not others
     me = Field(User)
     def resolve_me(parent, info):
-        return info.context.user
+        # Loading the user and flushing block, so on the event loop they run in a worker thread
+        if getattr(info.context, 'async_mongo', None):
+            return run_async(run_blocking(Query.get_me, info))
+        return Query.get_me(info)
+
+    @staticmethod
+    def get_me(info):
+        # Make sure buffered progress is reflected in the user's in-progress and completed poems
+        user = info.context.get_full_user()
+        if user:
+            progress_buffer.flush_user(user.id)
+        return user
+
+    # Poems similar to the ones the current user has completed or is working on
+    recommended_poems = List(Poem, first=Int(default_value=10))
+    def resolve_recommended_poems(parent, info, first):
+        if getattr(info.context, 'async_mongo', None):
+            return run_async(run_blocking(Query.recommend, info, first))
+        return Query.recommend(info, first)
+
+    @staticmethod
+    def recommend(info, first):
+        user = info.context.user
+        progress_buffer.flush_user(user.id)
+        poem_ids = UserPoemModel.get_poem_ids(user.id, PoemState.COMPLETED, PoemState.IN_PROGRESS)
+        ids = poem_recommender.recommend(
+            poem_ids[PoemState.COMPLETED],
+            poem_ids[PoemState.IN_PROGRESS],
+            min(first, 100),
+        )
+        # Load the recommended poems at once, keeping the order of recommendation
+        poems = project(PoemModel.objects(pk__in=ids), Poem, get_selected_fields(info))
+        lookup = {poem.id: poem for poem in poems}
+        return [lookup[id] for id in ids if id in lookup]
 
 """
 Mutations
@@ -43,13 +214,23 @@ class ResetProgress(Mutation):
         input = ResetProgressInput(required=True)
     ok = Boolean()
     def mutate(parent, info, input):
+        # Resetting deletes progress (and waits for flushes), so on the event loop it runs in a worker thread
+        if getattr(info.context, 'async_mongo', None):
+            return run_async(run_blocking(ResetProgress.reset, info, input))
+        return ResetProgress.reset(info, input)
+
+    @staticmethod
+    def reset(info, input):
         # Lookup poem and user
         poem = Node.get_node_from_global_id(info, input.poemID)
         user = info.context.user
         # Delete the progress associated with the poem and the current user
-        ProgressModel.objects(user=user, poem=poem).delete()
-        # Remove the poem from the user's in-progress and completed poems
-        user.modify(pull__in_progress=poem, pull__completed=poem)
+        # Remove the poem from the user's in-progress and completed poems (keeping its location)
+        def reset():
+            ProgressModel.objects(user=user, poem=poem).delete()
+            UserPoemModel.objects(user=user, poem=poem).update(unset__state=True)
+        # Buffered progress is dropped (and flushes already writing it are waited for) so that it isn't written afterwards
+        progress_buffer.reset(user.id, poem.id, reset)
         return ResetProgress(ok=True)
 
 class Logout(Mutation):
@@ -61,8 +242,9 @@ class Logout(Mutation):
         # We use the jti of the token to uniquely identify it
         # We also attach the expiration time so we can purge the document
         jwt = info.context.get_jwt()
-        block = TokenBlocklistModel(jti=jwt['jti'], expires=datetime.fromtimestamp(jwt['exp']))
+        block = TokenBlocklistModel(jti=jwt['jti'], expires=datetime.utcfromtimestamp(jwt['exp']))
         block.save()
+        blocklist_cache.add(block.jti, block.expires)
         return Logout(ok=True)
 
 class Mutation(PublicMutation, ObjectType):
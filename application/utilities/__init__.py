@@ -1,7 +1,23 @@
 import json
 import base64
-from .types import CountableConnection, MongoengineCreateMutation, MongoengineUpdateMutation, MongoengineDeleteMutation
+from .types import count_cache, CountableConnection, MongoengineCreateMutation, MongoengineUpdateMutation, MongoengineDeleteMutation
 from .document_path import DocumentPath
+from .loaders import DocumentLoader, DocumentPageLoader, DocumentCountLoader, get_reference_id, get_reference_ids
+from .pool import IdPool, PoemPool
+from .category_matrix import CategoryMatrix, PoemRecommender
+from .cache import Cache
+from .blocklist import TokenBlocklistCache
+from .connection import MongoConnection, TimeLimitedQuerySet, get_max_time_ms, with_max_time
+from .async_mongo import AsyncMongo, run_async, run_blocking, resolve_future
+from .backend import CachedDocumentBackend, hash_query
+from .query_cost import QueryBudget, QueryCostError
+from .response_cache import ResponseCache
+from .limiter import AttemptLimiter
+from .hasher import PasswordHasher
+from .progress import ProgressBuffer
+from .metrics import Metrics
+from .projection import ProjectedConnectionField, Size, get_computed, get_selected_fields, project
+from .keyset import KeysetConnectionField
 
 def find_conflicts(key, answer):
     """
@@ -21,11 +37,46 @@ def decode_location(location):
     return json.loads(base64.b64decode(location))
 
 def encode_location(location):
-    return base64.b64encode(json.dumps(location))
+    return base64.b64encode(json.dumps(location).encode('utf-8')).decode('ascii')
 
 __all__ = [
     'DocumentPath',
+    'DocumentLoader',
+    'DocumentPageLoader',
+    'DocumentCountLoader',
+    'get_reference_id',
+    'get_reference_ids',
+    'IdPool',
+    'PoemPool',
+    'CategoryMatrix',
+    'PoemRecommender',
+    'Cache',
+    'TokenBlocklistCache',
+    'MongoConnection',
+    'TimeLimitedQuerySet',
+    'get_max_time_ms',
+    'with_max_time',
+    'AsyncMongo',
+    'run_async',
+    'run_blocking',
+    'resolve_future',
+    'CachedDocumentBackend',
+    'hash_query',
+    'QueryBudget',
+    'QueryCostError',
+    'ResponseCache',
+    'AttemptLimiter',
+    'PasswordHasher',
+    'ProgressBuffer',
+    'Metrics',
     'CountableConnection',
+    'ProjectedConnectionField',
+    'KeysetConnectionField',
+    'Size',
+    'get_computed',
+    'get_selected_fields',
+    'project',
+    'count_cache',
     'MongoengineCreateMutation',
     'MongoengineUpdateMutation',
     'MongoengineDeleteMutation',
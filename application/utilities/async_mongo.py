@@ -0,0 +1,76 @@
+import asyncio
+import logging
+from contextvars import copy_context
+from functools import partial
+from weakref import WeakKeyDictionary
+from promise import Promise
+from .connection import get_client_options
+
+# Motor is in the requirements. Without it, the ASGI mode still works, but every resolver uses Mongoengine.
+try:
+    from motor.motor_asyncio import AsyncIOMotorClient
+except ImportError:
+    AsyncIOMotorClient = None
+
+class AsyncMongo:
+    """
+    Provides Motor (async Mongo driver) collections to resolvers when serving in ASGI mode
+    Motor clients are bound to an event loop, so a client is created lazily for each loop.
+    Resolvers check 'info.context.async_mongo', which is only set for requests served by the ASGI app,
+    and fall back to Mongoengine otherwise. Documents are still built using Mongoengine ('_from_son').
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.uri = None
+        self.db_name = None
+        self.client_options = {}
+        self._clients = WeakKeyDictionary()
+
+    def init_app(self, app):
+        self.enabled = app.config.get('ENABLE_ASYNC_MONGO', True)
+        if self.enabled and AsyncIOMotorClient is None:
+            logging.getLogger(__name__).warning('Motor is not installed, so resolvers use Mongoengine in ASGI mode')
+            self.enabled = False
+        self.uri = app.config['MONGO_URI']
+        self.db_name = app.config['MONGO_DB']
+        # Use the same pool size and timeouts as the Mongoengine connection
+        self.client_options = get_client_options(app.config)
+        self._clients = WeakKeyDictionary()
+
+    def get_client(self):
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            client = AsyncIOMotorClient(self.uri, io_loop=loop, **self.client_options)
+            self._clients[loop] = client
+        return client
+
+    def collection(self, model):
+        return self.get_client()[self.db_name][model._get_collection_name()]
+
+def run_async(coroutine):
+    """
+    Schedules a coroutine, returning a promise of its result
+    Resolvers return promises rather than coroutines so that Graphene can chain them (for connections, for instance).
+    """
+    return Promise.resolve(asyncio.ensure_future(coroutine))
+
+def resolve_future(future):
+    """
+    Returns the result of a concurrent future (like one from a thread pool), or a promise of it on an event loop
+    Outside of the event loop (when serving over WSGI, or in a worker thread), this waits for the future.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return future.result()
+    return Promise.resolve(asyncio.wrap_future(future))
+
+async def run_blocking(func, *args, **kwargs):
+    """
+    Runs a blocking function in a worker thread so it doesn't block the event loop
+    The function runs in a copy of the current context, so the Flask request context is still available.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, partial(copy_context().run, func, *args, **kwargs))
@@ -0,0 +1,64 @@
+from functools import partial
+from hashlib import sha256
+from graphql import parse, validate, execute
+from graphql.backend.base import GraphQLBackend, GraphQLDocument
+from graphql.execution import ExecutionResult
+from promise import Promise
+from .query_cost import CostAnalysis, execute_within_budget
+
+def hash_query(query):
+    """
+    Returns the SHA-256 hash of a query string, as a hex string
+    This is the same hash clients use to identify persisted queries.
+    """
+    return sha256(query.encode('utf-8')).hexdigest()
+
+class CachedDocumentBackend(GraphQLBackend):
+    """
+    A GraphQL backend that caches parsed and validated documents
+    Clients send the same few operations over and over, so parsing and validating each one
+    every time is wasted work. Documents are cached by schema and query hash, since the same
+    query might be valid for one role's schema but not another's.
+    Invalid documents are cached as well, along with their validation errors.
+    If 'get_budget' is specified, operations are checked against the budget it returns for the request context
+    before they are executed (see 'CostAnalysis').
+    Request contexts with a 'has_errors' attribute have it set when an operation's result has errors.
+    """
+
+    def __init__(self, cache, get_budget=None, default_list_size=100):
+        self.cache = cache
+        self.get_budget = get_budget
+        self.default_list_size = default_list_size
+
+    def document_from_string(self, schema, document_string):
+        key = (schema, hash_query(document_string))
+        document = self.cache.get(key)
+        if document is None:
+            # Syntax errors are raised here and not cached
+            document_ast = parse(document_string)
+            errors = validate(schema, document_ast)
+            if errors:
+                run = partial(invalid_result, errors)
+            else:
+                run = partial(execute, schema, document_ast)
+                if self.get_budget:
+                    analysis = CostAnalysis(schema, document_ast, self.default_list_size)
+                    run = partial(execute_within_budget, run, analysis, self.get_budget)
+            run = partial(execute_and_record_errors, run)
+            document = GraphQLDocument(schema=schema, document_string=document_string, document_ast=document_ast, execute=run)
+            self.cache.set(key, document)
+        return document
+
+def invalid_result(errors, *args, **kwargs):
+    return ExecutionResult(errors=errors, invalid=True)
+
+def execute_and_record_errors(execute, *args, **kwargs):
+    context = kwargs.get('context', kwargs.get('context_value'))
+    def record(result):
+        if result.errors and hasattr(context, 'has_errors'):
+            context.has_errors = True
+        return result
+    result = execute(*args, **kwargs)
+    if Promise.is_thenable(result):
+        return result.then(record)
+    return record(result)
@@ -0,0 +1,63 @@
+from datetime import datetime, timedelta
+from threading import Lock
+import time
+
+class TokenBlocklistCache:
+    """
+    A local copy of the token blocklist
+    Almost no tokens are revoked, so querying the blocklist on every request is mostly wasted.
+    Instead, each worker keeps the IDs of all unexpired blocks in memory and checks tokens against them.
+    The copy is synced with the database every 'BLOCKLIST_SYNC_INTERVAL' seconds, fetching only
+    blocks created since the last sync. This bounds how long a token revoked by another worker
+    can still be used here. Blocks revoked by this worker are added immediately.
+    Expired blocks are dropped locally, just like the TTL index drops them from the database.
+    'model' is the blocklist document, with 'jti', 'expires' and 'revoked' fields. Times are naive UTC datetimes.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.interval = 10
+        self._revoked = {}
+        self._synced = None
+        self._next_sync = 0
+        # Only one thread syncs at a time, and syncing doesn't block adding blocks
+        self._lock = Lock()
+        self._revoked_lock = Lock()
+
+    def init_app(self, app):
+        self.interval = app.config.get('BLOCKLIST_SYNC_INTERVAL', self.interval)
+        with self._revoked_lock:
+            self._revoked = {}
+        self._synced = None
+
+    def add(self, jti, expires):
+        with self._revoked_lock:
+            self._revoked[jti] = expires
+
+    def sync(self):
+        # Fetch all unexpired blocks the first time, and only new blocks afterwards
+        # Blocks are fetched with some overlap to account for clock differences between workers
+        started = datetime.utcnow()
+        if self._synced is None:
+            blocks = self.model.objects(expires__gt=started)
+        else:
+            blocks = self.model.objects(revoked__gte=self._synced - timedelta(seconds=self.interval))
+        fetched = {block.jti: block.expires for block in blocks.only('jti', 'expires')}
+        # Merge into the current copy, which might have had blocks added since the sync started, and drop expired blocks
+        now = datetime.utcnow()
+        with self._revoked_lock:
+            revoked = dict(self._revoked, **fetched)
+            self._revoked = {jti: expires for jti, expires in revoked.items() if expires > now}
+        self._synced = started
+        self._next_sync = time.monotonic() + self.interval
+
+    def is_revoked(self, jti):
+        # Only one thread syncs at a time. The others keep using the current copy.
+        if self._synced is None or time.monotonic() >= self._next_sync:
+            if self._lock.acquire(blocking=(self._synced is None)):
+                try:
+                    if self._synced is None or time.monotonic() >= self._next_sync:
+                        self.sync()
+                finally:
+                    self._lock.release()
+        return jti in self._revoked
@@ -0,0 +1,91 @@
+from collections import OrderedDict
+from threading import RLock
+import time
+
+class Cache:
+    """
+    A bounded, thread-safe LRU cache whose entries can optionally expire
+    Caches are set up like Flask extensions: they are created at import time and configured
+    by 'init_app', which reads the '<PREFIX>_SIZE' and '<PREFIX>_TTL' config values.
+    A TTL of None means entries never expire and are only evicted when the cache is full.
+    Caches are local to each worker process, so anything cached should either be invalidated
+    explicitly or have a TTL short enough to bound how stale other workers can be.
+    """
+
+    def __init__(self, prefix, size=1024, ttl=None):
+        self.prefix = prefix
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = RLock()
+
+    def init_app(self, app):
+        self.size = app.config.get(f'{self.prefix}_SIZE', self.size)
+        self.ttl = app.config.get(f'{self.prefix}_TTL', self.ttl)
+        self.clear()
+
+    def get(self, key, default=None):
+        """
+        Returns the value cached for a key, or the default if missing or expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires = entry
+            if expires is not None and expires < time.monotonic():
+                del self._entries[key]
+                self.misses += 1
+                return default
+            # Mark as most recently used
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if self.size <= 0:
+            return
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            # Evict least recently used entries
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def get_or_load(self, key, load):
+        """
+        Returns the value cached for a key, calling 'load' to compute it on a miss
+        None is never cached, so missing values are looked up again next time.
+        """
+        value = self.get(key)
+        if value is None:
+            value = load()
+            if value is not None:
+                self.set(key, value)
+        return value
+
+    async def get_or_load_async(self, key, load):
+        """
+        Same as 'get_or_load', where 'load' is a coroutine function
+        """
+        value = self.get(key)
+        if value is None:
+            value = await load()
+            if value is not None:
+                self.set(key, value)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
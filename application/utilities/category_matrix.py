@@ -0,0 +1,202 @@
+from array import array
+from collections import Counter
+from threading import Lock
+import heapq
+import logging
+import math
+import time
+
+# NumPy is in the requirements, but scoring falls back to Python without it, which is fine for small catalogs
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+_warned_without_numpy = False
+
+def warn_without_numpy():
+    global _warned_without_numpy
+    if not _warned_without_numpy:
+        _warned_without_numpy = True
+        logging.getLogger(__name__).warning('NumPy is not installed, so recommendations are scored in Python')
+
+class CategoryMatrix:
+    """
+    A sparse item x category matrix used to score items by their similarity to an interest vector
+    Each column (category) stores the set of rows (items) in it, which makes the matrix cheap to update one item at a time.
+    Rows of removed items are reused. Scoring multiplies the matrix with an interest vector over categories,
+    dividing by the norm of each row to get the cosine similarity (the norm of the interest vector doesn't affect ranking).
+    With NumPy, each column is converted to an index array (cached until the column changes), and scores are
+    accumulated column by column into a dense vector.
+    Not thread-safe.
+    """
+
+    def __init__(self):
+        self._rows = {}
+        self._keys = []
+        self._free = []
+        self._row_columns = []
+        self._norms = array('f')
+        self._columns = {}
+        self._column_arrays = {}
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def set(self, key, categories):
+        """
+        Adds an item, or replaces the categories of an existing item
+        """
+        row = self._rows.get(key)
+        if row is None:
+            if self._free:
+                row = self._free.pop()
+                self._keys[row] = key
+            else:
+                row = len(self._keys)
+                self._keys.append(key)
+                self._row_columns.append(frozenset())
+                self._norms.append(0)
+            self._rows[key] = row
+        categories = frozenset(categories)
+        old = self._row_columns[row]
+        for category in old.difference(categories):
+            self._columns[category].discard(row)
+            self._column_arrays.pop(category, None)
+        for category in categories.difference(old):
+            self._columns.setdefault(category, set()).add(row)
+            self._column_arrays.pop(category, None)
+        self._row_columns[row] = categories
+        self._norms[row] = math.sqrt(len(categories))
+
+    def remove(self, key):
+        row = self._rows.pop(key, None)
+        if row is None:
+            return
+        for category in self._row_columns[row]:
+            self._columns[category].discard(row)
+            self._column_arrays.pop(category, None)
+        self._row_columns[row] = frozenset()
+        self._norms[row] = 0
+        self._keys[row] = None
+        self._free.append(row)
+
+    def get_categories(self, key):
+        row = self._rows.get(key)
+        return self._row_columns[row] if row is not None else frozenset()
+
+    def get_interest(self, weighted_keys):
+        """
+        Builds an interest vector (a Counter of categories) from (key, weight) pairs
+        """
+        interest = Counter()
+        for key, weight in weighted_keys:
+            for category in self.get_categories(key):
+                interest[category] += weight
+        return interest
+
+    def top(self, interest, count, exclude=()):
+        """
+        Returns the keys of the (at most) 'count' items most similar to an interest vector, best first
+        Items in 'exclude' and items with no category in common with the interest vector are never returned.
+        """
+        interest = {category: weight for category, weight in interest.items() if self._columns.get(category)}
+        if not interest or count <= 0:
+            return []
+        excluded_rows = [self._rows[key] for key in exclude if key in self._rows]
+        if np is not None:
+            return self._top_numpy(interest, count, excluded_rows)
+        warn_without_numpy()
+        scores = Counter()
+        for category, weight in interest.items():
+            for row in self._columns[category]:
+                scores[row] += weight
+        for row in excluded_rows:
+            scores.pop(row, None)
+        best = heapq.nlargest(count, scores.items(), key=lambda item: (item[1] / self._norms[item[0]], -item[0]))
+        return [self._keys[row] for row, score in best if score > 0]
+
+    def _top_numpy(self, interest, count, excluded_rows):
+        scores = np.zeros(len(self._keys), dtype=np.float32)
+        for category, weight in interest.items():
+            scores[self._get_column_array(category)] += weight
+        # Copying the norms is a single memcpy, and leaves the array free to grow
+        norms = np.array(self._norms, dtype=np.float32)
+        np.divide(scores, norms, out=scores, where=norms > 0)
+        if excluded_rows:
+            scores[excluded_rows] = 0
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > count:
+            # Only sort the best candidates
+            candidates = candidates[np.argpartition(-scores[candidates], count - 1)[:count]]
+        # Sort by score, breaking ties by row so results are stable
+        candidates = candidates[np.lexsort((candidates, -scores[candidates]))]
+        return [self._keys[row] for row in candidates.tolist()]
+
+    def _get_column_array(self, category):
+        column_array = self._column_arrays.get(category)
+        if column_array is None:
+            column_array = np.fromiter(self._columns[category], dtype=np.intp, count=len(self._columns[category]))
+            self._column_arrays[category] = column_array
+        return column_array
+
+class PoemRecommender:
+    """
+    Recommends poems based on the categories of the poems a user has completed or is working on
+    The categories of every poem are kept in memory as a poem x category matrix (see 'CategoryMatrix'),
+    so a recommendation doesn't query the database at all, apart from loading the recommended poems.
+    Like the poem pool, the matrix is kept current by the poem mutation signals and reloaded
+    every 'RECOMMENDER_REFRESH_INTERVAL' seconds.
+    'model' is the poem document, which must have a 'categories' list field.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.refresh_interval = 300
+        self.completed_weight = 1
+        self.in_progress_weight = 0.5
+        self._matrix = CategoryMatrix()
+        self._next_refresh = None
+        self._lock = Lock()
+
+    def init_app(self, app):
+        self.refresh_interval = app.config.get('RECOMMENDER_REFRESH_INTERVAL', self.refresh_interval)
+        self.completed_weight = app.config.get('RECOMMENDER_COMPLETED_WEIGHT', self.completed_weight)
+        self.in_progress_weight = app.config.get('RECOMMENDER_IN_PROGRESS_WEIGHT', self.in_progress_weight)
+        self._next_refresh = None
+
+    def load(self):
+        matrix = CategoryMatrix()
+        for data in self.model.objects.only('categories').as_pymongo():
+            matrix.set(data['_id'], data.get('categories', []))
+        self._matrix = matrix
+        self._next_refresh = time.monotonic() + self.refresh_interval
+
+    def _ensure_loaded(self):
+        if self._next_refresh is None or time.monotonic() >= self._next_refresh:
+            with self._lock:
+                if self._next_refresh is None or time.monotonic() >= self._next_refresh:
+                    self.load()
+
+    def add(self, poem):
+        with self._lock:
+            self._matrix.set(poem.id, poem.categories)
+
+    def remove(self, poem):
+        with self._lock:
+            self._matrix.remove(poem.id)
+
+    def recommend(self, completed, in_progress, count):
+        """
+        Returns the IDs of the poems most similar to the completed and in-progress poems, best first
+        Completed and in-progress poems are never recommended.
+        """
+        self._ensure_loaded()
+        history = [(id, self.completed_weight) for id in completed]
+        history += [(id, self.in_progress_weight) for id in in_progress]
+        with self._lock:
+            interest = self._matrix.get_interest(history)
+            return self._matrix.top(interest, count, exclude=set(completed).union(in_progress))
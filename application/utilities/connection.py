@@ -0,0 +1,88 @@
+import os
+from mongoengine import QuerySet, connect, disconnect
+from mongoengine.connection import DEFAULT_CONNECTION_NAME
+
+# The default server-side time limit of queries, in milliseconds (see 'MongoConnection')
+_max_time_ms = None
+
+def get_max_time_ms():
+    return _max_time_ms
+
+def with_max_time(**options):
+    """
+    Adds the default time limit to the options of a raw collection operation (like 'aggregate' or 'count_documents')
+    'find' and 'find_one' take the limit as 'max_time_ms' instead (see 'get_max_time_ms').
+    """
+    if _max_time_ms is not None:
+        options.setdefault('maxTimeMS', _max_time_ms)
+    return options
+
+def get_client_options(config):
+    """
+    Returns the MongoClient options (pool size and timeouts) specified by a config
+    Options set to None are left at the driver's defaults.
+    """
+    options = {
+        'maxPoolSize': config.get('MONGO_MAX_POOL_SIZE'),
+        'minPoolSize': config.get('MONGO_MIN_POOL_SIZE'),
+        'maxIdleTimeMS': config.get('MONGO_MAX_IDLE_TIME_MS'),
+        'waitQueueTimeoutMS': config.get('MONGO_WAIT_QUEUE_TIMEOUT_MS'),
+        'connectTimeoutMS': config.get('MONGO_CONNECT_TIMEOUT_MS'),
+        'socketTimeoutMS': config.get('MONGO_SOCKET_TIMEOUT_MS'),
+        'serverSelectionTimeoutMS': config.get('MONGO_SERVER_SELECTION_TIMEOUT_MS'),
+    }
+    return {name: value for name, value in options.items() if value is not None}
+
+class TimeLimitedQuerySet(QuerySet):
+    """
+    A queryset that applies the default server-side time limit to its queries
+    Use 'max_time_ms' to override the limit of a single query.
+    """
+
+    def __init__(self, document, collection):
+        super().__init__(document, collection)
+        self._max_time_ms = _max_time_ms
+
+class MongoConnection:
+    """
+    Manages the Mongoengine connection of each process
+    Preforking servers create the app in a parent process and fork workers from it. MongoClients aren't fork-safe
+    (their pools and monitoring threads don't survive the fork), so the connection is only registered when the app
+    is created, and the client connects on its first operation. If the parent did use the client, each child drops
+    its inherited copy after forking and registers the connection again, so a new client (with the same settings)
+    is created when it is next used.
+    """
+
+    def __init__(self, alias=DEFAULT_CONNECTION_NAME):
+        self.alias = alias
+        self.client_options = {}
+        self._settings = None
+        self._registered_fork_handler = False
+
+    def init_app(self, app):
+        global _max_time_ms
+        _max_time_ms = app.config.get('MONGO_MAX_TIME_MS')
+        self.client_options = get_client_options(app.config)
+        self._settings = dict(
+            db=app.config['MONGO_DB'],
+            host=app.config['MONGO_URI'],
+            alias=self.alias,
+            connect=False,
+            **self.client_options
+        )
+        disconnect(self.alias)
+        connect(**self._settings)
+        if not self._registered_fork_handler and hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self.reset)
+            self._registered_fork_handler = True
+
+    def reset(self):
+        """
+        Replaces the current client with one that connects when the connection is next used
+        Disconnecting also detaches the collections documents cache, which belong to the old client.
+        Clients connect lazily, so unless the parent process used its client, there is nothing to close.
+        """
+        if self._settings is None:
+            return
+        disconnect(self.alias)
+        connect(**self._settings)
@@ -1,3 +1,7 @@
+from collections import namedtuple
+from functools import lru_cache
+from mongoengine.base.datastructures import EmbeddedDocumentList
+from mongoengine.errors import DoesNotExist
 from pypeg2 import *
 
 class StringLiteral(str):
@@ -30,6 +34,72 @@ class Level:
 class Path(List):
     grammar = optional(Level, maybe_some('.', Level))
 
+# A compiled level is shared between every path with the same string, so it is immutable
+# 'step' is a closure that takes the receiver of the previous level (and the index cache) and returns the next receiver
+CompiledLevel = namedtuple('CompiledLevel', ['field', 'selector', 'step'])
+
+def lookup_id(receiver, value, indexes):
+    """
+    Finds the element of an embedded document list with a certain ID
+    Instead of scanning the list, we look the ID up in an index of the list, which is built once and
+    shared by every path evaluated with the same index cache.
+    Indices are positions, so the index is rebuilt whenever it turns out to be stale, like after an element
+    is created or deleted.
+    """
+    if not isinstance(receiver, EmbeddedDocumentList):
+        return receiver.get(id=value)
+    key = id(receiver)
+    entry = indexes.get(key)
+    fresh = False
+    while True:
+        if entry is None or entry[0] is not receiver:
+            # Lists are indexed by identity, but the entry keeps a reference to the list so its ID isn't reused
+            entry = (receiver, {str(element.id): i for i, element in enumerate(receiver)})
+            indexes[key] = entry
+            fresh = True
+        i = entry[1].get(value)
+        if i is not None and i < len(receiver) and str(receiver[i].id) == value:
+            return receiver[i]
+        if fresh:
+            break
+        entry = None
+    # Same error as EmbeddedDocumentList.get
+    raise DoesNotExist(f'{receiver._name} matching query does not exist.')
+
+def compile_level(field, selector):
+    """
+    Creates the accessor closure for one level
+    """
+    if selector is None:
+        def step(receiver, indexes):
+            return receiver[field]
+    elif isinstance(selector, IndexSelector):
+        index = selector.index
+        def step(receiver, indexes):
+            return receiver[field][index]
+    elif len(selector) == 1 and selector[0].key == 'id':
+        value = str(selector[0].value)
+        def step(receiver, indexes):
+            return lookup_id(receiver[field], value, indexes)
+    else:
+        kwargs = {cond.key: cond.value for cond in selector}
+        def step(receiver, indexes):
+            return receiver[field].get(**kwargs)
+    return CompiledLevel(field, selector, step)
+
+@lru_cache(maxsize=4096)
+def compile_path(string, fix_field=None):
+    """
+    Parses and compiles a path string, returning a tuple of compiled levels
+    Results are memoized, since clients send the same few paths over and over.
+    'fix_field' can be used to transform field names, e.x. from camel case to snake case.
+    """
+    levels = []
+    for level in parse(string, Path):
+        field = fix_field(level.field) if fix_field else level.field
+        levels.append(compile_level(field, level.selector))
+    return tuple(levels)
+
 class DocumentPath:
     """
     A "DocumentPath" is a mini-language for querying specific fields on Mongoengine documents.
@@ -40,17 +110,23 @@ class DocumentPath:
     to select an embedded document with a certain field.
     E.x. 'lines[id=61cfdd8dc3f63c7f1a2873b0].text'
     A more complicated example: 'revision.lines[id=61cfdd8dc3f63c7f1a2873b0].key[2]'
+
+    Paths are compiled once into accessor closures and cached (see 'compile_path').
     """
 
-    def __init__(self, string):
-        self.levels = parse(string, Path)    
+    def __init__(self, string, fix_field=None):
+        self.string = string
+        self.levels = compile_path(string, fix_field)
 
-    def evaluate(self, document):
+    def evaluate(self, document, indexes=None):
+        """
+        Evaluates the path on a document
+        'indexes' is a dict used to cache indices of embedded document lists. Pass the same dict when evaluating
+        many paths on the same document, so filtering a list by ID doesn't have to scan it each time.
+        """
+        if indexes is None:
+            indexes = {}
         result = document
         for level in self.levels:
-            # Look up field
-            result = result[level.field]
-            # If selector is specified, apply selector
-            if (level.selector):
-                result = level.selector.apply(result)
-        return result
\ No newline at end of file
+            result = level.step(result, indexes)
+        return result
@@ -0,0 +1,83 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, BoundedSemaphore
+from ..exceptions import ServerBusyError
+
+class PasswordHasher:
+    """
+    Hashes and checks passwords in a small, bounded thread pool
+    bcrypt is deliberately slow, so a burst of logins hashed inline would occupy every request thread.
+    Instead, at most 'workers' passwords are hashed at once (bcrypt releases the GIL, so other threads keep running),
+    and at most 'queue_size' more can wait. Beyond that, 'check' and 'hash' raise 'ServerBusyError' right away.
+    Hashes are made with Flask-Bcrypt's 'BCRYPT_LOG_ROUNDS'. Hashes with a different cost are rehashed when users log in.
+
+    Only the ASGI mode frees up the request while a password is hashed (see 'resolve_future'). Over WSGI, the request
+    thread still waits for its hash, so the pool only bounds how many hashes run at once and rejects bursts early.
+    """
+
+    def __init__(self, bcrypt):
+        self.bcrypt = bcrypt
+        self.workers = 2
+        self.queue_size = 32
+        self.rounds = 12
+        self._executor = None
+        self._slots = BoundedSemaphore(self.workers + self.queue_size)
+        self._lock = Lock()
+
+    def init_app(self, app):
+        self.workers = app.config.get('PASSWORD_HASH_WORKERS', self.workers)
+        self.queue_size = app.config.get('PASSWORD_HASH_QUEUE_SIZE', self.queue_size)
+        self.rounds = app.config.get('BCRYPT_LOG_ROUNDS', self.rounds)
+        self._slots = BoundedSemaphore(self.workers + self.queue_size)
+        self._executor = None
+
+    def _submit(self, func, *args):
+        if not self._slots.acquire(blocking=False):
+            raise ServerBusyError('Too many passwords are being hashed')
+        try:
+            # Started lazily, so that workers forked from the app get their own threads
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='password-hasher')
+            future = self._executor.submit(func, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda future: self._slots.release())
+        return future
+
+    def check(self, hashed, password):
+        """
+        Checks a password against a hash, returning a future of whether they match
+        """
+        return self._submit(self.bcrypt.check_password_hash, hashed, password)
+
+    def hash(self, password):
+        """
+        Hashes a password, returning a future of the hash
+        """
+        return self._submit(self._hash, password)
+
+    def _hash(self, password):
+        return self.bcrypt.generate_password_hash(password, self.rounds).decode('utf-8')
+
+    def needs_rehash(self, hashed):
+        # bcrypt hashes look like '$2b$<cost>$<salt and hash>'
+        try:
+            return int(hashed.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return False
+
+    def rehash(self, password, save):
+        """
+        Rehashes a password with the current cost in the background, unless the pool is busy
+        'save' is called with the new hash once it is made.
+        """
+        try:
+            future = self.hash(password)
+        except ServerBusyError:
+            # Try again on the next login
+            return
+        def done(future):
+            if future.exception() is None:
+                save(future.result())
+        future.add_done_callback(done)
@@ -0,0 +1,166 @@
+import base64
+from bson import json_util
+from graphene import Boolean, PageInfo
+from graphql_relay.node.node import from_global_id
+from .projection import ProjectedConnectionField, from_son
+from .async_mongo import run_async
+from .connection import with_max_time
+
+PREFIX = 'keyset:'
+
+def encode_cursor(key):
+    return base64.b64encode((PREFIX + json_util.dumps(key)).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    """
+    Returns the key encoded in a keyset cursor, or None if the cursor isn't a keyset cursor
+    """
+    try:
+        string = base64.b64decode(cursor).decode('utf-8')
+    except ValueError:
+        return None
+    if not string.startswith(PREFIX):
+        return None
+    return json_util.loads(string[len(PREFIX):])
+
+class KeysetConnectionField(ProjectedConnectionField):
+    """
+    A connection field that can page through documents using keyset ("seek") pagination
+    The default connection field uses offset cursors, which are applied using 'skip', so Mongo has to walk
+    every document before the page. Instead, keyset cursors encode the key of the last document of the page,
+    and the next page is fetched with a range query on that key, which can use an index no matter how deep the page is.
+    Documents are ordered by ID, or by text score and then ID when searching.
+
+    Keyset pagination is opt-in: clients pass 'keyset: true' (and keep passing it, or a keyset cursor, for later pages).
+    Otherwise the field behaves exactly like the default connection field, with offset cursors and the default order,
+    so existing clients keep working. Backward pagination and offset cursors also fall back to the default behavior.
+    The connection iterable is the unpaginated queryset, so 'CountableConnection' counts still work.
+    In ASGI mode, pages are fetched using the async driver.
+    """
+
+    search_argument = 'search'
+    keyset_argument = 'keyset'
+
+    def __init__(self, type, *args, **kwargs):
+        kwargs.setdefault(self.keyset_argument, Boolean(default_value=False))
+        super().__init__(type, *args, **kwargs)
+
+    def use_keyset(self, args):
+        """
+        Pops the keyset argument, returning the decoded 'after' key and whether to use keyset pagination
+        """
+        keyset = args.pop(self.keyset_argument, False)
+        after = args.get('after')
+        after_key = decode_cursor(after) if after else None
+        if args.get('last') is not None or args.get('before') is not None or (after and after_key is None):
+            return after_key, False
+        return after_key, bool(keyset or after_key is not None)
+
+    def default_resolver(self, _root, info, **args):
+        after_key, keyset = self.use_keyset(args)
+        if not keyset:
+            return super().default_resolver(_root, info, **args)
+
+        first = args.pop('first', None)
+        for arg in ('after', 'last', 'before'):
+            args.pop(arg, None)
+        if _root is not None:
+            args['pk__in'] = [r.pk for r in getattr(_root, info.field_name, [])]
+        _id = args.pop('id', None)
+        if _id is not None:
+            args['pk'] = from_global_id(_id)[-1]
+        search = args.pop(self.search_argument, None)
+
+        queryset = self.get_queryset(self.model, info, **args)
+        if search:
+            queryset = queryset.search_text(search)
+        async_mongo = getattr(info.context, 'async_mongo', None)
+        if async_mongo:
+            return run_async(self.resolve_page_async(async_mongo, queryset, search, after_key, first))
+        if search:
+            keyed = self.get_search_page(queryset, after_key, first)
+        else:
+            keyed = self.get_page(queryset, after_key, first)
+        return self.create_connection(queryset, keyed, after_key, first)
+
+    async def resolve_page_async(self, async_mongo, queryset, search, after_key, first):
+        model = queryset._document
+        collection = async_mongo.collection(model)
+        if search:
+            sons = await collection.aggregate(self.get_search_pipeline(queryset, after_key, first), **with_max_time()).to_list(None)
+            keyed = self.get_search_keyed(queryset, sons)
+        else:
+            page = self.get_page_queryset(queryset, after_key, first)
+            cursor = collection.find(page._query, **page._cursor_args).sort(page._ordering)
+            if page._limit is not None:
+                cursor = cursor.limit(page._limit)
+            if page._max_time_ms is not None:
+                cursor = cursor.max_time_ms(page._max_time_ms)
+            documents = [from_son(page, son) for son in await cursor.to_list(None)]
+            keyed = [([document.pk], document) for document in documents]
+        return self.create_connection(queryset, keyed, after_key, first)
+
+    def create_connection(self, queryset, keyed, after_key, first):
+        # Fetch one extra document to know whether there is a next page
+        has_next_page = first is not None and len(keyed) > first
+        keyed = keyed[:first] if first is not None else keyed
+        edges = [self.type.Edge(node=document, cursor=encode_cursor(key)) for key, document in keyed]
+        page_info = PageInfo(
+            start_cursor=edges[0].cursor if edges else None,
+            end_cursor=edges[-1].cursor if edges else None,
+            has_previous_page=after_key is not None,
+            has_next_page=has_next_page,
+        )
+        connection = self.type(edges=edges, page_info=page_info)
+        connection.iterable = queryset
+        return connection
+
+    def get_page_queryset(self, queryset, after_key, first):
+        page = queryset.order_by('pk')
+        if after_key is not None:
+            page = page.filter(pk__gt=after_key[0])
+        if first is not None:
+            page = page.limit(first + 1)
+        return page
+
+    def get_page(self, queryset, after_key, first):
+        """
+        Returns (key, document) pairs of the documents after a key, ordered by ID
+        """
+        return [([document.pk], document) for document in self.get_page_queryset(queryset, after_key, first)]
+
+    def get_search_pipeline(self, queryset, after_key, first):
+        pipeline = [
+            {'$match': queryset._query},
+            {'$addFields': {'_score': {'$meta': 'textScore'}}},
+        ]
+        if after_key is not None:
+            score, pk = after_key
+            pipeline.append({'$match': {'$or': [
+                {'_score': {'$lt': score}},
+                {'_score': score, '_id': {'$gt': pk}},
+            ]}})
+        pipeline.append({'$sort': {'_score': -1, '_id': 1}})
+        if first is not None:
+            pipeline.append({'$limit': first + 1})
+        # Only fetch the selected fields (see 'ProjectedConnectionField'), like a find would
+        projection = queryset._cursor_args.get('projection')
+        if projection and all(value != 0 for value in projection.values()):
+            pipeline.append({'$project': dict(projection, _score=1)})
+        return pipeline
+
+    def get_search_keyed(self, queryset, sons):
+        keyed = []
+        for son in sons:
+            score = son.pop('_score')
+            keyed.append(([score, son['_id']], from_son(queryset, son)))
+        return keyed
+
+    def get_search_page(self, queryset, after_key, first):
+        """
+        Returns (key, document) pairs of the documents after a key, ordered by text score and then ID
+        The text score can't be used in a find filter, so the page is fetched using an aggregation.
+        """
+        model = queryset._document
+        sons = model._get_collection().aggregate(self.get_search_pipeline(queryset, after_key, first), **with_max_time())
+        return self.get_search_keyed(queryset, sons)
@@ -0,0 +1,50 @@
+from collections import OrderedDict
+from threading import Lock
+import time
+
+class AttemptLimiter:
+    """
+    Limits how many attempts each key (like an email or IP address) can make within a window of time
+    Limiters are set up like 'Cache': 'init_app' reads the '<PREFIX>_ATTEMPTS' and '<PREFIX>_WINDOW' (seconds) config values.
+    Windows are fixed, starting at a key's first attempt, so a key can make up to twice the limit around a window boundary.
+    Only the 'size' most recently used keys are tracked, and counts are local to each worker process.
+    """
+
+    def __init__(self, prefix, attempts=10, window=300, size=10000):
+        self.prefix = prefix
+        self.attempts = attempts
+        self.window = window
+        self.size = size
+        self._windows = OrderedDict()
+        self._lock = Lock()
+
+    def init_app(self, app):
+        self.attempts = app.config.get(f'{self.prefix}_ATTEMPTS', self.attempts)
+        self.window = app.config.get(f'{self.prefix}_WINDOW', self.window)
+        with self._lock:
+            self._windows.clear()
+
+    def attempt(self, key):
+        """
+        Counts an attempt, returning False if the key has used up its attempts
+        """
+        if self.attempts is None:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            entry = self._windows.get(key)
+            if entry is None or entry[0] <= now:
+                # Start a new window
+                entry = [now + self.window, 0]
+                self._windows[key] = entry
+            self._windows.move_to_end(key)
+            while len(self._windows) > self.size:
+                self._windows.popitem(last=False)
+            if entry[1] >= self.attempts:
+                return False
+            entry[1] += 1
+            return True
+
+    def reset(self, key):
+        with self._lock:
+            self._windows.pop(key, None)
@@ -0,0 +1,151 @@
+from promise import Promise
+from promise.dataloader import DataLoader
+from .async_mongo import run_async, run_blocking
+from .connection import with_max_time
+
+def get_reference_id(document, field):
+    """
+    Returns the primary key stored in a reference field without dereferencing it
+    Mongoengine dereferences references as soon as they are accessed, which costs a query each.
+    """
+    value = document._data.get(field)
+    return getattr(value, 'id', value)
+
+def get_reference_ids(document, field):
+    """
+    Returns the primary keys stored in a list of references without dereferencing them
+    """
+    return [getattr(value, 'id', value) for value in document._data.get(field) or []]
+
+class DocumentLoader(DataLoader):
+    """
+    Batches per-node document lookups into a single '$in' query
+    Resolvers call 'load' with a key (usually an ID) and receive a promise. Every key requested
+    during one GraphQL execution is collected, and the matching documents are fetched all at once.
+    Loaders are request-scoped: they are created and cached by the request context (see 'Context.get_loader'),
+    so subclasses can use the context to narrow the lookup (to the current user, for instance).
+
+    Subclasses must specify the 'model' and the 'field' used as the key. If the field is a reference
+    field, keys are the primary keys of the referenced documents.
+
+    In ASGI mode, the lookup uses the async driver (the query is still built by Mongoengine).
+    """
+
+    model = None
+    field = None
+
+    def __init__(self, context):
+        super().__init__()
+        self.context = context
+
+    def get_queryset(self):
+        """
+        Returns the queryset used to look up documents
+        Can be overriden to apply additional filters.
+        """
+        return self.model.objects
+
+    def get_key(self, document):
+        return get_reference_id(document, self.field)
+
+    def batch_load_fn(self, keys):
+        # Fetch all documents at once and match them to their keys
+        # Keys without a document resolve to None
+        queryset = self.get_queryset()(**{f'{self.field}__in': keys})
+        async_mongo = getattr(self.context, 'async_mongo', None)
+        if async_mongo:
+            return run_async(self.batch_load_async(async_mongo, queryset, keys))
+        return Promise.resolve(self.match(queryset, keys))
+
+    async def batch_load_async(self, async_mongo, queryset, keys):
+        cursor = async_mongo.collection(self.model).find(queryset._query)
+        if queryset._max_time_ms is not None:
+            cursor = cursor.max_time_ms(queryset._max_time_ms)
+        sons = await cursor.to_list(None)
+        return self.match([self.model._from_son(son) for son in sons], keys)
+
+    def match(self, documents, keys):
+        lookup = {self.get_key(document): document for document in documents}
+        return [lookup.get(key) for key in keys]
+
+class DocumentPageLoader(DataLoader):
+    """
+    Batches lookups of the first documents of many keys (like the first poems of each user in a list of users)
+    Each key loads a list of raw documents (with only 'fields'), ordered by 'order' and limited to 'limit' documents.
+    A single key is looked up with a limited 'find', which can stop early using an index on the key and order.
+    Several keys are looked up with one aggregation that groups documents by key, which reads every matching
+    document of those keys (so it is meant for pages of keys, like a page of users).
+    Loaders are request-scoped like 'DocumentLoader'. The arguments after the context are part of the loader's
+    identity (see 'Context.get_loader'), so subclasses can use them to narrow the lookup.
+
+    Subclasses must specify the 'model', the 'field' used as the key, the 'fields' to load and the 'order'
+    (model field names, prefixed with '-' for descending order).
+    In ASGI mode, the lookup runs in a worker thread.
+    """
+
+    model = None
+    field = None
+    fields = ()
+    order = ()
+
+    def __init__(self, context, limit=None):
+        super().__init__()
+        self.context = context
+        self.limit = limit
+
+    def get_queryset(self):
+        """
+        Returns the queryset used to look up documents
+        Can be overriden to apply additional filters.
+        """
+        return self.model.objects
+
+    def batch_load_fn(self, keys):
+        if getattr(self.context, 'async_mongo', None):
+            return run_async(run_blocking(self.load_pages, keys))
+        return Promise.resolve(self.load_pages(keys))
+
+    def load_pages(self, keys):
+        queryset = self.get_queryset()
+        if len(keys) == 1:
+            page = queryset(**{self.field: keys[0]}).order_by(*self.order).only(*self.fields)
+            if self.limit is not None:
+                page = page.limit(self.limit)
+            return [list(page.as_pymongo())]
+        db_field = self.model._fields[self.field].db_field
+        db_fields = [self.model._fields[name].db_field for name in self.fields]
+        pipeline = [{'$group': {'_id': f'${db_field}', 'documents': {'$push': {name: f'${name}' for name in db_fields}}}}]
+        if self.limit is not None:
+            pipeline.append({'$project': {'documents': {'$slice': ['$documents', self.limit]}}})
+        queryset = queryset(**{f'{self.field}__in': keys}).order_by(self.field, *self.order)
+        groups = {group['_id']: group['documents'] for group in queryset.aggregate(pipeline, **with_max_time())}
+        return [groups.get(key, []) for key in keys]
+
+class DocumentCountLoader(DataLoader):
+    """
+    Batches counts of the documents of many keys (like the poems each user in a list of users has completed)
+    into one aggregation
+    Subclasses specify the 'model' and 'field' like 'DocumentLoader'. Counts aren't cached beyond the request.
+    """
+
+    model = None
+    field = None
+
+    def __init__(self, context):
+        super().__init__()
+        self.context = context
+
+    def get_queryset(self):
+        return self.model.objects
+
+    def batch_load_fn(self, keys):
+        if getattr(self.context, 'async_mongo', None):
+            return run_async(run_blocking(self.load_counts, keys))
+        return Promise.resolve(self.load_counts(keys))
+
+    def load_counts(self, keys):
+        db_field = self.model._fields[self.field].db_field
+        queryset = self.get_queryset()(**{f'{self.field}__in': keys})
+        pipeline = [{'$group': {'_id': f'${db_field}', 'count': {'$sum': 1}}}]
+        counts = {group['_id']: group['count'] for group in queryset.aggregate(pipeline, **with_max_time())}
+        return [counts.get(key, 0) for key in keys]
@@ -0,0 +1,242 @@
+import logging
+import math
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from threading import Lock
+import bson
+from promise import Promise, is_thenable
+from pymongo import monitoring
+
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+BYTE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# The metrics of the request being handled, if any
+# Context variables follow requests into worker threads started with 'run_blocking' and into asyncio tasks.
+current_request = ContextVar('current_request', default=None)
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Histogram:
+    """
+    A Prometheus histogram with a fixed set of label names
+    Not thread-safe, see 'Metrics'.
+    """
+
+    def __init__(self, name, description, labels, buckets):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = tuple(buckets) + (math.inf,)
+        self._series = {}
+
+    def observe(self, labels, value):
+        series = self._series.get(labels)
+        if series is None:
+            # Bucket counts, followed by the sum and count
+            series = [0] * (len(self.buckets) + 2)
+            self._series[labels] = series
+        series[bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        for labels, series in sorted(self._series.items()):
+            label_string = ','.join(f'{name}="{escape_label(value)}"' for name, value in zip(self.labels, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{label_string},le="{format_value(bound)}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{label_string}}} {format_value(series[-2])}')
+            lines.append(f'{self.name}_count{{{label_string}}} {series[-1]}')
+        return lines
+
+class RequestMetrics:
+    """
+    Measurements of a single request
+    Resolver times are keyed by field ('Type.field') and summed over every time the field is resolved.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.operation = None
+        self.resolvers = {}
+        self.mongo_commands = 0
+        self.mongo_seconds = 0
+        self.mongo_bytes = 0
+        self._token = None
+
+    def add_resolver(self, key, seconds):
+        entry = self.resolvers.get(key)
+        if entry is None:
+            self.resolvers[key] = [seconds, 1]
+        else:
+            entry[0] += seconds
+            entry[1] += 1
+
+    def get_slowest_resolvers(self, count):
+        return sorted(self.resolvers.items(), key=lambda item: item[1][0], reverse=True)[:count]
+
+class TimingMiddleware:
+    """
+    Graphene middleware that records the wall time spent resolving each field
+    If a resolver returns a promise (like a DataLoader lookup), the time until the promise resolves is recorded,
+    which includes waiting for the batch.
+    """
+
+    def resolve(self, next, root, info, **args):
+        request = current_request.get()
+        if request is None:
+            return next(root, info, **args)
+        if request.operation is None:
+            operation = info.operation.name
+            request.operation = operation.value if operation else ''
+        key = f'{info.parent_type.name}.{info.field_name}'
+        started = time.perf_counter()
+        result = next(root, info, **args)
+        if is_thenable(result):
+            def record(value):
+                request.add_resolver(key, time.perf_counter() - started)
+                return value
+            return Promise.resolve(result).then(record)
+        request.add_resolver(key, time.perf_counter() - started)
+        return result
+
+class CommandMetrics(monitoring.CommandListener):
+    """
+    Attributes Mongo commands to the current request
+    Commands made outside of requests (like flushing buffered progress) aren't recorded.
+    Commands made by Motor run in the driver's own threads, so they can't be attributed either.
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def started(self, event):
+        request = current_request.get()
+        if request is not None:
+            request.mongo_commands += 1
+            if self.metrics.count_bytes:
+                request.mongo_bytes += len(bson.encode(event.command))
+
+    def succeeded(self, event):
+        request = current_request.get()
+        if request is not None:
+            request.mongo_seconds += event.duration_micros / 1e6
+            if self.metrics.count_bytes:
+                request.mongo_bytes += len(bson.encode(event.reply))
+
+    def failed(self, event):
+        request = current_request.get()
+        if request is not None:
+            request.mongo_seconds += event.duration_micros / 1e6
+
+class Metrics:
+    """
+    Collects request, resolver and Mongo command metrics, and exports them in the Prometheus text format
+    Requests are labeled by operation name and by schema (the role of the user). Clients choose operation names,
+    so only the first 'max_operations' names get their own series, and the rest are grouped as 'other'.
+    Requests slower than 'slow_threshold' seconds are logged along with their slowest resolvers.
+    Metrics are kept per worker process.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.count_bytes = False
+        self.max_operations = 100
+        self.slow_threshold = 1
+        self.slow_top_resolvers = 5
+        self.middleware = TimingMiddleware()
+        self._operations = set()
+        self._lock = Lock()
+        self._listener = None
+        self._create_histograms()
+
+    def _create_histograms(self):
+        labels = ('operation', 'schema')
+        self.request_seconds = Histogram('syllabits_request_duration_seconds', 'Time spent handling GraphQL requests', labels, DURATION_BUCKETS)
+        self.mongo_commands = Histogram('syllabits_request_mongo_commands', 'Mongo commands per GraphQL request', labels, COUNT_BUCKETS)
+        self.mongo_seconds = Histogram('syllabits_request_mongo_duration_seconds', 'Time spent on Mongo commands per GraphQL request', labels, DURATION_BUCKETS)
+        self.mongo_bytes = Histogram('syllabits_request_mongo_bytes', 'Size of Mongo commands and replies per GraphQL request', labels, BYTE_BUCKETS)
+        self.resolver_seconds = Histogram('syllabits_resolver_duration_seconds', 'Time spent resolving a field per GraphQL request', ('field', 'schema'), DURATION_BUCKETS)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('ENABLE_METRICS', self.enabled)
+        self.count_bytes = app.config.get('METRICS_COUNT_MONGO_BYTES', self.count_bytes)
+        self.max_operations = app.config.get('METRICS_MAX_OPERATIONS', self.max_operations)
+        self.slow_threshold = app.config.get('SLOW_REQUEST_THRESHOLD', self.slow_threshold)
+        self.slow_top_resolvers = app.config.get('SLOW_REQUEST_TOP_RESOLVERS', self.slow_top_resolvers)
+        # Listeners only apply to clients created afterwards, so this must be initialized before the Mongo connection
+        if self.enabled and self._listener is None:
+            self._listener = CommandMetrics(self)
+            monitoring.register(self._listener)
+
+    def start_request(self):
+        """
+        Starts measuring the current request, returning its metrics (or None if metrics are disabled)
+        Must be followed by 'finish_request' or 'cancel_request'.
+        """
+        if not self.enabled:
+            return None
+        request = RequestMetrics()
+        request._token = current_request.set(request)
+        return request
+
+    def cancel_request(self, request):
+        if request is not None:
+            current_request.reset(request._token)
+
+    def finish_request(self, request, schema, get_query_hash=None):
+        """
+        Records the metrics of a request, logging it if it was slow
+        'get_query_hash' is only called for slow requests.
+        """
+        if request is None:
+            return
+        current_request.reset(request._token)
+        seconds = time.perf_counter() - request.started
+        with self._lock:
+            operation = self.get_operation_label(request.operation)
+            labels = (operation, schema)
+            self.request_seconds.observe(labels, seconds)
+            self.mongo_commands.observe(labels, request.mongo_commands)
+            self.mongo_seconds.observe(labels, request.mongo_seconds)
+            self.mongo_bytes.observe(labels, request.mongo_bytes)
+            for key, (resolver_seconds, count) in request.resolvers.items():
+                self.resolver_seconds.observe((key, schema), resolver_seconds)
+        if self.slow_threshold is not None and seconds >= self.slow_threshold:
+            resolvers = ', '.join(
+                f'{key} {resolver_seconds:.3f}s ({count}x)'
+                for key, (resolver_seconds, count) in request.get_slowest_resolvers(self.slow_top_resolvers)
+            )
+            logging.getLogger(__name__).warning(
+                'Slow request: %.3fs, operation \'%s\', schema \'%s\', query %s, %d Mongo commands (%.3fs, %d bytes), slowest resolvers: %s',
+                seconds, operation, schema, get_query_hash() if get_query_hash else None,
+                request.mongo_commands, request.mongo_seconds, request.mongo_bytes, resolvers or 'none',
+            )
+
+    def get_operation_label(self, operation):
+        if operation is None:
+            # Nothing was resolved, usually because the request was invalid
+            return 'none'
+        operation = operation or 'unnamed'
+        if operation not in self._operations:
+            if len(self._operations) >= self.max_operations:
+                return 'other'
+            self._operations.add(operation)
+        return operation
+
+    def render(self):
+        with self._lock:
+            lines = []
+            for histogram in (self.request_seconds, self.mongo_commands, self.mongo_seconds, self.mongo_bytes, self.resolver_seconds):
+                lines.extend(histogram.render())
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,142 @@
+from threading import Lock
+import random
+import time
+
+class IdPool:
+    """
+    A set of IDs that supports constant-time insertion, removal, and random choice
+    IDs are stored in a list (for random choice) along with a lookup of each ID's index.
+    Removal swaps the last ID into the removed slot, so the list never has holes.
+    """
+
+    def __init__(self, ids=()):
+        self._ids = []
+        self._index = {}
+        for id in ids:
+            self.add(id)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, id):
+        return id in self._index
+
+    def add(self, id):
+        if id in self._index:
+            return
+        self._index[id] = len(self._ids)
+        self._ids.append(id)
+
+    def remove(self, id):
+        index = self._index.pop(id, None)
+        if index is None:
+            return
+        last = self._ids.pop()
+        if index < len(self._ids):
+            self._ids[index] = last
+            self._index[last] = index
+
+    def choice(self, exclude=None, attempts=8):
+        """
+        Returns a random ID, or None if the pool is empty
+        IDs in 'exclude' are never chosen. We first try picking at random a few times, which
+        almost always succeeds when only a small part of the pool is excluded. If that fails,
+        we fall back to choosing from the IDs that aren't excluded.
+        """
+        if not self._ids:
+            return None
+        if not exclude:
+            return random.choice(self._ids)
+        for _ in range(attempts):
+            id = random.choice(self._ids)
+            if id not in exclude:
+                return id
+        candidates = [id for id in self._ids if id not in exclude]
+        return random.choice(candidates) if candidates else None
+
+class PoemPool:
+    """
+    An in-memory pool of poem IDs used to choose random poems
+    Choosing from the pool takes constant time, so a random poem only costs one primary key lookup.
+    Each category also has its own pool so random poems can be chosen from a category.
+    The pool is kept current by the poem mutation signals. Since other workers (and commands like 'importpoems')
+    don't send signals to this worker, the pool is also reloaded every 'POEM_POOL_REFRESH_INTERVAL' seconds.
+    'model' is the poem document, which must have a 'categories' list field.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.refresh_interval = 300
+        self._all = IdPool()
+        self._categories = {}
+        self._poem_categories = {}
+        self._next_refresh = None
+        self._lock = Lock()
+
+    def init_app(self, app):
+        self.refresh_interval = app.config.get('POEM_POOL_REFRESH_INTERVAL', self.refresh_interval)
+        self._next_refresh = None
+
+    def load(self):
+        # Only load IDs and categories
+        self._all = IdPool()
+        self._categories = {}
+        self._poem_categories = {}
+        for data in self.model.objects.only('categories').as_pymongo():
+            self._add(data['_id'], data.get('categories', []))
+        self._next_refresh = time.monotonic() + self.refresh_interval
+
+    def _ensure_loaded(self):
+        if self._next_refresh is None or time.monotonic() >= self._next_refresh:
+            with self._lock:
+                if self._next_refresh is None or time.monotonic() >= self._next_refresh:
+                    self.load()
+
+    def _add(self, id, categories):
+        self._all.add(id)
+        self._poem_categories[id] = set(categories)
+        for name in categories:
+            self._categories.setdefault(name, IdPool()).add(id)
+
+    def _remove(self, id):
+        self._all.remove(id)
+        for name in self._poem_categories.pop(id, ()):
+            self._categories[name].remove(id)
+
+    def add(self, poem):
+        with self._lock:
+            self._remove(poem.id)
+            self._add(poem.id, poem.categories)
+
+    def remove(self, poem):
+        with self._lock:
+            self._remove(poem.id)
+
+    def choose(self, category=None, exclude=None):
+        """
+        Returns the ID of a random poem, or None if there are no candidates
+        If a category is specified, only poems in that category are considered.
+        Poem IDs in 'exclude' (poems the user has completed, for instance) are never chosen.
+        """
+        self._ensure_loaded()
+        with self._lock:
+            pool = self._all if category is None else self._categories.get(category)
+            if not pool:
+                return None
+            return pool.choice(exclude=exclude)
+
+    def fetch(self, category=None, exclude=None, attempts=3):
+        """
+        Chooses and loads a random poem
+        A poem could have been deleted by another worker, in which case we forget it and try again.
+        """
+        for _ in range(attempts):
+            id = self.choose(category=category, exclude=exclude)
+            if id is None:
+                return None
+            poem = self.model.objects.with_id(id)
+            if poem:
+                return poem
+            with self._lock:
+                self._remove(id)
+        return None
@@ -0,0 +1,183 @@
+from collections import Counter
+from threading import Lock, Condition, Event, Thread
+from pymongo import UpdateOne, ReturnDocument
+from .connection import get_max_time_ms, with_max_time
+import atexit
+import logging
+
+class ProgressBuffer:
+    """
+    Collects line submissions and writes them to the database in bulk
+    Each submission is merged into a pending entry for its user and poem, so repeated submissions
+    of the same line only cost one write. Pending entries are written using one 'bulk_write' for progress (plus one
+    'find' to read it back) and one for the states of the poems (to update in-progress and completed poems).
+    'progress_model' is the progress document, and 'state_model' provides the state updates ('get_progress_update').
+
+    If 'PROGRESS_WRITE_BEHIND' is set, entries are flushed by a background thread every 'PROGRESS_FLUSH_INTERVAL'
+    seconds, or as soon as 'PROGRESS_FLUSH_SIZE' entries are pending, and once more when the process exits.
+    Otherwise, each submission is flushed immediately.
+    A worker reads its own writes by flushing the pending entries of a user before reading their progress.
+    Other workers see the writes once they are flushed.
+
+    The number of correct lines is incremented by the upsert itself, which returns the updated lines. Whether the poem
+    is complete is decided by recounting those lines, so submitting a correct line twice doesn't count it twice
+    (the stored count is fixed up in that case). Writing a single entry, like every submission unless writing behind,
+    takes one round trip for progress and one for the state of the poem.
+    """
+
+    def __init__(self, progress_model, state_model):
+        self.progress_model = progress_model
+        self.state_model = state_model
+        self.write_behind = False
+        self.interval = 1
+        self.size = 500
+        self._pending = {}
+        # Number of flushes writing each key, and of resets running for each key (which aren't flushed meanwhile), see 'reset'
+        self._writing = Counter()
+        self._resetting = Counter()
+        self._lock = Lock()
+        self._written = Condition(self._lock)
+        self._wake = Event()
+        self._thread = None
+
+    def init_app(self, app):
+        self.write_behind = app.config.get('PROGRESS_WRITE_BEHIND', self.write_behind)
+        self.interval = app.config.get('PROGRESS_FLUSH_INTERVAL', self.interval)
+        self.size = app.config.get('PROGRESS_FLUSH_SIZE', self.size)
+
+    def submit(self, user_id, poem_id, line_id, answer, correct, num_lines):
+        """
+        Records a line submission
+        'num_lines' is the number of lines of the poem, which determines whether the poem is complete.
+        """
+        key = (user_id, poem_id)
+        with self._lock:
+            entry = self._pending.setdefault(key, {'lines': {}, 'num_lines': num_lines})
+            entry['lines'][line_id] = {'answer': list(answer), 'correct': correct}
+            entry['num_lines'] = num_lines
+            num_pending = len(self._pending)
+        if not self.write_behind:
+            self.flush(key=lambda k: k == key)
+        elif num_pending >= self.size:
+            self._wake.set()
+        else:
+            self._ensure_started()
+
+    def reset(self, user_id, poem_id, reset):
+        """
+        Drops the pending entry of a user and poem, then calls 'reset' to delete their stored progress
+        A flush could already be writing the entry, so this first waits for it to finish. The key isn't flushed
+        while 'reset' runs, so the dropped progress can't be written back afterwards. 'reset' runs without holding
+        the lock, so other users' submissions and flushes carry on meanwhile.
+        """
+        key = (user_id, poem_id)
+        with self._lock:
+            while self._writing[key]:
+                self._written.wait()
+            self._pending.pop(key, None)
+            self._resetting[key] += 1
+        try:
+            reset()
+        finally:
+            with self._lock:
+                self._resetting[key] -= 1
+                if not self._resetting[key]:
+                    del self._resetting[key]
+        # Write anything submitted during the reset, which was held back
+        if not self.write_behind:
+            self.flush(key=lambda k: k == key)
+
+    def flush_user(self, user_id):
+        return self.flush(key=lambda k: k[0] == user_id)
+
+    def flush(self, key=None):
+        """
+        Writes pending entries to the database, returning whether anything was written
+        If 'key' is specified, only entries whose key (user ID, poem ID) passes the test are written.
+        """
+        with self._lock:
+            pending = {k: v for k, v in self._pending.items() if (key is None or key(k)) and k not in self._resetting}
+            for k in pending:
+                del self._pending[k]
+            self._writing.update(pending.keys())
+        if not pending:
+            return False
+        try:
+            self._write(pending)
+            return True
+        except Exception:
+            # Put entries back, keeping anything submitted since
+            with self._lock:
+                for k, entry in pending.items():
+                    newer = self._pending.get(k)
+                    if newer:
+                        entry['lines'].update(newer['lines'])
+                    self._pending[k] = entry
+            raise
+        finally:
+            with self._lock:
+                for k in pending:
+                    self._writing[k] -= 1
+                    if not self._writing[k]:
+                        del self._writing[k]
+                self._written.notify_all()
+
+    def _write(self, pending):
+        # Upsert progress lines, counting the correct ones
+        progress_collection = self.progress_model._get_collection()
+        updates = {}
+        for key, entry in pending.items():
+            lines = {f'lines.{line_id}': line for line_id, line in entry['lines'].items()}
+            num_correct = sum(1 for line in entry['lines'].values() if line['correct'])
+            updates[key] = {'$set': lines, '$inc': {'num_correct': num_correct}}
+        projection = {'user': 1, 'poem': 1, 'lines': 1, 'num_correct': 1}
+        if len(updates) == 1:
+            # A single entry is upserted and read back at once
+            (user_id, poem_id), update = next(iter(updates.items()))
+            progresses = [progress_collection.find_one_and_update(
+                {'user': user_id, 'poem': poem_id}, update, projection,
+                upsert=True, return_document=ReturnDocument.AFTER, **with_max_time(),
+            )]
+        else:
+            progress_collection.bulk_write([
+                UpdateOne({'user': user_id, 'poem': poem_id}, update, upsert=True)
+                for (user_id, poem_id), update in updates.items()
+            ], ordered=False)
+            query = {'$or': [{'user': user_id, 'poem': poem_id} for user_id, poem_id in pending]}
+            progresses = progress_collection.find(query, projection, max_time_ms=get_max_time_ms())
+        # Recount correct lines and determine which poems are complete
+        # If poem is complete, mark it completed. If not, mark it in-progress (unless already completed)
+        fixes = []
+        state_requests = []
+        for progress in progresses:
+            user_id, poem_id = progress['user'], progress['poem']
+            num_correct = sum(1 for line in progress.get('lines', {}).values() if line.get('correct'))
+            if progress.get('num_correct') != num_correct:
+                # The increment was off (a line that was already correct was submitted again, or a correct line
+                # became wrong), so fix the count, unless a later write changed it (and fixes it itself)
+                fixes.append(UpdateOne({'_id': progress['_id'], 'num_correct': progress.get('num_correct')}, {'$set': {'num_correct': num_correct}}))
+            complete = num_correct == pending[(user_id, poem_id)]['num_lines']
+            state_requests.append(self.state_model.get_progress_update(user_id, poem_id, complete))
+        if fixes:
+            progress_collection.bulk_write(fixes, ordered=False)
+        if state_requests:
+            self.state_model._get_collection().bulk_write(state_requests, ordered=False)
+
+    def _ensure_started(self):
+        # The flushing thread is started lazily so that it is started in the worker process
+        # rather than in a parent process that forks workers
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = Thread(target=self._run, name='progress-buffer', daemon=True)
+                    self._thread.start()
+                    atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logging.getLogger(__name__).exception('Failed to flush progress')
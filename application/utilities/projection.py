@@ -0,0 +1,155 @@
+from graphql.language.ast import Field as FieldNode, FragmentSpread, InlineFragment
+from graphene_mongo import MongoengineConnectionField
+from .types import fix_field_name
+from .connection import TimeLimitedQuerySet
+
+class Size:
+    """
+    A computed field that is the size of a list field
+    The size is computed by Mongo (using '$size'), so the list itself doesn't have to be loaded.
+    Expressions in find projections require MongoDB 4.4.
+    """
+
+    def __init__(self, field):
+        self.field = field
+
+    def get_expression(self, model):
+        db_field = model._fields[self.field].db_field
+        return {'$size': {'$ifNull': [f'${db_field}', []]}}
+
+class ProjectionQuerySet(TimeLimitedQuerySet):
+    """
+    A queryset that can include computed fields in the projection
+    Computed fields are projected using aggregation expressions, and are attached to the loaded documents
+    as the '_computed' dict, since Mongoengine doesn't allow unknown fields on documents.
+    Computed fields can only be used along with 'only', as they would otherwise exclude every other field.
+    """
+
+    def __init__(self, document, collection):
+        super().__init__(document, collection)
+        self._computed = {}
+
+    def computed(self, **expressions):
+        queryset = self.clone()
+        queryset._computed = dict(queryset._computed, **expressions)
+        return queryset
+
+    def _clone_into(self, new_qs):
+        new_qs = super()._clone_into(new_qs)
+        new_qs._computed = dict(getattr(self, '_computed', {}))
+        return new_qs
+
+    @property
+    def _cursor_args(self):
+        cursor_args = super()._cursor_args
+        if self._computed:
+            cursor_args.setdefault('projection', {}).update(self._computed)
+        return cursor_args
+
+    def __next__(self):
+        if not self._computed or self._as_pymongo or self._scalar or self._none or self._empty:
+            return super().__next__()
+        return self.from_son(next(self._cursor))
+
+    def from_son(self, son):
+        """
+        Builds a document from a raw document returned by this queryset's projection
+        """
+        computed = {name: son.pop(name, None) for name in self._computed}
+        document = self._document._from_son(son, _auto_dereference=self._auto_dereference)
+        if computed:
+            document._computed = computed
+        return document
+
+    def __getitem__(self, key):
+        # Indexing reads from the cursor directly, so go through iteration instead
+        if isinstance(key, int) and self._computed:
+            for document in self[key:key + 1]:
+                return document
+            raise IndexError('no such item for Cursor instance')
+        return super().__getitem__(key)
+
+def from_son(queryset, son):
+    """
+    Builds a document from a raw document returned by a query built from a queryset (using the async driver, for instance)
+    """
+    if isinstance(queryset, ProjectionQuerySet):
+        return queryset.from_son(son)
+    return queryset._document._from_son(son)
+
+def get_computed(document, name, compute):
+    """
+    Returns a computed field of a document, computing it in Python if it wasn't projected
+    """
+    computed = getattr(document, '_computed', None)
+    if computed and computed.get(name) is not None:
+        return computed[name]
+    return compute()
+
+def get_selected_fields(info, path=()):
+    """
+    Returns the names of the fields selected by the current field, after following a path of fields
+    For connections, the path is ('edges', 'node'). Fragments are expanded regardless of their type conditions.
+    Names are GraphQL names (camel case).
+    """
+    def collect(selection_set, path, names):
+        if selection_set is None:
+            return
+        for selection in selection_set.selections:
+            if isinstance(selection, FieldNode):
+                name = selection.name.value
+                if not path:
+                    names.add(name)
+                elif name == path[0]:
+                    collect(selection.selection_set, path[1:], names)
+            elif isinstance(selection, FragmentSpread):
+                collect(info.fragments[selection.name.value].selection_set, path, names)
+            elif isinstance(selection, InlineFragment):
+                collect(selection.selection_set, path, names)
+    names = set()
+    for field_ast in info.field_asts:
+        collect(field_ast.selection_set, path, names)
+    return names
+
+def project(queryset, type, names):
+    """
+    Restricts a queryset to the model fields needed to resolve the selected fields of a type
+    Types can declare the model fields used by fields that aren't model fields (like computed fields)
+    with a 'projections' dict, mapping field names to a tuple of model fields or a computed field (see 'Size').
+    If a selected field can't be mapped, the queryset is returned unchanged, since a resolver might need anything.
+    """
+    model = queryset._document
+    projections = getattr(type, 'projections', {})
+    fields = set()
+    computed = {}
+    for name in names:
+        if name.startswith('__'):
+            continue
+        name = fix_field_name(name)
+        if name in projections:
+            projection = projections[name]
+            if isinstance(projection, Size):
+                computed[name] = projection.get_expression(model)
+            else:
+                fields.update(projection)
+        elif name in model._fields:
+            fields.add(name)
+        else:
+            return queryset
+    # The primary key is always needed
+    fields.add(model._meta['id_field'])
+    if not isinstance(queryset, ProjectionQuerySet):
+        queryset = queryset._clone_into(ProjectionQuerySet(model, queryset._collection_obj))
+    return queryset.only(*fields).computed(**computed)
+
+class ProjectedConnectionField(MongoengineConnectionField):
+    """
+    A connection field that only loads the model fields needed by the selected fields
+    Lists often select a few small fields of documents with large embedded lists (like poem lines),
+    so loading whole documents wastes bandwidth and time building Mongoengine objects.
+    See 'project' for how fields are mapped.
+    """
+
+    def get_queryset(self, model, info, **args):
+        queryset = super().get_queryset(model, info, **args)
+        return project(queryset, self.node_type, get_selected_fields(info, ('edges', 'node')))
@@ -0,0 +1,216 @@
+from collections import namedtuple
+from graphene.relay import Connection
+from graphql.error import GraphQLError
+from graphql.execution import ExecutionResult
+from graphql.language.ast import Field as FieldNode, FragmentSpread, InlineFragment, OperationDefinition, Variable
+from graphql.type.definition import GraphQLList, GraphQLNonNull, GraphQLObjectType, GraphQLInterfaceType, GraphQLUnionType
+from graphql.utils.value_from_ast import value_from_ast
+from .types import fix_field_name
+
+QueryBudget = namedtuple('QueryBudget', ['cost', 'depth'])
+"""
+The maximum estimated cost and depth of an operation. Either can be None (unlimited).
+"""
+
+# Arguments that limit the length of lists
+SIZE_ARGUMENTS = ('first', 'last')
+# Fields of connections and edges, which don't resolve anything themselves
+STRUCTURAL_FIELDS = ('edges', 'node', 'pageInfo')
+
+def unwrap(graphql_type):
+    while isinstance(graphql_type, GraphQLNonNull):
+        graphql_type = graphql_type.of_type
+    return graphql_type
+
+def get_named_type(graphql_type):
+    graphql_type = unwrap(graphql_type)
+    while isinstance(graphql_type, GraphQLList):
+        graphql_type = unwrap(graphql_type.of_type)
+    return graphql_type
+
+def is_connection(graphql_type):
+    graphene_type = getattr(graphql_type, 'graphene_type', None)
+    return isinstance(graphene_type, type) and issubclass(graphene_type, Connection)
+
+class QueryCostError(GraphQLError):
+    """
+    Raised (returned) when an operation exceeds its budget
+    The error has a 'code' extension ('QUERY_TOO_EXPENSIVE' or 'QUERY_TOO_DEEP') along with the estimate and the limit,
+    so clients can tell it apart from other errors.
+    """
+
+    def __init__(self, code, message, value, limit):
+        super().__init__(message, extensions={'code': code, 'value': value, 'limit': limit})
+
+class CostAnalysis:
+    """
+    Estimates the cost and depth of the operations of a validated document
+    The cost is roughly the number of documents an operation can read. Each field that resolves an object costs 1,
+    unless its type declares otherwise with a 'costs' dict (mapping field names to weights). Scalar fields and the
+    structural fields of connections are free. List fields are multiplied by their 'first' or 'last' argument,
+    or by 'default_list_size' if they have neither (connections without arguments return everything).
+    Fragments are counted regardless of their type conditions, so the estimate is an upper bound.
+    Estimates only depend on integer variables, so they are memoized by those.
+    """
+
+    max_memo_size = 64
+
+    def __init__(self, schema, document_ast, default_list_size):
+        self.schema = schema
+        self.document_ast = document_ast
+        self.default_list_size = default_list_size
+        self.fragments = {}
+        self.operations = {}
+        for definition in document_ast.definitions:
+            if isinstance(definition, OperationDefinition):
+                self.operations[definition.name.value if definition.name else None] = definition
+            else:
+                self.fragments[definition.name.value] = definition
+        self._memo = {}
+
+    def estimate(self, operation_name, variables):
+        """
+        Returns the estimated (cost, depth) of an operation
+        """
+        variables = variables or {}
+        key = (operation_name, tuple(sorted((name, value) for name, value in variables.items() if isinstance(value, int))))
+        estimate = self._memo.get(key)
+        if estimate is None:
+            operation = self.get_operation(operation_name)
+            if operation is None:
+                # Execution reports the missing operation
+                return 0, 0
+            root_type = {
+                'query': self.schema.get_query_type,
+                'mutation': self.schema.get_mutation_type,
+                'subscription': self.schema.get_subscription_type,
+            }[operation.operation]()
+            estimate = self.selection_cost(root_type, operation.selection_set, variables, None)
+            if len(self._memo) >= self.max_memo_size:
+                self._memo.clear()
+            self._memo[key] = estimate
+        return estimate
+
+    def get_operation(self, operation_name):
+        if operation_name is None and len(self.operations) == 1:
+            return next(iter(self.operations.values()))
+        return self.operations.get(operation_name)
+
+    def collect_fields(self, selection_set, fields):
+        for selection in selection_set.selections:
+            if isinstance(selection, FieldNode):
+                fields.append(selection)
+            elif isinstance(selection, FragmentSpread):
+                self.collect_fields(self.fragments[selection.name.value].selection_set, fields)
+            elif isinstance(selection, InlineFragment):
+                self.collect_fields(selection.selection_set, fields)
+        return fields
+
+    def selection_cost(self, parent_type, selection_set, variables, connection_size):
+        """
+        Returns the (cost, depth) of a selection set
+        'connection_size' is the size of the enclosing connection, which applies to its edges.
+        """
+        cost = 0
+        depth = 0
+        for node in self.collect_fields(selection_set, []):
+            name = node.name.value
+            if name.startswith('__'):
+                # Introspection
+                continue
+            field_def = self.get_field_def(parent_type, name)
+            if field_def is None:
+                continue
+            field_cost, field_depth = self.field_cost(parent_type, field_def, node, variables, connection_size)
+            cost += field_cost
+            depth = max(depth, field_depth)
+        return cost, depth
+
+    def get_field_def(self, parent_type, name):
+        if isinstance(parent_type, (GraphQLObjectType, GraphQLInterfaceType)):
+            return parent_type.fields.get(name)
+        if isinstance(parent_type, GraphQLUnionType):
+            for member in parent_type.types:
+                if name in member.fields:
+                    return member.fields[name]
+        return None
+
+    def field_cost(self, parent_type, field_def, node, variables, connection_size):
+        name = node.name.value
+        field_type = get_named_type(field_def.type)
+        connection = is_connection(field_type)
+        # Edges and nodes are part of the enclosing connection
+        structural = connection_size is not None and name in STRUCTURAL_FIELDS
+        # Determine the weight of the field
+        costs = getattr(getattr(parent_type, 'graphene_type', None), 'costs', {})
+        if fix_field_name(name) in costs:
+            weight = costs[fix_field_name(name)]
+        elif structural or node.selection_set is None:
+            weight = 0
+        else:
+            weight = 1
+        # Determine how many items the field resolves
+        size = 1
+        if structural:
+            if name == 'edges':
+                size = connection_size
+        elif connection or isinstance(unwrap(field_def.type), GraphQLList):
+            size = self.get_size(field_def, node, variables)
+        cost = weight * size
+        if node.selection_set is None:
+            return cost, 1
+        if connection:
+            # The size applies to the edges, not to the other fields of the connection (like 'totalCount')
+            child_cost, child_depth = self.selection_cost(field_type, node.selection_set, variables, size)
+        else:
+            child_connection_size = 1 if structural and name == 'edges' else None
+            child_cost, child_depth = self.selection_cost(field_type, node.selection_set, variables, child_connection_size)
+            child_cost *= size
+        return cost + child_cost, child_depth + (0 if structural else 1)
+
+    def get_size(self, field_def, node, variables):
+        for argument in node.arguments:
+            if argument.name.value in SIZE_ARGUMENTS:
+                value = argument.value
+                if isinstance(value, Variable):
+                    size = variables.get(value.name.value)
+                else:
+                    size = value_from_ast(value, unwrap(field_def.args[argument.name.value].type), variables)
+                if isinstance(size, int) and size >= 0:
+                    return size
+        # Use the default value of the argument, if there is one
+        for name in SIZE_ARGUMENTS:
+            argument = field_def.args.get(name)
+            if argument is not None and isinstance(argument.default_value, int):
+                return argument.default_value
+        return self.default_list_size
+
+def check_budget(analysis, budget, operation_name, variables, spent=0):
+    """
+    Returns an error if an operation exceeds a budget, or None if it doesn't
+    'spent' is the cost of the operations already executed as part of the same request (in a batch).
+    """
+    if budget is None:
+        return None
+    cost, depth = analysis.estimate(operation_name, variables)
+    if budget.depth is not None and depth > budget.depth:
+        return QueryCostError('QUERY_TOO_DEEP', f'Query is too deep ({depth} levels, the limit is {budget.depth})', depth, budget.depth)
+    if budget.cost is not None and spent + cost > budget.cost:
+        return QueryCostError('QUERY_TOO_EXPENSIVE', f'Query is too expensive (estimated cost {spent + cost}, the limit is {budget.cost})', spent + cost, budget.cost)
+    return None
+
+def execute_within_budget(execute, analysis, get_budget, *args, **kwargs):
+    """
+    Executes a document if the operation is within the budget of the request context, see 'CachedDocumentBackend'
+    The operations of a batch share one budget: the cost of each operation is added to the context's 'query_cost'.
+    """
+    context = kwargs.get('context', kwargs.get('context_value'))
+    operation_name = kwargs.get('operation_name')
+    variables = kwargs.get('variable_values', kwargs.get('variables'))
+    spent = getattr(context, 'query_cost', 0)
+    error = check_budget(analysis, get_budget(context), operation_name, variables, spent)
+    if error is not None:
+        return ExecutionResult(errors=[error], invalid=True)
+    if hasattr(context, 'query_cost'):
+        context.query_cost = spent + analysis.estimate(operation_name, variables)[0]
+    return execute(*args, **kwargs)
@@ -0,0 +1,149 @@
+from collections import OrderedDict, namedtuple
+from hashlib import sha256
+from threading import RLock
+import json
+import time
+from graphql.language.printer import print_ast
+from graphql.language.visitor import Visitor, TypeInfoVisitor, visit
+from graphql.type.definition import GraphQLInterfaceType, GraphQLUnionType, get_named_type
+from graphql.utils.type_info import TypeInfo
+from .cache import Cache
+from .backend import hash_query
+
+CachedResponse = namedtuple('CachedResponse', ['body', 'etag', 'models', 'expires'])
+
+class ModelCollector(Visitor):
+    """
+    Collects the Mongoengine models of every type selected by a document
+    Abstract types (like 'Node') could resolve to any of their implementations, so they depend on all of them.
+    """
+
+    def __init__(self, schema, type_info):
+        self.schema = schema
+        self.type_info = type_info
+        self.models = set()
+
+    def add_type(self, type):
+        type = get_named_type(type)
+        if isinstance(type, (GraphQLInterfaceType, GraphQLUnionType)):
+            for possible_type in self.schema.get_possible_types(type):
+                self.add_type(possible_type)
+            return
+        meta = getattr(getattr(type, 'graphene_type', None), '_meta', None)
+        model = getattr(meta, 'model', None)
+        if model is not None:
+            self.models.add(model)
+
+    def enter_Field(self, node, *args):
+        self.add_type(self.type_info.get_parent_type())
+        self.add_type(self.type_info.get_type())
+
+def get_document_models(schema, document_ast):
+    """
+    Returns the set of Mongoengine models a document depends on
+    """
+    type_info = TypeInfo(schema)
+    collector = ModelCollector(schema, type_info)
+    visit(document_ast, TypeInfoVisitor(type_info, collector))
+    return frozenset(collector.models)
+
+class ResponseCache:
+    """
+    Caches the serialized responses of queries, keyed by the normalized query, variables, and operation name
+    Only use this for requests whose result doesn't depend on who is asking, like anonymous queries.
+
+    Every entry records the models its query selects (see 'get_document_models'). Whenever a document of a model
+    is created, updated, or deleted, 'invalidate_model' drops every entry that depends on it.
+    Entries are evicted in LRU order once the total size of the cached responses exceeds 'RESPONSE_CACHE_MAX_BYTES'.
+    Like the other caches, responses are local to each worker, so 'RESPONSE_CACHE_TTL' bounds how stale
+    a response can be after a write made by another worker. For that reason the cache is disabled unless
+    'ENABLE_RESPONSE_CACHE' is set, which is only safe with a single worker or when that staleness is acceptable.
+    """
+
+    def __init__(self, max_bytes=32 << 20, ttl=60):
+        self.enabled = False
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._keys_by_model = {}
+        # Normalized query and models of each query, keyed by schema and query hash
+        self._queries = Cache('RESPONSE_CACHE_QUERY', size=1024)
+        self._lock = RLock()
+
+    def init_app(self, app):
+        self.enabled = app.config.get('ENABLE_RESPONSE_CACHE', self.enabled)
+        self.max_bytes = app.config.get('RESPONSE_CACHE_MAX_BYTES', self.max_bytes)
+        self.ttl = app.config.get('RESPONSE_CACHE_TTL', self.ttl)
+        self._queries.init_app(app)
+        self.clear()
+
+    def describe(self, document):
+        """
+        Returns the normalized query string and the models of a GraphQL document
+        Normalizing the query means clients that format the same query differently share entries.
+        """
+        def load():
+            return print_ast(document.document_ast), get_document_models(document.schema, document.document_ast)
+        return self._queries.get_or_load((document.schema, hash_query(document.document_string)), load)
+
+    def get_key(self, document, variables, operation_name):
+        query, models = self.describe(document)
+        key = sha256(json.dumps([query, variables or {}, operation_name], sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        return key, models
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.expires < time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def set(self, key, body, models):
+        """
+        Caches a response body, returning the entry
+        """
+        entry = CachedResponse(body, sha256(body).hexdigest(), models, time.monotonic() + self.ttl)
+        if len(body) > self.max_bytes:
+            return entry
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self.bytes += len(body)
+            for model in models:
+                self._keys_by_model.setdefault(model, set()).add(key)
+            # Evict least recently used entries
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+        return entry
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.bytes -= len(entry.body)
+        for model in entry.models:
+            keys = self._keys_by_model.get(model)
+            if keys:
+                keys.discard(key)
+
+    def invalidate_model(self, model):
+        with self._lock:
+            for key in self._keys_by_model.pop(model, ()):
+                if key in self._entries:
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_model.clear()
+            self.bytes = 0
+
+    def stats(self):
+        return {'size': len(self._entries), 'bytes': self.bytes, 'hits': self.hits, 'misses': self.misses}
@@ -5,6 +5,11 @@ pre_create = signal('pre_create')
 Sent by MongoengineCreateMutation before saving the created document
 """
 
+post_create = signal('post_create')
+"""
+Sent by MongoengineCreateMutation after saving the created document
+"""
+
 pre_delete = signal('pre_delete')
 """
 Sent by MongoengineDeleteMutation before deleting the document
@@ -13,5 +18,18 @@ Sent by MongoengineDeleteMutation before deleting the document
 pre_update = signal('pre_update')
 """
 Sent by MongoengineUpdateMutation before applying a transform to the document
-Provides the operator, the receiver, and the arguments
-"""
\ No newline at end of file
+Provides the operator, the receiver, the path, the arguments, and the state
+If the transforms were compiled into an atomic update, the document and receiver are None.
+The state is a dict shared by all update signals of a mutation, which receivers can use to collect changes.
+"""
+
+post_update = signal('post_update')
+"""
+Sent by MongoengineUpdateMutation after the transformed document has been saved
+Provides the updated document and the state shared with the 'pre_update' signals
+"""
+
+post_delete = signal('post_delete')
+"""
+Sent by MongoengineDeleteMutation after deleting the document
+"""
@@ -2,8 +2,16 @@ from graphene import Field, Connection, Int, JSONString, Boolean, List, ID
 from graphene.relay import Node, GlobalID
 from graphene.types.mutation import Mutation, MutationOptions
 from graphene_mongo import MongoengineObjectType
+from mongoengine import QuerySet
+from bson import json_util
+from flask import current_app
 import re
+from pymongo import ReturnDocument
 from .document_path import DocumentPath
+from .update_compiler import compile_transforms, CannotCompile
+from .cache import Cache
+from .async_mongo import run_async
+from .connection import with_max_time
 from . import operators, signals
 
 PATTERN = re.compile(r'(?<!^)(?=[A-Z])')
@@ -17,18 +25,71 @@ def fix_fields(value):
         return [fix_fields(e) for e in value]
     return value
 
+count_cache = Cache('COUNT_CACHE', size=1024, ttl=60)
+"""
+Caches connection counts by model and query
+Each model has a "generation" which is included in the key. Whenever a document of a model is
+created, updated, or deleted, the generation is bumped, so stale counts are never looked up again.
+The TTL covers writes that don't go through the mutation signals (like registering users).
+"""
+_count_generations = {}
+
+def invalidate_counts(sender, **kwargs):
+    _count_generations[sender] = _count_generations.get(sender, 0) + 1
+
+for _signal in (signals.pre_create, signals.post_create, signals.pre_delete, signals.post_delete, signals.post_update):
+    _signal.connect(invalidate_counts)
+
 class CountableConnection(Connection):
     """
     A connection that supports a 'totalCount' field
+    Counts are cached, since the same count is requested for every page of the connection.
+    Connections can count themselves instead by setting 'get_total_count' (returning a count or a promise), for documents
+    that are written without the mutation signals (like a user's play state), whose cached counts would go stale.
+    If 'ESTIMATE_UNFILTERED_COUNTS' is set, unfiltered connections use the (much cheaper)
+    collection metadata count rather than counting documents.
     """
 
     class Meta:
         abstract = True
 
+    # Counting costs a query (see 'CostAnalysis')
+    costs = {'total_count': 1}
+
     total_count = Int()
 
     def resolve_total_count(root, info):
-        return root.iterable.count()
+        get_total_count = getattr(root, 'get_total_count', None)
+        if get_total_count is not None:
+            return get_total_count()
+        queryset = root.iterable
+        if not isinstance(queryset, QuerySet):
+            return len(queryset)
+        model = queryset._document
+        query = queryset._query
+        key = (model, _count_generations.get(model, 0), json_util.dumps(query, sort_keys=True))
+        estimate = not query and current_app.config.get('ESTIMATE_UNFILTERED_COUNTS')
+        async_mongo = getattr(info.context, 'async_mongo', None)
+        if async_mongo:
+            total_count = count_cache.get(key)
+            if total_count is not None:
+                return total_count
+            return run_async(CountableConnection.count_async(async_mongo, model, query, estimate, key))
+        def count():
+            if estimate:
+                return model._get_collection().estimated_document_count(**with_max_time())
+            return model._get_collection().count_documents(query, **with_max_time())
+        return count_cache.get_or_load(key, count)
+
+    @staticmethod
+    async def count_async(async_mongo, model, query, estimate, key):
+        collection = async_mongo.collection(model)
+        if estimate:
+            total_count = await collection.estimated_document_count(**with_max_time())
+        else:
+            total_count = await collection.count_documents(query, **with_max_time())
+        count_cache.set(key, total_count)
+        return total_count
 
 class MongoengineMutationOptions(MutationOptions):
     """
@@ -73,6 +134,7 @@ class MongoengineCreateMutation(MongoengineMutation):
         # Send signal then create document
         signals.pre_create.send(model, document=document)
         document.save()
+        signals.post_create.send(model, document=document)
         return cls(ok=True, id=document.id)
 
 class MongoengineUpdateMutation(MongoengineMutation):
@@ -82,6 +144,10 @@ class MongoengineUpdateMutation(MongoengineMutation):
     A transform can additionally specify the 'path' attribute, which is a DocumentPath that is evaluated to change
     the operation receiver.
     The rest of the attributes are arguments to the operation.
+
+    Whenever possible, transforms are compiled into a single atomic Mongo update, so the document doesn't have to be
+    loaded and concurrent edits don't overwrite each other. Transforms that can't be compiled are applied to the
+    loaded document instead, which is then saved.
     """
     class Meta:
         abstract = True
@@ -94,13 +160,11 @@ class MongoengineUpdateMutation(MongoengineMutation):
         cls._meta.fields['ok'] = Field(Boolean)
     
     @classmethod
-    def mutate(cls, parent, info, id, transforms):
-
-        # Retrieve document using global ID
-        document = Node.get_node_from_global_id(info, id, only_type=cls._meta.type)
-        model = cls._meta.type._meta.model
-        receiver_lookup = {}
-
+    def parse_transforms(cls, transforms):
+        """
+        Parses transforms into (operator, path, args) tuples
+        """
+        parsed = []
         for transform in transforms:
             # Parse operation using operation registry
             op_name = transform.pop('op', None)
@@ -111,17 +175,8 @@ class MongoengineUpdateMutation(MongoengineMutation):
                 raise TypeError(f'Unknown operation \'{op_name}\'')
 
             # Parse path
-            # If path is specified, we try to lookup receiver using cache
-            # If not, we compile path and evaluate to find receiver
-            raw_path = transform.pop('path', '')
-            receiver = receiver_lookup.get(raw_path, None)
-            if not receiver:
-                path = DocumentPath(raw_path)
-                # Must fix field names
-                for level in path.levels:
-                    level.field = fix_field_name(level.field)
-                receiver = path.evaluate(document)
-                receiver_lookup[raw_path] = receiver
+            # Must fix field names
+            path = DocumentPath(transform.pop('path', ''), fix_field_name)
             
             # Remaining values are arguments
             # 'Fix' arguments depending on operation
@@ -133,16 +188,85 @@ class MongoengineUpdateMutation(MongoengineMutation):
                 args['data'] = fix_fields(args['data'])
             elif operator == operators.delete:
                 args['where'] = fix_fields(args['where'])
+            parsed.append((operator, path, args))
+        return parsed
+
+    @classmethod
+    def mutate(cls, parent, info, id, transforms):
+        model = cls._meta.type._meta.model
+        transforms = cls.parse_transforms(transforms)
+        # Signal receivers can use the state to collect changes across transforms
+        state = {}
+        try:
+            update = compile_transforms(model, transforms)
+        except CannotCompile:
+            update = None
+        if update:
+            document = cls.apply_update(info, id, update, transforms, state)
+        else:
+            document = cls.apply_transforms(info, id, transforms, state)
+        signals.post_update.send(model, document=document, state=state)
+        return cls(ok=True)
+
+    @classmethod
+    def apply_update(cls, info, id, update, transforms, state):
+        """
+        Runs a compiled update, returning the updated document
+        """
+        model = cls._meta.type._meta.model
+        _type, pk = Node.from_global_id(id)
+        if _type != cls._meta.type._meta.name:
+            raise model.DoesNotExist(f'Must receive a {cls._meta.type._meta.name} id')
+        pk = model._fields[model._meta['id_field']].to_python(pk)
+        # Send update signals
+        # There is no loaded document or receiver
+        for operator, path, args in transforms:
+            signals.pre_update.send(model, document=None, operator=operator, receiver=None, path=path, args=args, state=state)
+        query = dict(update.query, _id=pk)
+        son = model._get_collection().find_one_and_update(
+            query,
+            update.update,
+            array_filters=update.array_filters or None,
+            return_document=ReturnDocument.AFTER,
+            **with_max_time()
+        )
+        if son is None:
+            # Either the document doesn't exist or a transform selected something that doesn't exist
+            if not model.objects(pk=pk).count():
+                raise model.DoesNotExist(f'{model.__name__} \'{id}\' does not exist')
+            raise ValueError('Transform refers to a value that does not exist')
+        return model._from_son(son)
+
+    @classmethod
+    def apply_transforms(cls, info, id, transforms, state):
+        """
+        Loads the document, applies the transforms in Python, and saves the document
+        """
+        # Retrieve document using global ID
+        document = Node.get_node_from_global_id(info, id, only_type=cls._meta.type)
+        model = cls._meta.type._meta.model
+        receiver_lookup = {}
+        # Indices of embedded document lists, shared by every path
+        indexes = {}
+
+        for operator, path, args in transforms:
+            # If path has already been evaluated, we try to lookup receiver using cache
+            # If not, we evaluate path to find receiver
+            raw_path = path.string
+            receiver = receiver_lookup.get(raw_path, None)
+            if not receiver:
+                receiver = path.evaluate(document, indexes)
+                receiver_lookup[raw_path] = receiver
             
             # Send update signal
-            signals.pre_update.send(model, document=document, operator=operator, receiver=receiver, args=args)
+            signals.pre_update.send(model, document=document, operator=operator, receiver=receiver, path=path, args=args, state=state)
 
             # Apply transform
             operator(receiver, **args)
 
         # Save document to database
         document.save()
-        return cls(ok=True)
+        return document
 
 class MongoengineDeleteMutation(MongoengineMutation):
 
@@ -164,4 +288,5 @@ class MongoengineDeleteMutation(MongoengineMutation):
         model = cls._meta.type._meta.model
         signals.pre_delete.send(model, document=document)
         document.delete()
+        signals.post_delete.send(model, document=document)
         return cls(ok=True)
\ No newline at end of file
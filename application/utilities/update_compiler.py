@@ -0,0 +1,185 @@
+from mongoengine.fields import EmbeddedDocumentField, ListField
+from .document_path import FilterSelector, IndexSelector
+from . import operators
+
+class CannotCompile(Exception):
+    """
+    Raised when a list of transforms cannot be expressed as a single atomic update
+    """
+    pass
+
+def convert(field, value):
+    """
+    Validates a value for a field and converts it to its database representation
+    """
+    value = field.to_python(value)
+    field.validate(value)
+    return field.to_mongo(value)
+
+class Target:
+    """
+    Describes what a compiled path points to
+    'kind' is one of 'document', 'embedded_list', 'list', or 'value'.
+    For documents and embedded lists, 'type' is the document class. For lists, it is the element field.
+    'field' is the field holding the target, or None for the document itself and for list elements.
+    """
+
+    def __init__(self, kind, type, field=None):
+        self.kind = kind
+        self.type = type
+        self.field = field
+
+    @classmethod
+    def of_field(cls, field):
+        if isinstance(field, EmbeddedDocumentField):
+            return cls('document', field.document_type, field)
+        if isinstance(field, ListField):
+            if isinstance(field.field, EmbeddedDocumentField):
+                return cls('embedded_list', field.field.document_type, field)
+            return cls('list', field.field, field)
+        return cls('value', field, field)
+
+class CompiledUpdate:
+    """
+    An atomic Mongo update compiled from a list of transforms
+    'query' contains extra conditions that make the update fail (match nothing) in the same cases
+    where applying the transforms in Python would raise, like selecting a line that doesn't exist.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.query = {}
+        self.update = {}
+        self.array_filters = []
+        self._filter_names = {}
+        self._writes = []
+
+    def resolve(self, levels):
+        """
+        Translates a DocumentPath into a Mongo field path, returning the path and its target
+        Filter selectors become array filters, and index selectors become numeric path components.
+        """
+        target = Target('document', self.model)
+        path = []
+        has_placeholder = False
+        for level in levels:
+            if target.kind != 'document':
+                raise CannotCompile(f'Cannot select field \'{level.field}\'')
+            field = target.type._fields.get(level.field)
+            if field is None:
+                raise CannotCompile(f'Unknown field \'{level.field}\'')
+            path.append(field.db_field)
+            target = Target.of_field(field)
+            selector = level.selector
+            if selector is None:
+                continue
+            if target.kind not in ('list', 'embedded_list'):
+                raise CannotCompile(f'Cannot select from field \'{level.field}\'')
+            if isinstance(selector, IndexSelector):
+                if selector.index < 0:
+                    raise CannotCompile('Negative indices are not supported')
+                path.append(str(selector.index))
+                if not has_placeholder:
+                    # The element must exist, otherwise Mongo would pad the list
+                    self.query['.'.join(path)] = {'$exists': True}
+            elif isinstance(selector, FilterSelector):
+                if target.kind != 'embedded_list':
+                    raise CannotCompile(f'Cannot filter field \'{level.field}\'')
+                conditions = {}
+                for condition in selector:
+                    condition_field = target.type._fields.get(condition.key)
+                    if condition_field is None:
+                        raise CannotCompile(f'Unknown field \'{condition.key}\'')
+                    conditions[condition_field.db_field] = convert(condition_field, condition.value)
+                if not has_placeholder:
+                    # The element must exist, otherwise the update would silently do nothing
+                    self.query['.'.join(path)] = {'$elemMatch': conditions}
+                path.append(f'$[{self.get_filter_name(path, conditions)}]')
+                has_placeholder = True
+            if target.kind == 'embedded_list':
+                target = Target('document', target.type)
+            else:
+                target = Target.of_field(target.type)
+        return '.'.join(path), target, has_placeholder
+
+    def get_filter_name(self, path, conditions):
+        # Identical filters on the same list share a name
+        key = ('.'.join(path), tuple(sorted(conditions.items(), key=lambda item: item[0])))
+        name = self._filter_names.get(key)
+        if name is None:
+            name = f'f{len(self._filter_names)}'
+            self._filter_names[key] = name
+            self.array_filters.append({f'{name}.{k}': v for k, v in conditions.items()})
+        return name
+
+    def write(self, op, path):
+        """
+        Records that an update operator writes to a path
+        Mongo rejects updates that write to overlapping paths with different operators,
+        and combining them would change the order transforms are applied in, so we can't compile them.
+        """
+        for other_op, other_path in self._writes:
+            overlaps = (path == other_path or path.startswith(other_path + '.') or other_path.startswith(path + '.'))
+            if overlaps and (op != other_op or path != other_path):
+                raise CannotCompile(f'Conflicting updates to \'{path}\'')
+        self._writes.append((op, path))
+
+    def add_transform(self, operator, levels, args):
+        path, target, has_placeholder = self.resolve(levels)
+        if operator == operators.set:
+            if target.kind != 'document':
+                raise CannotCompile('Can only set fields of documents')
+            field = target.type._fields.get(args['field'])
+            if field is None or (field.primary_key and not path):
+                raise CannotCompile(f'Cannot set field \'{args["field"]}\'')
+            key = f'{path}.{field.db_field}' if path else field.db_field
+            if args['value'] is None:
+                # Saving a document unsets fields set to None, unless they are required (which fails validation)
+                if field.required:
+                    raise CannotCompile(f'Cannot unset required field \'{args["field"]}\'')
+                self.write('$unset', key)
+                self.update.setdefault('$unset', {})[key] = ''
+                return
+            self.write('$set', key)
+            self.update.setdefault('$set', {})[key] = convert(field, args['value'])
+        elif operator == operators.create:
+            if target.kind != 'embedded_list':
+                raise CannotCompile('Can only create documents in embedded document lists')
+            document = target.type(**args['data'])
+            document.validate()
+            self.write('$push', path)
+            self.update.setdefault('$push', {}).setdefault(path, {'$each': []})['$each'].append(document.to_mongo())
+        elif operator == operators.delete:
+            if target.kind != 'embedded_list':
+                raise CannotCompile('Can only delete documents from embedded document lists')
+            if target.field is not None and target.field.required:
+                # Deleting every document would fail validation
+                raise CannotCompile('Cannot delete from required lists')
+            conditions = {}
+            for key, value in args['where'].items():
+                field = target.type._fields.get(key)
+                if field is None:
+                    raise CannotCompile(f'Unknown field \'{key}\'')
+                conditions[field.db_field] = convert(field, value)
+            self.write('$pull', path)
+            self.update.setdefault('$pull', {}).setdefault(path, {'$or': []})['$or'].append(conditions)
+        elif operator in (operators.add, operators.remove):
+            # Lists can hold duplicates. '$pull' would remove every copy of a value rather than the first,
+            # and '$addToSet' would skip values already present, which receivers counting changes
+            # (like category reference counts) can't tell. So these are always applied in Python.
+            raise CannotCompile('Adding and removing list values is applied in Python')
+        else:
+            raise CannotCompile('Unknown operator')
+
+def compile_transforms(model, transforms):
+    """
+    Compiles a list of (operator, path, args) transforms into one atomic update
+    Raises CannotCompile if the transforms can't be expressed as a single update, including transforms that
+    could fail document validation (like unsetting a required field), which are left to the Python path.
+    """
+    update = CompiledUpdate(model)
+    for operator, path, args in transforms:
+        update.add_transform(operator, path.levels, args)
+    if not update.update:
+        raise CannotCompile('Nothing to update')
+    return update
@@ -8,9 +8,18 @@ from flask_jwt_extended import (
 )
 from flask_jwt_extended.exceptions import RevokedTokenError, UserLookupError
 from flask_graphql import GraphQLView
+from graphql_server import HttpQueryError, get_graphql_params, run_http_query, encode_execution_results
+from graphql.execution.executors.asyncio import AsyncioExecutor
+from promise import Promise
 from jwt.exceptions import InvalidTokenError
-from flask import current_app as app
+from flask import current_app as app, g, jsonify, request, Response
+import asyncio
+import json
+from functools import partial
 from .exceptions import InsufficientPrivilegeError
+from .models import User
+from .extensions import user_cache, document_cache, persisted_queries, response_cache, async_mongo, metrics
+from .utilities import CachedDocumentBackend, hash_query, count_cache, run_blocking
 from . import schema_loader
 
 class Context:
@@ -21,6 +30,18 @@ class Context:
 
     user = None
     attach_refresh_token = False
+    # Query budget of the user's role, chosen with the schema (see 'prepare_request')
+    query_budget = None
+    # Estimated cost of the operations executed so far, which share the query budget (see 'execute_within_budget')
+    query_cost = 0
+    # Set in ASGI mode, see 'handle_request_async'
+    async_mongo = None
+    # Whether any operation's result had errors (see 'CachedDocumentBackend')
+    has_errors = False
+
+    def __init__(self):
+        self.loaders = {}
+        self.full_user = None
     
     def verify_identity(self, refresh=False):
         locations = 'cookies' if refresh else None
@@ -32,6 +53,18 @@ class Context:
         except (RevokedTokenError, InvalidTokenError, UserLookupError):
             self.user = None
     
+    def get_full_user(self):
+        """
+        Returns the current user with every field loaded
+        Depending on 'USER_LOOKUP_AUTH_ONLY', the user loaded during authentication might only
+        include the fields required for authentication. The full user is loaded at most once per request.
+        """
+        if not self.user or not app.config['USER_LOOKUP_AUTH_ONLY']:
+            return self.user
+        if not self.full_user or self.full_user.id != self.user.id:
+            self.full_user = User.objects.with_id(self.user.id)
+        return self.full_user
+    
     def create_access_token(self):
         """
         Generates new access token for the current user
@@ -44,6 +77,19 @@ class Context:
         """
         return get_jwt()
     
+    def get_loader(self, loader_class, *args):
+        """
+        Returns the request-scoped instance of a DocumentLoader subclass
+        Loaders are created on first use so that every resolver in the request shares the same batch.
+        Additional arguments are passed to the loader, and loaders with different arguments are separate.
+        """
+        key = (loader_class, *args)
+        loader = self.loaders.get(key)
+        if not loader:
+            loader = loader_class(self, *args)
+            self.loaders[key] = loader
+        return loader
+    
     def has_perm(self, perm):
         """
         Whether the current user has a permission
@@ -62,19 +108,290 @@ class Context:
         if not self.has_perm(perm):
             raise InsufficientPrivilegeError()
 
-graphql = GraphQLView(graphiql=app.config["ENABLE_GRAPHIQL"])
+class PersistedQueryView(GraphQLView):
+    """
+    A GraphQL view that supports persisted queries
+    Clients can send the SHA-256 hash of a query in place of the query itself, using the same
+    'extensions.persistedQuery.sha256Hash' format as Apollo. If the hash is unknown, the client is asked
+    to send the full query along with the hash, which is then remembered for subsequent requests.
+    """
 
-@app.route('/', methods=['GET', 'POST', 'PUT', 'DELETE'])
-def handle_request():
+    def parse_body(self):
+        """
+        Returns the request body, with persisted queries resolved
+        The body is parsed once per request, and the result (or error) is reused by every step that needs it,
+        so persisted queries are only looked up and registered once.
+        """
+        parsed = g.get('graphql_body')
+        if parsed is None:
+            try:
+                parsed = (self.parse_new_body(), None)
+            except Exception as e:
+                parsed = (None, e)
+            g.graphql_body = parsed
+        data, error = parsed
+        if error is not None:
+            raise error
+        return data
+    
+    def parse_new_body(self):
+        data = super().parse_body()
+        if isinstance(data, list) and len(data) > app.config['MAX_BATCH_SIZE']:
+            raise HttpQueryError(400, f'Batches can have at most {app.config["MAX_BATCH_SIZE"]} operations')
+        if not app.config['ENABLE_PERSISTED_QUERIES']:
+            return data
+        if isinstance(data, list):
+            return [self.resolve_persisted_query(entry) for entry in data]
+        return self.resolve_persisted_query(data)
+    
+    def resolve_persisted_query(self, data):
+        # Invalid params are rejected by 'run_http_query'
+        if not isinstance(data, dict):
+            return data
+        extensions = data.get('extensions') or {}
+        if isinstance(extensions, str):
+            try:
+                extensions = json.loads(extensions)
+            except ValueError:
+                raise HttpQueryError(400, 'Extensions are invalid JSON.')
+        if not isinstance(extensions, dict):
+            raise HttpQueryError(400, 'Extensions should be an object.')
+        persisted = extensions.get('persistedQuery')
+        if not persisted:
+            return data
+        if not isinstance(persisted, dict) or not isinstance(persisted.get('sha256Hash'), str):
+            raise HttpQueryError(400, 'persistedQuery should be an object with a sha256Hash string.')
+        query_hash = persisted['sha256Hash']
+        query = data.get('query')
+        if query and not isinstance(query, str):
+            raise HttpQueryError(400, 'Query should be a string.')
+        if query:
+            # Remember query, making sure the hash is actually the hash of the query
+            if hash_query(query) != query_hash:
+                raise HttpQueryError(400, 'provided sha does not match query')
+            persisted_queries.set(query_hash, query)
+            return data
+        query = persisted_queries.get(query_hash)
+        if not query:
+            raise HttpQueryError(200, 'PersistedQueryNotFound')
+        data = dict(data)
+        data['query'] = query
+        return data
+
+    def is_batch(self):
+        try:
+            return isinstance(self.parse_body(), list)
+        except Exception:
+            return False
+
+    def get_cache_key(self, schema):
+        """
+        Returns the response cache key and the models the response depends on, or None if the request
+        can't be cached
+        Only single queries are cached. Anything else (including invalid requests) is left to 'dispatch_request'.
+        """
+        try:
+            data = self.parse_body()
+            if isinstance(data, list):
+                return None
+            params = get_graphql_params(data, request.args)
+            if not params.query:
+                return None
+            document = self.get_backend().document_from_string(schema, params.query)
+        except Exception:
+            return None
+        if document.get_operation_type(params.operation_name) != 'query':
+            return None
+        return response_cache.get_key(document, params.variables, params.operation_name)
+
+    async def dispatch_request_async(self, schema, context):
+        """
+        Executes a GraphQL request on the running event loop
+        Resolvers can return coroutines (or promises of them), which run concurrently.
+        GraphiQL isn't served in ASGI mode.
+        """
+        try:
+            data = self.parse_body()
+            execution_results, all_params = run_http_query(
+                schema,
+                request.method.lower(),
+                data,
+                query_data=request.args,
+                batch_enabled=self.batch,
+                backend=self.get_backend(),
+                context=context,
+                middleware=self.get_middleware(),
+                executor=AsyncioExecutor(loop=asyncio.get_running_loop()),
+                return_promise=True,
+            )
+            execution_results = [await result if Promise.is_thenable(result) else result for result in execution_results]
+            result, status_code = encode_execution_results(
+                execution_results,
+                is_batch=isinstance(data, list),
+                format_error=self.format_error,
+                encode=partial(self.encode, pretty=self.pretty or request.args.get('pretty')),
+            )
+            return Response(result, status=status_code, content_type='application/json')
+        except HttpQueryError as e:
+            return Response(
+                self.encode({'errors': [self.format_error(e)]}),
+                status=e.status_code,
+                headers=e.headers,
+                content_type='application/json',
+            )
+
+def cached_response(entry):
+    """
+    Creates a response for a cache entry
+    If the client already has the response, as indicated by 'If-None-Match', the body is left out.
+    """
+    if request.if_none_match.contains(entry.etag):
+        response = Response(status=304)
+    else:
+        response = Response(entry.body, content_type='application/json')
+    response.set_etag(entry.etag)
+    # Clients must revalidate, and responses differ for authenticated users
+    response.headers['Cache-Control'] = 'no-cache'
+    response.vary.add('Authorization')
+    return response
+
+graphql = PersistedQueryView(
+    graphiql=app.config["ENABLE_GRAPHIQL"],
+    # Check operations against the query budget of the user's role
+    backend=CachedDocumentBackend(
+        document_cache,
+        get_budget=lambda context: context.query_budget,
+        default_list_size=app.config['QUERY_COST_DEFAULT_LIST_SIZE'],
+    ),
+    # Time resolvers when collecting metrics
+    middleware=[metrics.middleware] if metrics.enabled else [],
+    # Clients can send an array of operations, which are executed with one context (see 'handle_request')
+    batch=app.config['ENABLE_BATCHING'],
+)
+
+def prepare_request(context):
+    """
+    Authenticates a request and chooses its schema and query budget
+    Both are chosen once, so an operation that changes the user (such as logging in) doesn't change them for
+    the rest of a batch.
+    Returns the schema, the response cache key (or None if the response can't be cached),
+    and the cached response, if there is one.
+    """
     # Use the access token to discern identity by default
-    context = Context()
     context.verify_identity()
     # Dynamically choose schema based on user authentication
     schema = schema_loader.load(context.user)
-    response = graphql.dispatch_request(schema=schema, context=context)
+    context.query_budget = schema_loader.load_budget(context.user)
+    # Anonymous queries don't depend on who is asking, so their responses can be cached
+    cache_key = None
+    if response_cache.enabled and not context.user:
+        cache_key = graphql.get_cache_key(schema)
+    if cache_key:
+        entry = response_cache.get(cache_key[0])
+        if entry:
+            return schema, cache_key, cached_response(entry)
+    return schema, cache_key, None
+
+def finish_request(context, cache_key, response):
+    # Don't cache errors, which might be temporary
+    if cache_key and response.status_code == 200 and not context.has_errors and response.mimetype == 'application/json':
+        key, models = cache_key
+        return cached_response(response_cache.set(key, response.get_data(), models))
     # If a refresh token was requested, create a refresh token
     # for the current user and attach it as a cookie
     if (context.attach_refresh_token):
         token = create_refresh_token(context.user)
         set_refresh_cookies(response, token)
-    return response
\ No newline at end of file
+    return response
+
+def get_schema_label(context):
+    return context.user.role.name.lower() if context.user else 'public'
+
+def get_query_hash():
+    """
+    Returns the hash of the requested query (for logging), or None if there isn't one
+    The hashes of a batch are separated by commas.
+    """
+    try:
+        data = graphql.parse_body()
+        if isinstance(data, list):
+            queries = [get_graphql_params(entry, {}).query for entry in data]
+        else:
+            queries = [get_graphql_params(data, request.args).query]
+    except Exception:
+        return None
+    return ','.join(hash_query(query) if query else 'none' for query in queries)
+
+def start_metrics():
+    request_metrics = metrics.start_request()
+    # Batches are labeled as a whole, rather than by their first operation
+    if request_metrics is not None and graphql.is_batch():
+        request_metrics.operation = 'batch'
+    return request_metrics
+
+@app.route('/', methods=['GET', 'POST', 'PUT', 'DELETE'])
+def handle_request():
+    """
+    Handles a GraphQL request
+    The request can also be a batch (an array of operations). The user is authenticated and the schema chosen once,
+    and the operations are executed in order with the same context, so they share loaders and the query budget.
+    Their results are returned as an array.
+    """
+    context = Context()
+    request_metrics = start_metrics()
+    try:
+        schema, cache_key, response = prepare_request(context)
+    except Exception:
+        metrics.cancel_request(request_metrics)
+        raise
+    if response is not None:
+        # Cached responses aren't recorded
+        metrics.cancel_request(request_metrics)
+        return response
+    try:
+        response = graphql.dispatch_request(schema=schema, context=context)
+    finally:
+        metrics.finish_request(request_metrics, get_schema_label(context), get_query_hash)
+    return finish_request(context, cache_key, response)
+
+async def handle_request_async():
+    """
+    Handles a GraphQL request in ASGI mode (see 'asgi.py')
+    Resolvers run on the event loop, so independent lookups run concurrently, and the hot resolvers
+    use the async driver. The operations of a batch also run concurrently, so their lookups are batched together.
+    """
+    context = Context()
+    if async_mongo.enabled:
+        context.async_mongo = async_mongo
+    request_metrics = start_metrics()
+    try:
+        # Authenticating can look up the user and sync the blocklist, so it runs in a worker thread
+        schema, cache_key, response = await run_blocking(prepare_request, context)
+    except Exception:
+        metrics.cancel_request(request_metrics)
+        raise
+    if response is not None:
+        metrics.cancel_request(request_metrics)
+        return response
+    try:
+        response = await graphql.dispatch_request_async(schema, context)
+    finally:
+        metrics.finish_request(request_metrics, get_schema_label(context), get_query_hash)
+    return finish_request(context, cache_key, response)
+
+if app.config['EXPOSE_METRICS']:
+    @app.route('/metrics', methods=['GET'])
+    def handle_metrics():
+        return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+if app.config['ENABLE_CACHE_STATS']:
+    @app.route('/stats', methods=['GET'])
+    def handle_stats():
+        # Expose cache hit rates for tuning cache sizes
+        return jsonify({
+            'documents': document_cache.stats(),
+            'persisted_queries': persisted_queries.stats(),
+            'users': user_cache.stats(),
+            'counts': count_cache.stats(),
+            'responses': response_cache.stats(),
+        })
\ No newline at end of file
@@ -0,0 +1,8 @@
+"""
+ASGI interface
+Run with an ASGI server, e.g. 'uvicorn asgi:application'
+"""
+
+from application import create_app
+from application.asgi import ASGIApp
+application = ASGIApp(create_app())
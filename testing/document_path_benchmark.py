@@ -0,0 +1,104 @@
+"""
+Micro-benchmark for DocumentPath parsing and evaluation
+Simulates editor sessions, where a client sends many update mutations for the same poem, each with hundreds of
+transforms targeting individual lines. The compiled paths are compared against the original implementation,
+which parsed every path and scanned the line list for every transform.
+Run with 'python -m testing.document_path_benchmark'.
+"""
+import argparse
+import random
+import time
+from pypeg2 import parse
+from application.models import Poem, PoemLine
+from application.utilities.document_path import DocumentPath, Path, compile_path
+from application.utilities.types import fix_field_name
+
+def legacy_evaluate(string, document):
+    # The original implementation: parse the path, fix field names, and walk the levels
+    levels = parse(string, Path)
+    for level in levels:
+        level.field = fix_field_name(level.field)
+    result = document
+    for level in levels:
+        result = result[level.field]
+        if level.selector:
+            result = level.selector.apply(result)
+    return result
+
+def compiled_evaluate(string, document, indexes):
+    return DocumentPath(string, fix_field_name).evaluate(document, indexes)
+
+def create_poem(num_lines):
+    lines = [PoemLine(order=i, text=f'Line {i}', key=['', '', '', '', '']) for i in range(num_lines)]
+    return Poem(title='Benchmark', lines=lines)
+
+def create_session(poem, num_mutations, num_transforms):
+    """
+    Creates the paths of each mutation in a session
+    Editors mostly edit lines, so most paths select a line by ID.
+    """
+    ids = [str(line.id) for line in poem.lines]
+    templates = ['lines[id={}]', 'lines[id={}].key', 'lines[{}]']
+    session = []
+    for _ in range(num_mutations):
+        paths = []
+        for _ in range(num_transforms):
+            template = random.choice(templates)
+            if template == 'lines[{}]':
+                paths.append(template.format(random.randrange(len(ids))))
+            else:
+                paths.append(template.format(random.choice(ids)))
+        session.append(paths)
+    return session
+
+def run_legacy(poem, session):
+    for paths in session:
+        for path in paths:
+            legacy_evaluate(path, poem)
+
+def run_compiled(poem, session):
+    for paths in session:
+        # Every mutation uses a fresh index cache, like MongoengineUpdateMutation
+        indexes = {}
+        for path in paths:
+            compiled_evaluate(path, poem, indexes)
+
+def measure(func, *args, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--lines', type=int, default=100, help='Number of lines in the poem')
+    parser.add_argument('--mutations', type=int, default=20, help='Number of mutations in a session')
+    parser.add_argument('--transforms', type=int, default=200, help='Number of transforms in a mutation')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of times each session is run')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    poem = create_poem(args.lines)
+    session = create_session(poem, args.mutations, args.transforms)
+    num_transforms = args.mutations * args.transforms
+
+    # Check that both implementations agree
+    indexes = {}
+    for path in session[0]:
+        assert legacy_evaluate(path, poem) is compiled_evaluate(path, poem, indexes), path
+
+    legacy = measure(run_legacy, poem, session, repeat=args.repeat)
+    compile_path.cache_clear()
+    cold = measure(run_compiled, poem, session, repeat=1)
+    warm = measure(run_compiled, poem, session, repeat=args.repeat)
+
+    print(f'{args.lines} lines, {args.mutations} mutations of {args.transforms} transforms')
+    for name, elapsed in [('legacy', legacy), ('compiled (cold)', cold), ('compiled (warm)', warm)]:
+        print(f'{name:>16}: {elapsed * 1000:8.1f} ms, {elapsed / num_transforms * 1e6:6.1f} us/transform, {legacy / elapsed:5.1f}x')
+    print(f'path cache: {compile_path.cache_info()}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,461 @@
+"""
+Load benchmark for the GraphQL hot paths
+Seeds a database with synthetic poems, collections, users and progress, then drives the real app (and schemas)
+through the Flask test client, one scenario at a time. Each scenario reports latency percentiles, throughput and the
+number of Mongo operations per request.
+By default, the database is an in-process stand-in (mongomock), which measures the server's own overhead.
+Use '--mongo-uri' to run against a local MongoDB instead (the benchmark database is dropped before seeding).
+Searching requires a real MongoDB, since mongomock doesn't support text indexes.
+Results can be saved as a baseline ('--save-baseline'), and later runs can be checked against it ('--check'),
+which fails if any scenario got slower, or made more Mongo operations, by more than the tolerance.
+Run with 'python -m testing.load_benchmark'.
+"""
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+from bson.objectid import ObjectId
+from graphql_relay import to_global_id
+from pymongo import monitoring
+from application.config_loader import for_mode
+from application.configs import ProductionConfig
+from application.utilities import encode_location
+
+MODE = 'benchmark'
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'load_baseline.json')
+PASSWORD = 'benchmark-password'
+WORDS = [
+    'autumn', 'river', 'silence', 'harbor', 'lantern', 'meadow', 'thunder', 'ember', 'willow', 'sparrow',
+    'granite', 'velvet', 'orchard', 'tide', 'cathedral', 'frost', 'hollow', 'marigold', 'compass', 'ivory',
+]
+SYMBOLS = ['u', '/']
+
+@for_mode(MODE)
+class BenchmarkConfig(ProductionConfig):
+    MONGO_DB = 'syllabits_benchmark'
+    CORS_ORIGINS = '*'
+    # Every request comes from the same address
+    LOGIN_IP_ATTEMPTS = None
+
+"""
+Counting Mongo operations
+"""
+
+class OperationCounter(monitoring.CommandListener):
+    """
+    Counts the Mongo commands sent by the app
+    MongoClients only notify listeners registered before they are created, so this must be registered first.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def started(self, event):
+        self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+# Collection methods counted when using mongomock, which doesn't support command monitoring
+MOCK_OPERATIONS = (
+    'find', 'find_one', 'find_one_and_update', 'aggregate', 'count_documents', 'estimated_document_count', 'distinct',
+    'insert_one', 'insert_many', 'update_one', 'update_many', 'replace_one', 'bulk_write', 'delete_one', 'delete_many',
+)
+
+def count_mock_operations(counter):
+    """
+    Counts the operations made through mongomock collections
+    Methods implemented using other methods (like 'find_one', which calls 'find') only count once.
+    """
+    from mongomock.collection import Collection
+    state = threading.local()
+    def wrap(method):
+        def wrapped(self, *args, **kwargs):
+            depth = getattr(state, 'depth', 0)
+            if not depth:
+                counter.count += 1
+            state.depth = depth + 1
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                state.depth = depth
+        return wrapped
+    for name in MOCK_OPERATIONS:
+        setattr(Collection, name, wrap(getattr(Collection, name)))
+
+"""
+Seeding
+"""
+
+class SeedData:
+    """
+    Describes the seeded documents, so scenarios can make valid requests
+    """
+
+    def __init__(self):
+        self.categories = []
+        self.poems = []
+        self.collections = []
+        self.users = []
+        self.editor = None
+        self.sessions = []
+        self.editor_session = None
+
+def create_poem(rng, categories, num_lines):
+    lines = []
+    for i in range(num_lines):
+        lines.append({
+            '_id': ObjectId(),
+            'order': i,
+            'text': ' '.join(rng.choices(WORDS, k=8)),
+            'key': rng.choices(SYMBOLS, k=5),
+        })
+    return {
+        '_id': ObjectId(),
+        'title': ' '.join(rng.choices(WORDS, k=3)).title(),
+        'author': rng.choice(WORDS).title(),
+        'categories': rng.sample(categories, rng.randint(1, min(3, len(categories)))),
+        'lines': lines,
+    }
+
+def insert(model, documents, batch_size=1000):
+    collection = model._get_collection()
+    for i in range(0, len(documents), batch_size):
+        collection.insert_many(documents[i:i + batch_size], ordered=False)
+
+def seed(args, rng, password_hashed):
+    """
+    Drops the benchmark database and fills it with synthetic documents
+    Every user has some saved, in-progress and completed poems, with progress for the latter two.
+    """
+    from mongoengine.connection import get_db
+    from application.models import Category, Poem, Collection, User, Progress, UserPoem, PoemState
+    from application.roles import Role
+    db = get_db()
+    db.client.drop_database(db.name)
+    data = SeedData()
+
+    data.categories = [f'category-{i}' for i in range(args.categories)]
+    poems = [create_poem(rng, data.categories, rng.randint(args.lines // 2, args.lines)) for _ in range(args.poems)]
+    insert(Poem, poems)
+    data.poems = [(poem['_id'], [(line['_id'], line['key']) for line in poem['lines']]) for poem in poems]
+    ref_counts = {}
+    for poem in poems:
+        for category in poem['categories']:
+            ref_counts[category] = ref_counts.get(category, 0) + 1
+    insert(Category, [{'_id': name, 'ref_count': count} for name, count in ref_counts.items()])
+
+    poem_ids = [poem['_id'] for poem in poems]
+    collections = []
+    for i in range(args.collections):
+        poems_in_collection = rng.sample(poem_ids, min(args.collection_size, len(poem_ids)))
+        collections.append({'_id': ObjectId(), 'title': f'Collection {i}', 'poems': poems_in_collection})
+    insert(Collection, collections)
+    data.collections = [(collection['_id'], len(collection['poems'])) for collection in collections]
+
+    users = []
+    progress = []
+    user_poems = []
+    lines_by_poem = dict(data.poems)
+    for i in range(args.users):
+        user_id = ObjectId()
+        played = rng.sample(poem_ids, min(args.progress * 2, len(poem_ids)))
+        in_progress, completed = played[:args.progress], played[args.progress:]
+        for poem_id in played:
+            location = encode_location({'t': 0, 'p': to_global_id('Poem', str(poem_id))})
+            state = PoemState.COMPLETED if poem_id in completed else PoemState.IN_PROGRESS
+            user_poems.append({'user': user_id, 'poem': poem_id, 'state': int(state), 'location': location})
+            lines = lines_by_poem[poem_id]
+            answered = lines if poem_id in completed else lines[:len(lines) // 2]
+            progress.append({
+                'user': user_id,
+                'poem': poem_id,
+                'lines': {str(line_id): {'answer': key, 'correct': True} for line_id, key in answered},
+                'num_correct': len(answered),
+            })
+        played_ids = set(played)
+        unplayed = [poem_id for poem_id in poem_ids if poem_id not in played_ids]
+        for poem_id in rng.sample(unplayed, min(args.progress, len(unplayed))):
+            user_poems.append({'user': user_id, 'poem': poem_id, 'state': int(PoemState.SAVED)})
+        users.append({
+            '_id': user_id,
+            'email': f'user{i}@benchmark.test',
+            'password_hashed': password_hashed,
+            'role': Role.USER.value,
+        })
+    editor = {
+        '_id': ObjectId(),
+        'email': 'editor@benchmark.test',
+        'password_hashed': password_hashed,
+        'role': Role.EDITOR.value,
+    }
+    insert(User, users + [editor])
+    insert(Progress, progress)
+    insert(UserPoem, user_poems)
+    data.users = [user['email'] for user in users]
+    data.editor = editor['email']
+    return data
+
+"""
+Scenarios
+Each scenario is a generator of (query, variables, token) requests. The result of each request is sent back,
+so scenarios can follow up on it (to fetch the next page, for instance).
+"""
+
+LOGIN = '''
+mutation Login($input: LoginInput!) {
+    login(input: $input) { ok result }
+}
+'''
+
+SUBMIT_LINE = '''
+mutation SubmitLine($input: SubmitLineInput!) {
+    submitLine(input: $input) { correct conflicts }
+}
+'''
+
+PLAY_POEM = '''
+mutation PlayPoem($location: String!) {
+    playPoem(location: $location) {
+        ok error next previous
+        poem { id title author lines { id text numFeet } progress { numCorrect } }
+    }
+}
+'''
+
+RANDOM_POEM = '''
+mutation RandomPoem($category: String) {
+    randomPoem(category: $category, excludeCompleted: true) { poem { id title } }
+}
+'''
+
+POEMS = '''
+query Poems($after: String, $search: String) {
+    poems(first: 20, after: $after, search: $search) {
+        edges { cursor node { id title author categories progress { numCorrect } } }
+        pageInfo { hasNextPage endCursor }
+    }
+}
+'''
+
+UPDATE_POEM = '''
+mutation UpdatePoem($id: ID, $transforms: [JSONString]) {
+    updatePoem(id: $id, transforms: $transforms) { ok }
+}
+'''
+
+def submit_line(data, rng):
+    while True:
+        poem_id, lines = rng.choice(data.poems)
+        line_id, key = rng.choice(lines)
+        # About half of the answers are correct
+        answer = list(key) if rng.random() < 0.5 else rng.choices(SYMBOLS, k=len(key))
+        variables = {'input': {'poemID': to_global_id('Poem', str(poem_id)), 'lineID': str(line_id), 'answer': answer}}
+        yield SUBMIT_LINE, variables, rng.choice(data.sessions)
+
+def play_poem(data, rng):
+    while True:
+        # Most poems are played through collections
+        if rng.random() < 0.75:
+            collection_id, size = rng.choice(data.collections)
+            location = {'t': 1, 'c': to_global_id('Collection', str(collection_id)), 'i': rng.randrange(size)}
+        else:
+            poem_id, lines = rng.choice(data.poems)
+            location = {'t': 0, 'p': to_global_id('Poem', str(poem_id))}
+        yield PLAY_POEM, {'location': encode_location(location)}, rng.choice(data.sessions)
+
+def random_poem(data, rng):
+    while True:
+        category = rng.choice(data.categories) if rng.random() < 0.5 else None
+        yield RANDOM_POEM, {'category': category}, rng.choice(data.sessions)
+
+def poems(data, rng):
+    # Page through the poems, starting over at the end
+    token = rng.choice(data.sessions)
+    after = None
+    while True:
+        result = yield POEMS, {'after': after}, token
+        page_info = result['data']['poems']['pageInfo']
+        after = page_info['endCursor'] if page_info['hasNextPage'] else None
+        if after is None:
+            token = rng.choice(data.sessions)
+
+def search_poems(data, rng):
+    while True:
+        yield POEMS, {'search': rng.choice(WORDS)}, rng.choice(data.sessions)
+
+def login(data, rng):
+    while True:
+        yield LOGIN, {'input': {'email': rng.choice(data.users), 'password': PASSWORD}}, None
+
+def update_poem(data, rng):
+    while True:
+        poem_id, lines = rng.choice(data.poems)
+        # Index paths work with mongomock, which doesn't support array filters
+        transform = {'op': 'set', 'path': f'lines[{rng.randrange(len(lines))}]', 'field': 'text', 'value': ' '.join(rng.choices(WORDS, k=8))}
+        variables = {'id': to_global_id('Poem', str(poem_id)), 'transforms': [json.dumps(transform)]}
+        yield UPDATE_POEM, variables, data.editor_session
+
+# Scenarios, and whether they require a real MongoDB
+SCENARIOS = {
+    'submit_line': (submit_line, False),
+    'play_poem': (play_poem, False),
+    'random_poem': (random_poem, False),
+    'poems': (poems, False),
+    'search_poems': (search_poems, True),
+    'login': (login, False),
+    'update_poem': (update_poem, False),
+}
+
+"""
+Running
+"""
+
+class BenchmarkError(Exception):
+    pass
+
+def execute(client, query, variables, token):
+    headers = {'Authorization': token} if token else {}
+    response = client.post('/', json={'query': query, 'variables': variables}, headers=headers)
+    result = response.get_json()
+    if response.status_code != 200 or not result or result.get('errors'):
+        raise BenchmarkError(f'Request failed ({response.status_code}): {response.get_data(as_text=True)[:500]}')
+    return result
+
+def log_in(client, email):
+    result = execute(client, LOGIN, {'input': {'email': email, 'password': PASSWORD}}, None)
+    if not result['data']['login']['ok']:
+        raise BenchmarkError(f'Could not log in as {email}')
+    return result['data']['login']['result']
+
+def percentile(values, p):
+    # Nearest-rank percentile of sorted values
+    return values[max(0, min(len(values) - 1, math.ceil(p / 100 * len(values)) - 1))]
+
+def run_scenario(client, counter, scenario, data, rng, num_requests, warmup):
+    requests = scenario(data, rng)
+    request = next(requests)
+    latencies = []
+    for i in range(warmup + num_requests):
+        if i == warmup:
+            counter.count = 0
+            started = time.perf_counter()
+        request_started = time.perf_counter()
+        result = execute(client, *request)
+        if i >= warmup:
+            latencies.append(time.perf_counter() - request_started)
+        request = requests.send(result)
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'rps': num_requests / elapsed,
+        'ops': counter.count / num_requests,
+    }
+
+def compare(results, baseline, tolerance):
+    """
+    Returns descriptions of the results that regressed compared to a baseline
+    Latency is compared at the median and the 95th percentile, since the 99th is too noisy for small runs.
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        for metric in ('p50_ms', 'p95_ms', 'ops'):
+            if result[metric] > base[metric] * (1 + tolerance) + 1e-9:
+                regressions.append(f'{name}: {metric} {result[metric]:.2f} > {base[metric]:.2f} (+{tolerance:.0%})')
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--mongo-uri', default='mongomock://localhost', help='Database to seed (dropped first!)')
+    parser.add_argument('--poems', type=int, default=2000, help='Number of poems')
+    parser.add_argument('--lines', type=int, default=24, help='Maximum number of lines per poem')
+    parser.add_argument('--categories', type=int, default=20, help='Number of categories')
+    parser.add_argument('--collections', type=int, default=50, help='Number of collections')
+    parser.add_argument('--collection-size', type=int, default=30, help='Number of poems per collection')
+    parser.add_argument('--users', type=int, default=500, help='Number of users')
+    parser.add_argument('--progress', type=int, default=20, help='Number of in-progress (and completed) poems per user')
+    parser.add_argument('--sessions', type=int, default=20, help='Number of users making requests')
+    parser.add_argument('--requests', type=int, default=300, help='Number of measured requests per scenario')
+    parser.add_argument('--login-requests', type=int, default=20, help='Number of measured logins (dominated by bcrypt)')
+    parser.add_argument('--warmup', type=int, default=20, help='Number of unmeasured requests per scenario')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS, help='Scenario to run (default: all)')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='Baseline file')
+    parser.add_argument('--save-baseline', action='store_true', help='Save the results as the baseline')
+    parser.add_argument('--check', action='store_true', help='Fail if results regressed compared to the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed regression, as a fraction of the baseline')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    mock = args.mongo_uri.startswith('mongomock://')
+    counter = OperationCounter()
+    if mock:
+        count_mock_operations(counter)
+        # mongomock doesn't support server-side time limits
+        BenchmarkConfig.MONGO_MAX_TIME_MS = None
+    else:
+        monitoring.register(counter)
+    BenchmarkConfig.MONGO_URI = args.mongo_uri
+    os.environ['SYLLABITS_MODE'] = MODE
+    os.environ.setdefault('SYLLABITS_SECRET_KEY', 'benchmark-secret-key')
+
+    from application import create_app
+    from application.extensions import bcrypt
+    app = create_app()
+    client = app.test_client()
+    rng = random.Random(args.seed)
+    with app.app_context():
+        # Every user has the same password, so it's only hashed once
+        password_hashed = bcrypt.generate_password_hash(PASSWORD).decode('utf-8')
+        started = time.perf_counter()
+        data = seed(args, rng, password_hashed)
+    print(f'Seeded {args.poems} poems, {args.collections} collections and {args.users} users '
+        f'in {time.perf_counter() - started:.1f} s ({"mongomock" if mock else args.mongo_uri})')
+    data.sessions = [log_in(client, email) for email in rng.sample(data.users, min(args.sessions, len(data.users)))]
+    data.editor_session = log_in(client, data.editor)
+
+    scale = {name: getattr(args, name) for name in ('poems', 'lines', 'categories', 'collections', 'collection_size', 'users', 'progress', 'seed')}
+    scale['mongomock'] = mock
+    results = {}
+    print(f'{"scenario":>14} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"req/s":>9} {"ops/req":>8}')
+    for name in args.scenario or SCENARIOS:
+        scenario, requires_mongo = SCENARIOS[name]
+        if requires_mongo and mock:
+            print(f'{name:>14} skipped (requires MongoDB)')
+            continue
+        num_requests = args.login_requests if name == 'login' else args.requests
+        result = run_scenario(client, counter, scenario, data, rng, num_requests, args.warmup)
+        results[name] = result
+        print(f'{name:>14} {result["p50_ms"]:9.2f} {result["p95_ms"]:9.2f} {result["p99_ms"]:9.2f} {result["rps"]:9.1f} {result["ops"]:8.2f}')
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump({'scale': scale, 'results': results}, file, indent=4, sort_keys=True)
+        print(f'Saved baseline to {args.baseline}')
+    if args.check:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if baseline['scale'] != scale:
+            print('Baseline was recorded at a different scale, run with the same options or save a new baseline')
+            sys.exit(2)
+        regressions = compare(results, baseline['results'], args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            sys.exit(1)
+        print('No regressions')
+
+if __name__ == '__main__':
+    main()
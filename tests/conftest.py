@@ -0,0 +1,4 @@
+import mongoengine
+
+# Tests run against an in-process mock database
+mongoengine.connect('test', host='mongomock://localhost')
@@ -0,0 +1,45 @@
+from threading import Event
+import pytest
+from flask_bcrypt import Bcrypt
+from application.exceptions import ServerBusyError
+from application.utilities import PasswordHasher
+
+def create_hasher(workers=1, queue_size=1, rounds=4):
+    hasher = PasswordHasher(Bcrypt())
+    hasher.workers = workers
+    hasher.queue_size = queue_size
+    hasher.rounds = rounds
+    hasher.init_app(type('App', (), {'config': {}}))
+    return hasher
+
+def test_hash_and_check():
+    hasher = create_hasher()
+    hashed = hasher.hash('secret').result()
+    assert hasher.check(hashed, 'secret').result()
+    assert not hasher.check(hashed, 'wrong').result()
+
+def test_needs_rehash():
+    hasher = create_hasher(rounds=4)
+    hashed = hasher.hash('secret').result()
+    assert not hasher.needs_rehash(hashed)
+    hasher.rounds = 5
+    assert hasher.needs_rehash(hashed)
+    assert not hasher.needs_rehash('not a hash')
+
+def test_rejects_when_full():
+    hasher = create_hasher(workers=1, queue_size=1)
+    release = Event()
+    running = [hasher._submit(release.wait) for _ in range(2)]
+    with pytest.raises(ServerBusyError):
+        hasher.hash('secret')
+    release.set()
+    for future in running:
+        future.result()
+
+def test_rehash():
+    hasher = create_hasher()
+    saved = Event()
+    hashes = []
+    hasher.rehash('secret', lambda hashed: (hashes.append(hashed), saved.set()))
+    assert saved.wait(5)
+    assert hasher.check(hashes[0], 'secret').result()
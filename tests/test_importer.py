@@ -0,0 +1,40 @@
+import io
+import pytest
+from bson.objectid import ObjectId
+from application.importer import read_records, assign_ids, batched
+
+def read(text, chunk_size=4):
+    return list(read_records(io.StringIO(text), chunk_size=chunk_size))
+
+def test_read_json_array():
+    assert read('[{"a": 1}, {"b": [1, 2]},\n {"c": "]"}]') == [{'a': 1}, {'b': [1, 2]}, {'c': ']'}]
+
+def test_read_json_lines():
+    assert read('{"a": 1}\n{"a": 2}\r\n\n{"a": 3}\n') == [{'a': 1}, {'a': 2}, {'a': 3}]
+
+def test_read_records_across_chunks():
+    records = [{'title': 'x' * 50, 'lines': list(range(20))} for _ in range(5)]
+    text = '\n'.join('{"title": "%s", "lines": %s}' % (record['title'], record['lines']) for record in records)
+    assert read(text, chunk_size=7) == records
+
+def test_read_empty():
+    assert read('') == []
+    assert read('[]') == []
+
+def test_read_truncated():
+    with pytest.raises(ValueError):
+        read('[{"a": 1}, {"a": ')
+
+def test_assign_ids():
+    seed = ObjectId()
+    records = [{}, {'_id': 'kept'}, {}]
+    first = [record['_id'] for record in assign_ids([dict(record) for record in records], seed, 10)]
+    again = [record['_id'] for record in assign_ids([dict(record) for record in records], seed, 10)]
+    # Resuming assigns the same IDs
+    assert first == again
+    assert first[1] == 'kept'
+    assert first[0] < first[2]
+    assert first[0].generation_time == seed.generation_time
+
+def test_batched():
+    assert list(batched(range(5), 2)) == [[0, 1], [2, 3], [4]]
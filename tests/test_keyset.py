@@ -0,0 +1,86 @@
+import base64
+import mongoengine
+from bson import ObjectId
+from flask import Flask
+from graphene import Node, ObjectType, Schema
+from graphene_mongo import MongoengineObjectType
+from application.utilities import CountableConnection, KeysetConnectionField
+from application.utilities.keyset import encode_cursor, decode_cursor
+from application.utilities.projection import ProjectionQuerySet
+
+class Thing(mongoengine.Document):
+    name = mongoengine.StringField()
+    meta = {'queryset_class': ProjectionQuerySet}
+
+class ThingType(MongoengineObjectType):
+    class Meta:
+        model = Thing
+        interfaces = (Node,)
+        connection_class = CountableConnection
+
+class SelfCountingConnectionField(KeysetConnectionField):
+    def create_connection(self, *args):
+        connection = super().create_connection(*args)
+        connection.get_total_count = lambda: Thing.objects.count()
+        return connection
+
+class Query(ObjectType):
+    things = KeysetConnectionField(ThingType)
+    counted_things = SelfCountingConnectionField(ThingType)
+
+schema = Schema(query=Query)
+
+def setup_function():
+    Thing.objects.delete()
+    for i in range(5):
+        Thing(name=str(i)).save()
+
+def get_page(arguments):
+    result = schema.execute('{ things(%s) { edges { cursor node { name } } } }' % arguments)
+    assert result.errors is None
+    edges = result.data['things']['edges']
+    return [edge['node']['name'] for edge in edges], [edge['cursor'] for edge in edges]
+
+def test_cursor_round_trip():
+    key = [1.5, ObjectId()]
+    assert decode_cursor(encode_cursor(key)) == key
+
+def test_decode_offset_cursor():
+    offset_cursor = base64.b64encode(b'arrayconnection:3').decode('ascii')
+    assert decode_cursor(offset_cursor) is None
+    assert decode_cursor('not a cursor!') is None
+
+def test_offset_by_default():
+    names, cursors = get_page('first: 2')
+    assert names == ['0', '1']
+    assert all(decode_cursor(cursor) is None for cursor in cursors)
+    names, _ = get_page(f'first: 2, after: "{cursors[-1]}"')
+    assert names == ['2', '3']
+
+def test_keyset_opt_in():
+    names, cursors = get_page('first: 2, keyset: true')
+    assert names == ['0', '1']
+    assert all(decode_cursor(cursor) is not None for cursor in cursors)
+    # Keyset cursors keep using keyset pagination
+    names, _ = get_page(f'first: 2, after: "{cursors[-1]}"')
+    assert names == ['2', '3']
+
+def test_search_pipeline_projection():
+    field = Query._meta.fields['things']
+    pipeline = field.get_search_pipeline(Thing.objects.only('name'), None, 2)
+    assert pipeline[-1] == {'$project': {'name': 1, '_score': 1}}
+    pipeline = field.get_search_pipeline(Thing.objects.exclude('name'), None, 2)
+    assert all('$project' not in stage for stage in pipeline)
+
+def test_self_counting_connections():
+    def count(field):
+        with Flask(__name__).app_context():
+            result = schema.execute('{ %s(keyset: true) { totalCount } }' % field)
+        assert result.errors is None
+        return result.data[field]['totalCount']
+    assert count('things') == 5
+    assert count('countedThings') == 5
+    # Written without the mutation signals, so only connections counting themselves see it
+    Thing(name='5').save()
+    assert count('things') == 5
+    assert count('countedThings') == 6
@@ -0,0 +1,43 @@
+from unittest import mock
+from application.utilities import AttemptLimiter
+
+def test_limits_attempts():
+    limiter = AttemptLimiter('TEST', attempts=3, window=60)
+    assert [limiter.attempt('a') for _ in range(4)] == [True, True, True, False]
+    # Keys are limited separately
+    assert limiter.attempt('b')
+
+def test_window_expires():
+    limiter = AttemptLimiter('TEST', attempts=1, window=60)
+    with mock.patch('time.monotonic', return_value=100):
+        assert limiter.attempt('a')
+        assert not limiter.attempt('a')
+    with mock.patch('time.monotonic', return_value=161):
+        assert limiter.attempt('a')
+
+def test_reset():
+    limiter = AttemptLimiter('TEST', attempts=1, window=60)
+    assert limiter.attempt('a')
+    limiter.reset('a')
+    assert limiter.attempt('a')
+
+def test_unlimited():
+    limiter = AttemptLimiter('TEST', attempts=None)
+    assert all(limiter.attempt('a') for _ in range(100))
+
+def test_evicts_least_recently_used_keys():
+    limiter = AttemptLimiter('TEST', attempts=1, window=60, size=2)
+    limiter.attempt('a')
+    limiter.attempt('b')
+    limiter.attempt('c')
+    # 'a' was evicted, so it starts over
+    assert limiter.attempt('a')
+    assert not limiter.attempt('c')
+
+def test_init_app():
+    limiter = AttemptLimiter('TEST', attempts=1, window=60)
+    limiter.attempt('a')
+    app = mock.Mock(config={'TEST_ATTEMPTS': 5, 'TEST_WINDOW': 10})
+    limiter.init_app(app)
+    assert (limiter.attempts, limiter.window) == (5, 10)
+    assert limiter.attempt('a')
@@ -0,0 +1,55 @@
+from types import SimpleNamespace
+from bson.objectid import ObjectId
+from application.models import UserPoem, PoemState
+from application.utilities import DocumentPageLoader, DocumentCountLoader
+
+class CompletedLoader(DocumentPageLoader):
+    model = UserPoem
+    field = 'user'
+    fields = ('poem',)
+    order = ('poem',)
+
+    def get_queryset(self):
+        return UserPoem.objects(state=PoemState.COMPLETED)
+
+class CompletedCountLoader(DocumentCountLoader):
+    model = UserPoem
+    field = 'user'
+
+    def get_queryset(self):
+        return UserPoem.objects(state=PoemState.COMPLETED)
+
+def setup_function():
+    UserPoem.objects.delete()
+
+def create_entries(num_users, num_poems):
+    users = [ObjectId() for _ in range(num_users)]
+    poems = sorted(ObjectId() for _ in range(num_poems))
+    entries = []
+    for user in users:
+        for poem in poems:
+            entries.append({'user': user, 'poem': poem, 'state': int(PoemState.COMPLETED)})
+        entries.append({'user': user, 'poem': ObjectId(), 'state': int(PoemState.IN_PROGRESS)})
+    UserPoem._get_collection().insert_many(entries)
+    return users, poems
+
+def load(loader, keys):
+    return loader.load_many(keys).get()
+
+def test_single_key():
+    users, poems = create_entries(2, 5)
+    pages = load(CompletedLoader(SimpleNamespace(), limit=3), users[:1])
+    assert [data['poem'] for data in pages[0]] == poems[:3]
+
+def test_many_keys():
+    users, poems = create_entries(3, 5)
+    missing = ObjectId()
+    pages = load(CompletedLoader(SimpleNamespace(), limit=2), users + [missing])
+    assert [[data['poem'] for data in page] for page in pages] == [poems[:2]] * 3 + [[]]
+    pages = load(CompletedLoader(SimpleNamespace()), users)
+    assert [[data['poem'] for data in page] for page in pages] == [poems] * 3
+
+def test_counts():
+    users, poems = create_entries(3, 4)
+    missing = ObjectId()
+    assert load(CompletedCountLoader(SimpleNamespace()), users + [missing]) == [4, 4, 4, 0]
@@ -0,0 +1,57 @@
+from collections import Counter
+from types import SimpleNamespace
+from bson.objectid import ObjectId
+from application.models import Poem
+from application.utilities import IdPool, PoemPool
+
+def test_add_and_remove():
+    pool = IdPool([1, 2, 3])
+    pool.add(2)
+    assert len(pool) == 3
+    pool.remove(1)
+    pool.remove(4)
+    assert len(pool) == 2
+    assert 1 not in pool and 2 in pool and 3 in pool
+    # The removed slot was filled, so every remaining ID can still be chosen
+    assert {pool.choice() for _ in range(100)} == {2, 3}
+
+def test_remove_last():
+    pool = IdPool([1, 2])
+    pool.remove(2)
+    pool.remove(1)
+    assert len(pool) == 0
+    assert pool.choice() is None
+
+def test_choice_excludes():
+    pool = IdPool(range(10))
+    assert {pool.choice(exclude={0, 1, 2}) for _ in range(200)} == set(range(3, 10))
+
+def test_choice_falls_back_when_mostly_excluded():
+    pool = IdPool(range(1000))
+    exclude = set(range(999))
+    assert all(pool.choice(exclude=exclude) == 999 for _ in range(20))
+    assert pool.choice(exclude=set(range(1000))) is None
+
+def test_choice_is_uniform():
+    pool = IdPool(range(4))
+    counts = Counter(pool.choice() for _ in range(4000))
+    assert all(800 < count < 1200 for count in counts.values())
+
+def test_poem_pool():
+    Poem.objects.delete()
+    ids = [ObjectId() for _ in range(3)]
+    Poem._get_collection().insert_many([
+        {'_id': ids[0], 'categories': ['a']},
+        {'_id': ids[1], 'categories': ['a', 'b']},
+        {'_id': ids[2]},
+    ])
+    pool = PoemPool(Poem)
+    assert pool.choose(category='b') == ids[1]
+    assert pool.choose(category='c') is None
+    assert pool.choose(exclude=set(ids[:2])) == ids[2]
+    # Poems are kept current by signals
+    pool.add(SimpleNamespace(id=ids[2], categories=['b']))
+    assert {pool.choose(category='b') for _ in range(50)} == {ids[1], ids[2]}
+    pool.remove(SimpleNamespace(id=ids[1]))
+    assert pool.choose(category='b') == ids[2]
+    assert pool.choose(category='a') == ids[0]
@@ -0,0 +1,97 @@
+from threading import Event, Thread
+from bson.objectid import ObjectId
+from application.models import Progress, UserPoem, PoemState
+from application.utilities import ProgressBuffer
+
+def setup_function():
+    Progress.objects.delete()
+    UserPoem.objects.delete()
+
+def get_state(user_id, poem_id):
+    data = UserPoem._get_collection().find_one({'user': user_id, 'poem': poem_id})
+    return data and data.get('state')
+
+def test_submit_writes_progress_and_state():
+    buffer = ProgressBuffer(Progress, UserPoem)
+    user_id, poem_id = ObjectId(), ObjectId()
+    buffer.submit(user_id, poem_id, 'a', ['x'], True, 2)
+    assert get_state(user_id, poem_id) == PoemState.IN_PROGRESS
+    buffer.submit(user_id, poem_id, 'b', ['y'], True, 2)
+    progress = Progress._get_collection().find_one({'user': user_id, 'poem': poem_id})
+    assert progress['num_correct'] == 2
+    assert get_state(user_id, poem_id) == PoemState.COMPLETED
+
+def test_write_behind_coalesces():
+    buffer = ProgressBuffer(Progress, UserPoem)
+    buffer.write_behind = True
+    buffer._ensure_started = lambda: None
+    user_id, poem_id = ObjectId(), ObjectId()
+    buffer.submit(user_id, poem_id, 'a', ['x'], False, 2)
+    buffer.submit(user_id, poem_id, 'a', ['y'], True, 2)
+    assert Progress.objects.count() == 0
+    assert buffer.flush_user(user_id)
+    progress = Progress._get_collection().find_one({'user': user_id, 'poem': poem_id})
+    assert progress['lines']['a'] == {'answer': ['y'], 'correct': True}
+    assert not buffer.flush()
+
+def test_reset_waits_for_flush_in_progress():
+    buffer = ProgressBuffer(Progress, UserPoem)
+    buffer.write_behind = True
+    buffer._ensure_started = lambda: None
+    user_id, poem_id = ObjectId(), ObjectId()
+    buffer.submit(user_id, poem_id, 'a', ['x'], True, 1)
+    writing = Event()
+    release = Event()
+    write = buffer._write
+    def slow_write(pending):
+        writing.set()
+        release.wait(5)
+        write(pending)
+    buffer._write = slow_write
+    flusher = Thread(target=buffer.flush)
+    flusher.start()
+    assert writing.wait(5)
+    def reset():
+        Progress.objects(user=user_id, poem=poem_id).delete()
+        UserPoem.objects(user=user_id, poem=poem_id).update(unset__state=True)
+    resetter = Thread(target=buffer.reset, args=(user_id, poem_id, reset))
+    resetter.start()
+    release.set()
+    flusher.join(5)
+    resetter.join(5)
+    # The reset ran after the flush, so the flushed progress is gone
+    assert Progress.objects(user=user_id, poem=poem_id).count() == 0
+    assert get_state(user_id, poem_id) is None
+
+def test_resubmitting_lines_keeps_count():
+    buffer = ProgressBuffer(Progress, UserPoem)
+    user_id, poem_id = ObjectId(), ObjectId()
+    buffer.submit(user_id, poem_id, 'a', ['x'], True, 2)
+    buffer.submit(user_id, poem_id, 'a', ['x'], True, 2)
+    progress = Progress._get_collection().find_one({'user': user_id, 'poem': poem_id})
+    assert progress['num_correct'] == 1
+    assert get_state(user_id, poem_id) == PoemState.IN_PROGRESS
+    buffer.submit(user_id, poem_id, 'a', ['y'], False, 2)
+    progress = Progress._get_collection().find_one({'user': user_id, 'poem': poem_id})
+    assert progress['num_correct'] == 0
+
+def test_reset_does_not_block_other_keys():
+    buffer = ProgressBuffer(Progress, UserPoem)
+    user_id, poem_id, other_user_id = ObjectId(), ObjectId(), ObjectId()
+    resetting = Event()
+    release = Event()
+    def reset():
+        resetting.set()
+        release.wait(5)
+        Progress.objects(user=user_id, poem=poem_id).delete()
+    resetter = Thread(target=buffer.reset, args=(user_id, poem_id, reset))
+    resetter.start()
+    assert resetting.wait(5)
+    # Other users are written while the reset runs, but the reset key is held back until it finishes
+    buffer.submit(other_user_id, poem_id, 'a', ['x'], True, 2)
+    buffer.submit(user_id, poem_id, 'a', ['x'], True, 2)
+    assert Progress.objects(user=other_user_id).count() == 1
+    assert Progress.objects(user=user_id).count() == 0
+    release.set()
+    resetter.join(5)
+    assert Progress.objects(user=user_id, poem=poem_id).count() == 1
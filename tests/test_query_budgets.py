@@ -0,0 +1,90 @@
+import pytest
+from graphql import parse, validate
+from application import schema_loader
+from application.configs import BaseConfig
+from application.roles import Role
+from application.utilities.query_cost import CostAnalysis, check_budget
+
+# The queries the frontend makes when loading its pages, with the schemas of the roles that make them
+COLLECTIONS = '''
+{
+    collections {
+        edges { node { id title poems { edges { node { id title progress { numCorrect } } } } } }
+    }
+}
+'''
+
+POEMS = '''
+query Poems($after: String, $search: String) {
+    poems(first: 20, after: $after, search: $search) {
+        totalCount
+        edges { cursor node { id title author categories numLines progress { numCorrect } location } }
+        pageInfo { hasNextPage endCursor }
+    }
+}
+'''
+
+CATEGORIES = '''
+{
+    categories { edges { node { id name refCount } } }
+}
+'''
+
+PLAY_POEM = '''
+mutation PlayPoem($location: String!) {
+    playPoem(location: $location) {
+        ok error next previous
+        poem { id title author categories lines { id order text numFeet stanzaBreak } progress { numCorrect } }
+    }
+}
+'''
+
+PROFILE = '''
+{
+    me {
+        email
+        saved { totalCount edges { node { id title author } } }
+        inProgress { totalCount edges { node { id title author numLines progress { numCorrect } } } }
+        completed { totalCount edges { node { id title author numLines } } }
+        locations
+    }
+    recommendedPoems { id title author }
+}
+'''
+
+USERS = '''
+{
+    users(first: 50) { totalCount edges { node { id email role } } pageInfo { hasNextPage endCursor } }
+}
+'''
+
+PAGES = {
+    'collections': (COLLECTIONS, [None, Role.USER]),
+    'poems': (POEMS, [None, Role.USER]),
+    'categories': (CATEGORIES, [None, Role.USER]),
+    'play_poem': (PLAY_POEM, [None, Role.USER]),
+    'profile': (PROFILE, [Role.USER]),
+    'users': (USERS, [Role.ADMIN]),
+}
+CASES = [(query, role) for query, roles in PAGES.values() for role in roles]
+CASE_IDS = [f'{name}-{role.name if role else "public"}' for name, (query, roles) in PAGES.items() for role in roles]
+
+class User:
+    def __init__(self, role):
+        self.role = role
+
+@pytest.fixture(scope='module')
+def schemas():
+    # Building the schemas registers them with the schema loader
+    from application.schemas import public_schema, user_schema, editor_schema, admin_schema
+    schema_loader.use_budgets(BaseConfig.QUERY_BUDGETS)
+    return {None: public_schema, Role.USER: user_schema, Role.EDITOR: editor_schema, Role.ADMIN: admin_schema}
+
+@pytest.mark.parametrize('query, role', CASES, ids=CASE_IDS)
+def test_page_queries_are_within_budget(schemas, query, role):
+    schema = schemas[role]
+    document_ast = parse(query)
+    assert validate(schema, document_ast) == []
+    analysis = CostAnalysis(schema, document_ast, BaseConfig.QUERY_COST_DEFAULT_LIST_SIZE)
+    budget = schema_loader.load_budget(User(role) if role else None)
+    assert check_budget(analysis, budget, None, {}) is None
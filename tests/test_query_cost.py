@@ -0,0 +1,76 @@
+from types import SimpleNamespace
+from graphene import Int, List, ObjectType, Schema, String, Field
+from graphene.relay import Connection, ConnectionField
+from graphql import parse
+from application.utilities import QueryBudget, QueryCostError
+from application.utilities.query_cost import CostAnalysis, check_budget, execute_within_budget
+
+class Line(ObjectType):
+    text = String()
+
+class Poem(ObjectType):
+    costs = {'expensive': 10}
+    title = String()
+    lines = List(Line)
+    expensive = Field(Line)
+
+class PoemConnection(Connection):
+    total_count = Int()
+
+    class Meta:
+        node = Poem
+
+class Query(ObjectType):
+    poem = Field(Poem)
+    poems = ConnectionField(PoemConnection)
+
+schema = Schema(query=Query)
+
+def estimate(query, variables=None, default_list_size=100):
+    return CostAnalysis(schema, parse(query), default_list_size).estimate(None, variables)
+
+def test_scalars_are_free():
+    assert estimate('{ poem { title } }') == (1, 2)
+
+def test_lists_use_default_size():
+    assert estimate('{ poem { lines { text } } }', default_list_size=5) == (1 + 5, 3)
+
+def test_connection_size():
+    # Edges and nodes are part of the connection, and 'totalCount' isn't multiplied by the size
+    assert estimate('{ poems(first: 3) { totalCount edges { node { title } } } }') == (3, 2)
+    assert estimate('query ($n: Int) { poems(first: $n) { edges { node { poem: title } } } }', {'n': 7}) == (7, 2)
+
+def test_nested_sizes_multiply():
+    assert estimate('{ poems(first: 3) { edges { node { lines { text } } } } }', default_list_size=4) == (3 + 3 * 4, 3)
+
+def test_declared_costs():
+    assert estimate('{ poem { expensive { text } } }') == (1 + 10, 3)
+
+def test_fragments():
+    query = '{ poem { ...Parts } } fragment Parts on Poem { lines { text } ... on Poem { expensive { text } } }'
+    assert estimate(query, default_list_size=2) == (1 + 2 + 10, 3)
+
+def test_check_budget():
+    analysis = CostAnalysis(schema, parse('{ poems(first: 10) { edges { node { lines { text } } } } }'), 10)
+    assert check_budget(analysis, None, None, None) is None
+    assert check_budget(analysis, QueryBudget(cost=110, depth=3), None, None) is None
+    error = check_budget(analysis, QueryBudget(cost=100, depth=None), None, None)
+    assert isinstance(error, QueryCostError)
+    assert error.extensions == {'code': 'QUERY_TOO_EXPENSIVE', 'value': 110, 'limit': 100}
+    error = check_budget(analysis, QueryBudget(cost=None, depth=2), None, None)
+    assert error.extensions['code'] == 'QUERY_TOO_DEEP'
+    # Costs already spent count against the budget
+    assert check_budget(analysis, QueryBudget(cost=110, depth=None), None, None, spent=1) is not None
+
+def test_execute_within_budget_shares_budget():
+    analysis = CostAnalysis(schema, parse('{ poems(first: 10) { edges { node { title } } } }'), 100)
+    context = SimpleNamespace(query_cost=0)
+    execute = lambda **kwargs: 'executed'
+    get_budget = lambda context: QueryBudget(cost=25, depth=None)
+    assert execute_within_budget(execute, analysis, get_budget, context_value=context) == 'executed'
+    assert execute_within_budget(execute, analysis, get_budget, context_value=context) == 'executed'
+    assert context.query_cost == 20
+    result = execute_within_budget(execute, analysis, get_budget, context_value=context)
+    assert result.invalid
+    assert result.errors[0].extensions['code'] == 'QUERY_TOO_EXPENSIVE'
+    assert context.query_cost == 20
@@ -0,0 +1,81 @@
+import mongoengine
+import pytest
+from bson import ObjectId
+from application.models import Poem
+from application.utilities import operators
+from application.utilities.document_path import DocumentPath
+from application.utilities.update_compiler import compile_transforms, CannotCompile
+
+class Line(mongoengine.EmbeddedDocument):
+    id = mongoengine.ObjectIdField(default=ObjectId)
+    text = mongoengine.StringField(required=True)
+
+class Draft(mongoengine.Document):
+    title = mongoengine.StringField(required=True)
+    author = mongoengine.StringField()
+    tags = mongoengine.ListField(mongoengine.StringField())
+    lines = mongoengine.EmbeddedDocumentListField(Line)
+    required_lines = mongoengine.EmbeddedDocumentListField(Line, required=True)
+
+def compile(*transforms, model=Draft):
+    return compile_transforms(model, [(operators.get(op), DocumentPath(path), args) for op, path, args in transforms])
+
+def test_set():
+    update = compile(('set', '', {'field': 'title', 'value': 'x'}))
+    assert update.update == {'$set': {'title': 'x'}}
+    assert update.query == {}
+
+def test_set_none_unsets_optional_field():
+    update = compile(('set', '', {'field': 'author', 'value': None}), ('set', '', {'field': 'title', 'value': 'x'}))
+    assert update.update == {'$unset': {'author': ''}, '$set': {'title': 'x'}}
+
+def test_set_none_on_required_field():
+    with pytest.raises(CannotCompile):
+        compile(('set', '', {'field': 'title', 'value': None}))
+
+def test_set_filtered_line():
+    line_id = ObjectId()
+    update = compile(('set', f'lines[id={line_id}]', {'field': 'text', 'value': 'x'}))
+    assert update.update == {'$set': {'lines.$[f0].text': 'x'}}
+    assert update.array_filters == [{'f0.id': line_id}]
+    # The update only matches documents where the line exists
+    assert update.query == {'lines': {'$elemMatch': {'id': line_id}}}
+
+def test_set_indexed_line():
+    update = compile(('set', 'lines[1]', {'field': 'text', 'value': 'x'}))
+    assert update.update == {'$set': {'lines.1.text': 'x'}}
+    assert update.query == {'lines.1': {'$exists': True}}
+
+@pytest.mark.parametrize('op', ['add', 'remove'])
+def test_list_values_are_not_compiled(op):
+    with pytest.raises(CannotCompile):
+        compile((op, 'tags', {'value': 'x'}))
+
+def test_delete():
+    line_id = ObjectId()
+    update = compile(('delete', 'lines', {'where': {'id': str(line_id)}}))
+    assert update.update == {'$pull': {'lines': {'$or': [{'id': line_id}]}}}
+
+def test_delete_from_required_list():
+    with pytest.raises(CannotCompile):
+        compile(('delete', 'required_lines', {'where': {'id': str(ObjectId())}}))
+
+def test_conflicting_updates():
+    with pytest.raises(CannotCompile):
+        compile(('set', 'lines[0]', {'field': 'text', 'value': 'x'}), ('delete', 'lines', {'where': {'text': 'y'}}))
+
+def test_set_poem_line():
+    # Poem lines use their ID as primary key, which is stored as '_id'
+    line_id = ObjectId()
+    update = compile(('set', f'lines[id={line_id}]', {'field': 'text', 'value': 'x'}), model=Poem)
+    assert update.update == {'$set': {'lines.$[f0].text': 'x'}}
+    assert update.array_filters == [{'f0._id': line_id}]
+    assert update.query == {'lines': {'$elemMatch': {'_id': line_id}}}
+
+@pytest.mark.parametrize('transform', [
+    ('create', 'lines', {'data': {'order': 1, 'text': 'y'}}),
+    ('delete', 'lines', {'where': {'id': str(ObjectId())}}),
+])
+def test_poem_line_set_with_create_or_delete(transform):
+    with pytest.raises(CannotCompile):
+        compile(('set', f'lines[id={ObjectId()}]', {'field': 'text', 'value': 'x'}), transform, model=Poem)